@@ -0,0 +1,282 @@
+"""Admission control for the chat proxy.
+
+Every ``/api/openai/`` call is admitted here before it does any work:
+
+1. A per-user token bucket, measured in estimated prompt tokens, refills at
+   ADMISSION_TOKENS_PER_MINUTE (default 120000) up to ADMISSION_TOKEN_BURST
+   (default 20000).  A request reserves its cost up front; if the bucket
+   would take longer than ADMISSION_MAX_WAIT seconds (default 10) to cover
+   it, the request is rejected with 429 and a Retry-After.
+2. Concurrency slots: at most ADMISSION_MAX_CONCURRENCY requests in flight
+   overall (default 64), ADMISSION_USER_CONCURRENCY per user (default 8) and,
+   optionally, a cap per role from ADMISSION_ROLE_CONCURRENCY
+   (e.g. ``user=48,batch=16``).
+3. Requests that cannot get a slot wait in a weighted fair queue.  Each role
+   gets a share from ADMISSION_WEIGHTS (default ``admin=4,batch=2,user=1``);
+   waiters are served by virtual finish time, so a busy role cannot starve
+   the others.  A request still waiting at its deadline, or arriving when
+   ADMISSION_MAX_QUEUE (default 256) are already waiting, gets a 503.
+
+ADMISSION=0 disables all of it.  State is per process.
+"""
+import asyncio
+import math
+import os
+import threading
+import time
+from collections import OrderedDict
+from typing import Dict, List, Optional
+
+from fastapi import HTTPException
+
+_MAX_TRACKED_USERS = 10000
+
+
+def _env_float(name: str, default: float) -> float:
+    try:
+        return float(os.getenv(name, default))
+    except (TypeError, ValueError):
+        return default
+
+
+def _parse_map(value: str) -> Dict[str, float]:
+    result: Dict[str, float] = {}
+    for part in (value or "").split(","):
+        if "=" not in part:
+            continue
+        name, _, number = part.partition("=")
+        try:
+            result[name.strip()] = float(number)
+        except ValueError:
+            continue
+    return result
+
+
+class _Config:
+    def __init__(self):
+        self.enabled = os.getenv("ADMISSION", "1") != "0"
+        self.max_concurrency = int(_env_float("ADMISSION_MAX_CONCURRENCY", 64))
+        self.user_concurrency = int(_env_float("ADMISSION_USER_CONCURRENCY", 8))
+        self.role_concurrency = {k: int(v) for k, v in _parse_map(os.getenv("ADMISSION_ROLE_CONCURRENCY", "")).items()}
+        self.weights = _parse_map(os.getenv("ADMISSION_WEIGHTS", "admin=4,batch=2,user=1"))
+        self.rate = _env_float("ADMISSION_TOKENS_PER_MINUTE", 120000) / 60.0
+        self.burst = _env_float("ADMISSION_TOKEN_BURST", 20000)
+        self.max_wait = _env_float("ADMISSION_MAX_WAIT", 10)
+        self.max_queue = int(_env_float("ADMISSION_MAX_QUEUE", 256))
+
+
+class _Bucket:
+    __slots__ = ("tokens", "updated")
+
+    def __init__(self, tokens: float, now: float):
+        self.tokens = tokens
+        self.updated = now
+
+    def refill(self, now: float, rate: float, burst: float) -> None:
+        self.tokens = min(burst, self.tokens + (now - self.updated) * rate)
+        self.updated = now
+
+
+class _Waiter:
+    __slots__ = ("user", "role", "tag", "loop", "future", "granted")
+
+    def __init__(self, user, role: str, tag: float):
+        self.user = user
+        self.role = role
+        self.tag = tag
+        self.loop = asyncio.get_running_loop()
+        self.future = self.loop.create_future()
+        self.granted = False
+
+
+class Ticket:
+    """An admitted request's slot and token reservation.
+
+    ``retain``/``release`` are reference counted so a streaming response can
+    keep the slot until its generator finishes.
+    """
+
+    def __init__(self, controller: Optional["AdmissionController"], user, role: str, cost: float):
+        self._controller = controller
+        self.user = user
+        self.role = role
+        self.cost = cost
+        self._refs = 1
+
+    def retain(self) -> "Ticket":
+        self._refs += 1
+        return self
+
+    def release(self) -> None:
+        self._refs -= 1
+        if self._refs == 0 and self._controller is not None:
+            self._controller._release(self)
+
+    def settle(self, actual_cost: float) -> None:
+        """Refund the part of the reservation the request turned out not to need."""
+        if self._controller is not None and actual_cost < self.cost:
+            self._controller._refund(self.user, self.cost - actual_cost)
+            self.cost = actual_cost
+
+
+class AdmissionController:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._buckets: "OrderedDict[object, _Bucket]" = OrderedDict()
+        self._inflight = 0
+        self._inflight_user: Dict[object, int] = {}
+        self._inflight_role: Dict[str, int] = {}
+        self._waiters: List[_Waiter] = []
+        self._virtual_time = 0.0
+        self._last_finish: Dict[str, float] = {}
+        self.rejected_rate = 0
+        self.rejected_capacity = 0
+
+    def _reserve(self, cfg: _Config, user, cost: float) -> float:
+        """Take ``cost`` tokens (possibly going negative); returns seconds to wait."""
+        now = time.monotonic()
+        bucket = self._buckets.get(user)
+        if bucket is None:
+            bucket = self._buckets[user] = _Bucket(cfg.burst, now)
+            while len(self._buckets) > _MAX_TRACKED_USERS:
+                self._buckets.popitem(last=False)
+        else:
+            self._buckets.move_to_end(user)
+            bucket.refill(now, cfg.rate, cfg.burst)
+        bucket.tokens -= cost
+        if bucket.tokens >= 0:
+            return 0.0
+        return math.inf if cfg.rate <= 0 else -bucket.tokens / cfg.rate
+
+    def _refund(self, user, amount: float) -> None:
+        with self._lock:
+            self._refund_locked(user, amount)
+
+    def _fits(self, cfg: _Config, user, role: str) -> bool:
+        if self._inflight >= cfg.max_concurrency:
+            return False
+        if self._inflight_user.get(user, 0) >= cfg.user_concurrency:
+            return False
+        role_cap = cfg.role_concurrency.get(role)
+        return role_cap is None or self._inflight_role.get(role, 0) < role_cap
+
+    def _take(self, user, role: str) -> None:
+        self._inflight += 1
+        self._inflight_user[user] = self._inflight_user.get(user, 0) + 1
+        self._inflight_role[role] = self._inflight_role.get(role, 0) + 1
+
+    async def admit(self, current_user: dict, cost: float) -> Ticket:
+        """Wait for admission or raise HTTPException(429/503) with Retry-After."""
+        cfg = _Config()
+        user = current_user.get("id")
+        role = current_user.get("role") or "user"
+        if not cfg.enabled:
+            return Ticket(None, user, role, cost)
+
+        with self._lock:
+            wait = self._reserve(cfg, user, cost)
+            if wait > cfg.max_wait:
+                self._refund_locked(user, cost)
+                self.rejected_rate += 1
+                retry = "3600" if math.isinf(wait) else str(max(1, math.ceil(wait)))
+                raise HTTPException(
+                    status_code=429,
+                    detail="Token rate limit exceeded. Try again later.",
+                    headers={"Retry-After": retry},
+                )
+        if wait > 0:
+            try:
+                await asyncio.sleep(wait)
+            except asyncio.CancelledError:
+                # the client left while paying off its debt; give the tokens back
+                with self._lock:
+                    self._refund_locked(user, cost)
+                raise
+        ticket = Ticket(self, user, role, cost)
+
+        with self._lock:
+            if not self._waiters and self._fits(cfg, user, role):
+                self._take(user, role)
+                return ticket
+            if len(self._waiters) >= cfg.max_queue:
+                self.rejected_capacity += 1
+                self._refund_locked(user, cost)
+                raise self._busy(cfg)
+            weight = cfg.weights.get(role, 1.0) or 1.0
+            tag = max(self._virtual_time, self._last_finish.get(role, 0.0)) + max(cost, 1.0) / weight
+            self._last_finish[role] = tag
+            waiter = _Waiter(user, role, tag)
+            self._waiters.append(waiter)
+            self._dispatch(cfg)
+
+        try:
+            await asyncio.wait_for(asyncio.shield(waiter.future), max(0.0, cfg.max_wait - wait))
+            return ticket
+        except (asyncio.TimeoutError, asyncio.CancelledError) as exc:
+            with self._lock:
+                if waiter.granted:
+                    # granted just as we gave up; keep it unless we were cancelled
+                    if isinstance(exc, asyncio.TimeoutError):
+                        return ticket
+                    self._release_locked(ticket)
+                else:
+                    self._waiters.remove(waiter)
+                self._refund_locked(user, cost)
+                self.rejected_capacity += 1
+            if isinstance(exc, asyncio.CancelledError):
+                raise
+            raise self._busy(cfg)
+
+    def _busy(self, cfg: _Config) -> HTTPException:
+        return HTTPException(
+            status_code=503,
+            detail="Server is at capacity. Try again shortly.",
+            headers={"Retry-After": str(max(1, math.ceil(cfg.max_wait)))},
+        )
+
+    def _refund_locked(self, user, amount: float) -> None:
+        bucket = self._buckets.get(user)
+        if bucket is not None:
+            bucket.tokens += amount
+
+    def _dispatch(self, cfg: _Config) -> None:
+        """Grant slots to waiters in virtual-finish-time order while limits allow."""
+        for waiter in sorted(self._waiters, key=lambda w: w.tag):
+            if not self._fits(cfg, waiter.user, waiter.role):
+                continue
+            self._waiters.remove(waiter)
+            self._take(waiter.user, waiter.role)
+            waiter.granted = True
+            self._virtual_time = max(self._virtual_time, waiter.tag)
+            waiter.loop.call_soon_threadsafe(_resolve, waiter.future)
+
+    def _release_locked(self, ticket: Ticket) -> None:
+        self._inflight -= 1
+        self._inflight_user[ticket.user] -= 1
+        if not self._inflight_user[ticket.user]:
+            del self._inflight_user[ticket.user]
+        self._inflight_role[ticket.role] -= 1
+        if not self._inflight_role[ticket.role]:
+            del self._inflight_role[ticket.role]
+        self._dispatch(_Config())
+
+    def _release(self, ticket: Ticket) -> None:
+        with self._lock:
+            self._release_locked(ticket)
+
+    def stats(self) -> Dict:
+        with self._lock:
+            return {
+                "inflight": self._inflight,
+                "waiting": len(self._waiters),
+                "rejected_rate": self.rejected_rate,
+                "rejected_capacity": self.rejected_capacity,
+            }
+
+
+def _resolve(future: asyncio.Future) -> None:
+    if not future.done():
+        future.set_result(None)
+
+
+controller = AdmissionController()
@@ -1,9 +1,24 @@
 from fastapi import APIRouter, HTTPException, Header, Depends
+from fastapi.concurrency import run_in_threadpool
+from fastapi.responses import StreamingResponse
 from pydantic import BaseModel
+import asyncio
+import json
 import os
+import time
 
-from typing import List, Dict
+from typing import AsyncIterator, List, Dict, Optional
+from core import admission
+from core import completions
 from core import memory as memory_module
+from core import model_router
+from core import resilience
+from core import summaries
+from core import timing
+from core import tokenizer
+from core import history
+from core import idempotency
+from core import upstream
 from core.memory import MemorySave
 from core.auth import get_current_user
 
@@ -14,188 +29,479 @@ class OpenAIRequest(BaseModel):
     model: str = "gpt-3.5-turbo"
     temperature: float = 0.7
     max_tokens: int = 512
+    # relay upstream server-sent events instead of waiting for the full completion
+    stream: bool = False
 
 @router.post("/openai/")
-def openai_proxy(
+async def openai_proxy(
     req: OpenAIRequest,
     session_id: str = Header(None, alias="X-Session-Id"),
+    idempotency_key: Optional[str] = Header(None, alias="Idempotency-Key"),
+    request_timeout_ms: Optional[str] = Header(None, alias="X-Request-Timeout-Ms"),
     current_user: dict = Depends(get_current_user)
 ):
     """Proxy to OpenAI that requires an X-Session-Id header for tracking.
 
     The session_id is required for downstream memory and logging.
+    The handler is async so that the upstream round trip does not hold a
+    threadpool worker; only the short SQLite calls are run in the pool.
+    With ``stream: true`` the upstream server-sent events are relayed as they
+    arrive and the assembled reply is saved when the stream ends.
+    A retry carrying the same Idempotency-Key replays the first result.
+    The whole turn runs under one deadline (REQUEST_TIMEOUT_MS, optionally
+    shortened by X-Request-Timeout-Ms); running out of time is a 504.
     """
     if not session_id:
         raise HTTPException(status_code=400, detail="X-Session-Id header is required")
+    resilience.start_deadline(request_timeout_ms)
+    if idempotency_key and req.stream:
+        # a relayed stream cannot be replayed
+        raise HTTPException(status_code=400, detail="Idempotency-Key is not supported for streamed responses")
 
+    async def admitted_turn():
+        # Admission control before any work: reserve the prompt plus the most history
+        # we could send, then settle to the real size once history is trimmed.
+        with timing.phase("admission"):
+            ticket = await resilience.bounded(
+                admission.controller.admit(current_user, tokenizer.count_tokens(req.prompt, req.model) + history.token_budget()),
+                "admission",
+            )
+        try:
+            return await _proxy_turn(req, session_id, current_user, ticket)
+        finally:
+            ticket.release()
+
+    return await idempotency.run(
+        "openai", idempotency_key, current_user,
+        idempotency.fingerprint(session_id, req.model_dump()), admitted_turn,
+    )
+
+
+async def _proxy_turn(req: OpenAIRequest, session_id: str, current_user: dict, ticket: admission.Ticket):
     # Persist the incoming user prompt so history is durable and complete
     try:
-        memory_module.save_memory(
+        saved = memory_module.store_memory(
             MemorySave(
                 session_id=session_id,
                 role="user",
                 message=req.prompt,
                 user_id=current_user["id"],
             ),
-            current_user=current_user,
+            current_user,
+            req.model,
         )
+        # the prompt must be committed before history is read back; shielded so
+        # a deadline does not cancel the queued write itself
+        with timing.phase("prompt_save"):
+            await resilience.bounded(asyncio.shield(asyncio.wrap_future(saved)), "prompt save")
+    except resilience.DeadlineExceeded:
+        raise
     except Exception as exc:
         # log to stdout for debugging; we intentionally do not abort the request
         print(f"warning: failed to save prompt memory: {exc}")
 
-    # Fetch recent memory for this session
+    # Fetch the recent history for this session, trimmed newest-first to whole
+    # turns (user+assistant pairs) within the token budget (MEMORY_TOKEN_BUDGET),
+    # led by the running summary of older turns when there is one.
     try:
-        history = memory_module.get_all_memory(session_id=session_id, current_user=current_user) or []
+        messages: List[Dict] = await resilience.bounded(
+            run_in_threadpool(memory_module.get_context_messages, session_id, current_user, history.token_budget()),
+            "history",
+        ) or []
+    except resilience.DeadlineExceeded:
+        raise
     except Exception:
-        history = []
-
-    # memory.get_all_memory returns newest-first. Use a simple token-estimate heuristic
-    # and prefer including full turns (user+assistant pairs).
-    # Allow configuring the token budget via environment variable
-    DEFAULT_TOKEN_BUDGET = 3000
-    TOKEN_BUDGET = DEFAULT_TOKEN_BUDGET
-    env_val = os.getenv("MEMORY_TOKEN_BUDGET")
-    if env_val is not None:
-        try:
-            TOKEN_BUDGET = int(env_val)
-        except Exception:
-            TOKEN_BUDGET = DEFAULT_TOKEN_BUDGET
-
-    def estimate_tokens(s: str) -> int:
-        return max(1, (len(s) + 3) // 4)
-
-    # Build turns from newest-first history. Each turn is a tuple (user_entry, assistant_entry)
-    turns_newest_first: List[tuple] = []
-    i = 0
-    while i < len(history):
-        entry = history[i]
-        role = (entry.get("role") or "").lower()
-        if role == "assistant":
-            # try to pair with a user entry after this assistant
-            if i + 1 < len(history) and (history[i + 1].get("role") or "").lower() == "user":
-                user_entry = history[i + 1]
-                assistant_entry = entry
-                turns_newest_first.append((user_entry, assistant_entry))
-                i += 2
-            else:
-                # assistant without paired user
-                turns_newest_first.append((None, entry))
-                i += 1
-        elif role == "user":
-            # user without assistant yet
-            turns_newest_first.append((entry, None))
-            i += 1
-        else:
-            # other roles treated as single-message user turns
-            turns_newest_first.append((entry, None))
-            i += 1
-
-    included_turns_newest_first: List[tuple] = []
-    total_tokens = 0
-    seen_user_included = False
-    for user_entry, assistant_entry in turns_newest_first:
-        user_text = (user_entry.get("message") if user_entry else "") or ""
-        assistant_text = (assistant_entry.get("message") if assistant_entry else "") or ""
-        t_user = estimate_tokens(user_text)
-        t_assist = estimate_tokens(assistant_text) if assistant_text else 0
-
-        if not seen_user_included and user_text:
-            # Always include the most recent user message even if it exceeds the budget.
-            # Include assistant reply in the same turn only if it fits.
-            included_turns_newest_first.append((user_entry, assistant_entry))
-            total_tokens += t_user
-            if assistant_text and total_tokens + t_assist <= TOKEN_BUDGET:
-                total_tokens += t_assist
-            seen_user_included = True
-            continue
-
-        # For subsequent turns include the full turn only if it fits in remaining budget
-        if total_tokens + t_user + t_assist <= TOKEN_BUDGET:
-            included_turns_newest_first.append((user_entry, assistant_entry))
-            total_tokens += t_user + t_assist
-        else:
-            # stop when budget exhausted
-            break
-
-    # Flatten included turns to messages (oldest-first)
-    recent_oldest_first: List[Dict] = []
-    for user_entry, assistant_entry in reversed(included_turns_newest_first):
-        if user_entry:
-            recent_oldest_first.append({"role": user_entry.get("role", "user"), "content": user_entry.get("message", "")})
-        if assistant_entry:
-            recent_oldest_first.append({"role": assistant_entry.get("role", "assistant"), "content": assistant_entry.get("message", "")})
-
-    messages: List[Dict] = recent_oldest_first
+        messages = []
+    ticket.settle(sum(tokenizer.count_many((m.get("content") or "" for m in messages), req.model)))
 
     if os.getenv("MOCK_MODE") == "1":
         # In mock mode, synthesize an assistant reply and persist it
         assistant_text = f"MOCK_REPLY: reply to {req.prompt[:64]}"
-        # Persist assistant reply to memory (include user context)
-        try:
-            memory_module.save_memory(
-                MemorySave(
-                    session_id=session_id,
-                    role="assistant",
-                    message=assistant_text,
-                    user_id=current_user["id"],
-                ),
-                current_user=current_user,
+        if req.stream:
+            return _TicketedStream(
+                _mock_event_stream(assistant_text, req.model, session_id, current_user),
+                ticket.retain(),
+                media_type="text/event-stream",
+                headers={"X-Session-Id": session_id, "Cache-Control": "no-cache"},
             )
-        except Exception:
-            pass
+        # Persist assistant reply to memory (include user context)
+        _save_assistant_reply(session_id, assistant_text, current_user, req.model)
         return {"response": assistant_text, "session_id": session_id, "messages": messages}
 
-    api_key = os.getenv("OPENAI_API_KEY")
-    if not api_key:
-        raise HTTPException(status_code=403, detail="Ingen API-nyckel satt")
-
     # the session_id and user are implicitly associated; we don't allow an external
     # caller to pretend to be someone else by setting the header differently.
     # (current_user is already validated above.)
+    payload = {
+        "model": req.model,
+        "messages": messages,
+        "temperature": req.temperature,
+        "max_tokens": req.max_tokens
+    }
 
-    # import requests lazily so module import works even when requests isn't installed
-    import requests
-
-    resp = requests.post(
-        "https://api.openai.com/v1/chat/completions",
-        headers={
-            "Authorization": f"Bearer {api_key}",
-            "Content-Type": "application/json"
-        },
-        json={
-            "model": req.model,
-            "messages": messages,
-            "temperature": req.temperature,
-            "max_tokens": req.max_tokens
-        }
-    )
-    # Pass session id back so caller can correlate logs/memory
-    result = resp.json()
+    if req.stream:
+        # streamed replies are relayed from OpenAI only
+        return await _openai_stream(payload, session_id, current_user, ticket)
+
+    async def call_backend() -> dict:
+        return await model_router.router.complete(payload)
+
+    # identical concurrent requests share one backend call; temperature 0
+    # replies may come from the response cache (RESPONSE_CACHE_TTL)
+    with timing.phase("upstream"):
+        result = await completions.complete(payload, call_backend)
 
     # Try to extract assistant reply text and persist it to memory
-    assistant_text = None
+    assistant_text = _assistant_text(result)
+    if assistant_text:
+        _save_assistant_reply(session_id, assistant_text, current_user, req.model)
+
+    if isinstance(result, dict):
+        result.setdefault("session_id", session_id)
+    return result
+
+
+def _assistant_text(result) -> Optional[str]:
+    """The assistant reply carried by an upstream result, if any."""
     try:
         if isinstance(result, dict) and "choices" in result:
-            assistant_text = result["choices"][0]["message"]["content"]
+            return result["choices"][0]["message"]["content"]
         elif isinstance(result, dict) and "response" in result:
-            assistant_text = result.get("response")
+            return result.get("response")
     except Exception:
-        assistant_text = None
+        return None
+    return None
 
-    if assistant_text:
+
+class BatchItem(BaseModel):
+    session_id: str
+    prompt: str
+    model: str = "gpt-3.5-turbo"
+    temperature: float = 0.7
+    max_tokens: int = 512
+
+
+class BatchRequest(BaseModel):
+    items: List[BatchItem]
+
+
+@router.post("/openai/batch")
+async def openai_batch(
+    req: BatchRequest,
+    request_timeout_ms: Optional[str] = Header(None, alias="X-Request-Timeout-Ms"),
+    current_user: dict = Depends(get_current_user)
+):
+    """Run many independent chat turns in one request.
+
+    Authenticates once, reads every session's history and running summary
+    with one query each and runs the turns with at most BATCH_CONCURRENCY (default 8) in flight.
+    Results are streamed back as NDJSON lines in completion order, each
+    tagged with the item's ``index``; a failed item gets an ``error`` line
+    instead.  REQUEST_TIMEOUT_MS (or a shorter X-Request-Timeout-Ms) applies
+    to each item from the moment it starts, not to the whole batch.  All prompts and replies are saved in one transaction at the
+    end, followed by a final ``{"saved": n}`` line.  Ownership rules are the
+    same as for /openai/.
+    """
+    if not req.items:
+        raise HTTPException(status_code=400, detail="items must not be empty")
+    limit = int(os.getenv("BATCH_MAX_ITEMS", 1000))
+    if len(req.items) > limit:
+        raise HTTPException(status_code=413, detail=f"At most {limit} items per batch")
+    # bounds the setup below; every item gets a fresh deadline of its own
+    resilience.start_deadline(request_timeout_ms)
+
+    uid = current_user["id"]
+    session_ids = list(dict.fromkeys(item.session_id for item in req.items))
+    owners = await run_in_threadpool(memory_module.session_owners, session_ids)
+    foreign = {sid for sid, owner in owners.items() if owner != uid}
+    owned = [sid for sid in session_ids if sid not in foreign]
+    windows = await run_in_threadpool(memory_module.load_session_windows, owned, current_user)
+    running = await run_in_threadpool(summaries.load_many, owned, uid) if summaries.enabled() else {}
+    return StreamingResponse(
+        _batch_results(req.items, windows, running, foreign, current_user, request_timeout_ms),
+        media_type="application/x-ndjson",
+    )
+
+
+async def _batch_turn(item: BatchItem, window: List, summary: Optional[summaries.Summary], current_user: dict,
+                      budget: int) -> dict:
+    prompt = history.to_cached({"role": "user", "message": item.prompt}, item.model)
+    if summaries.enabled():
+        # same context as /openai/: summary first, evicted turns folded in the background
+        messages = summaries.context_messages([prompt] + window, summary, budget, item.session_id, current_user["id"])
+    else:
+        messages = history.trim_to_budget([prompt] + window, budget)
+    ticket = await resilience.bounded(
+        admission.controller.admit(current_user, sum(tokenizer.count_many((m["content"] or "" for m in messages), item.model))),
+        "admission",
+    )
+    try:
+        if os.getenv("MOCK_MODE") == "1":
+            return {"response": f"MOCK_REPLY: reply to {item.prompt[:64]}", "messages": messages}
+        payload = {
+            "model": item.model,
+            "messages": messages,
+            "temperature": item.temperature,
+            "max_tokens": item.max_tokens
+        }
+
+        async def call_backend() -> dict:
+            return await model_router.router.complete(payload)
+
+        return await completions.complete(payload, call_backend)
+    finally:
+        ticket.release()
+
+
+async def _batch_results(items: List[BatchItem], windows: Dict, running: Dict, foreign: set, current_user: dict,
+                         request_timeout_ms: Optional[str] = None) -> AsyncIterator[str]:
+    budget = history.token_budget()
+    limit = asyncio.Semaphore(max(1, int(os.getenv("BATCH_CONCURRENCY", 8))))
+    rows: List[MemorySave] = []
+    # each row's model, so its token_count matches the tokenizer it is trimmed with
+    models: List[str] = []
+    uid = current_user["id"]
+
+    async def run(index: int, item: BatchItem):
+        async with limit:
+            try:
+                # each task runs in its own context, so this deadline is the item's alone
+                resilience.start_deadline(request_timeout_ms)
+                turn = _batch_turn(item, windows[item.session_id], running.get(item.session_id), current_user, budget)
+                return index, await turn, None
+            except HTTPException as exc:
+                return index, None, {"status": exc.status_code, "detail": exc.detail}
+            except Exception as exc:
+                return index, None, {"status": 500, "detail": str(exc)}
+
+    def line(data: dict) -> str:
+        return json.dumps(data, ensure_ascii=False, default=str) + "\n"
+
+    tasks = []
+    try:
+        for index, item in enumerate(items):
+            if item.session_id in foreign:
+                yield line({"index": index, "session_id": item.session_id,
+                            "error": {"status": 400, "detail": "session_id already used by another user"}})
+            else:
+                tasks.append(asyncio.ensure_future(run(index, item)))
+        for done in asyncio.as_completed(tasks):
+            index, result, error = await done
+            item = items[index]
+            # like /openai/, the prompt is kept even when the call fails
+            rows.append(MemorySave(session_id=item.session_id, role="user", message=item.prompt, user_id=uid))
+            models.append(item.model)
+            if error is not None:
+                yield line({"index": index, "session_id": item.session_id, "error": error})
+                continue
+            text = _assistant_text(result)
+            if text:
+                rows.append(MemorySave(session_id=item.session_id, role="assistant", message=text, user_id=uid))
+                models.append(item.model)
+            if isinstance(result, dict):
+                result.setdefault("session_id", item.session_id)
+            yield line(dict(result, index=index) if isinstance(result, dict) else {"index": index, "result": result})
+        saving, rows = rows, []
         try:
-            memory_module.save_memory(
+            if saving:
+                await asyncio.shield(asyncio.wrap_future(memory_module.store_memories(saving, current_user, models)))
+        except HTTPException as exc:
+            yield line({"saved": 0, "error": {"status": exc.status_code, "detail": exc.detail}})
+        else:
+            yield line({"saved": len(saving)})
+    finally:
+        for task in tasks:
+            task.cancel()
+        if rows:
+            # client went away mid-batch: still keep what was answered
+            try:
+                memory_module.store_memories(rows, current_user, models)
+            except Exception as exc:
+                print(f"warning: failed to save batch memory: {exc}")
+
+
+async def _openai_stream(payload: dict, session_id: str, current_user: dict, ticket: admission.Ticket):
+    """Open a streamed upstream completion and relay it as server-sent events."""
+    api_key = os.getenv("OPENAI_API_KEY")
+    if not api_key:
+        raise HTTPException(status_code=403, detail="Ingen API-nyckel satt")
+
+    breaker = model_router.router.backend("openai").breaker
+    if not breaker.allow():
+        raise HTTPException(
+            status_code=503, detail="Upstream is unavailable", headers={"Retry-After": str(breaker.retry_after())}
+        )
+
+    import httpx
+
+    client = upstream.get_client()
+    headers = {
+        "Authorization": f"Bearer {api_key}",
+        "Content-Type": "application/json"
+    }
+    try:
+        # the deadline covers getting the response headers, not the whole stream
+        with timing.phase("upstream"):
+            resp = await resilience.bounded(
+                client.send(
+                    client.build_request("POST", upstream.chat_url(), headers=headers, json=dict(payload, stream=True)),
+                    stream=True,
+                ),
+                "upstream",
+            )
+    except resilience.DeadlineExceeded:
+        breaker.release_probe()
+        raise
+    except httpx.TimeoutException:
+        breaker.record(False)
+        raise HTTPException(status_code=504, detail="Upstream timed out")
+    except httpx.HTTPError as exc:
+        breaker.record(False)
+        raise HTTPException(status_code=502, detail=f"Upstream request failed: {exc}")
+    except asyncio.CancelledError:
+        breaker.release_probe()
+        raise
+    breaker.record(resp.status_code < 500)
+    if resp.status_code >= 400:
+        # surface upstream errors as a normal response before any bytes are streamed
+        body = await resp.aread()
+        await resp.aclose()
+        raise HTTPException(status_code=resp.status_code, detail=body.decode(errors="replace"))
+    return _TicketedStream(
+        _relay_event_stream(resp, session_id, current_user, payload["model"]),
+        ticket.retain(),
+        upstream_response=resp,
+        media_type="text/event-stream",
+        headers={"X-Session-Id": session_id, "Cache-Control": "no-cache"},
+    )
+
+
+@router.get("/openai/backends")
+def backend_stats(current_user: dict = Depends(get_current_user)):
+    """Routing policy and per-backend latency/error figures (admins only)."""
+    if current_user.get("role") != "admin":
+        raise HTTPException(status_code=403, detail="Only admins can view backend stats")
+    return model_router.router.stats()
+
+
+@router.get("/openai/cache")
+def completion_cache_stats(current_user: dict = Depends(get_current_user)):
+    """Response cache and coalescing counters for monitoring (admins only)."""
+    if current_user.get("role") != "admin":
+        raise HTTPException(status_code=403, detail="Only admins can view cache stats")
+    return completions.cache.stats()
+
+
+def _save_assistant_reply(session_id: str, text: str, current_user: dict, model: Optional[str] = None) -> None:
+    """Queue an assistant reply for persistence without waiting for the commit.
+
+    Failures are logged but never abort the request.
+    """
+    queued = time.perf_counter()
+
+    def _saved(fut) -> None:
+        # the request does not wait for the commit, so this only reaches /metrics
+        timing.observe("reply_save", time.perf_counter() - queued)
+        if fut.exception() is not None:
+            print(f"warning: failed to save assistant memory: {fut.exception()}")
+
+    try:
+        with timing.phase("reply_queue"):
+            memory_module.store_memory(
                 MemorySave(
                     session_id=session_id,
                     role="assistant",
-                    message=assistant_text,
+                    message=text,
                     user_id=current_user["id"],
                 ),
-                current_user=current_user,
-            )
-        except Exception as exc:
-            print(f"warning: failed to save assistant memory: {exc}")
+                current_user,
+                model,
+            ).add_done_callback(_saved)
+    except Exception as exc:
+        print(f"warning: failed to save assistant memory: {exc}")
 
-    if isinstance(result, dict):
-        result.setdefault("session_id", session_id)
-    return result
+
+def _sse_delta_text(line: str) -> str:
+    """Return the content delta carried by one SSE ``data:`` line, or ''."""
+    if not line.startswith("data:"):
+        return ""
+    data = line[5:].strip()
+    if not data or data == "[DONE]":
+        return ""
+    try:
+        chunk = json.loads(data)
+        return chunk["choices"][0].get("delta", {}).get("content") or ""
+    except (ValueError, KeyError, IndexError, TypeError, AttributeError):
+        return ""
+
+
+def _persist_streamed_reply(session_id: str, parts: List[str], current_user: dict, model: Optional[str] = None) -> None:
+    """Save the assembled reply once the stream ends or the client goes away."""
+    text = "".join(parts)
+    if text:
+        # queuing never awaits, so this also runs for a cancelled (disconnected) stream
+        _save_assistant_reply(session_id, text, current_user, model)
+
+
+class _TicketedStream(StreamingResponse):
+    """A streamed reply that holds an admission ticket until it is done.
+
+    The ticket is released (and the upstream response closed) when sending
+    ends for any reason, including a client that left before the body
+    iterator was ever started, which skips both the iterator's ``finally``
+    and Starlette's background task.
+    """
+
+    def __init__(self, content, ticket: admission.Ticket, upstream_response=None, **kwargs):
+        super().__init__(content, **kwargs)
+        self._ticket = ticket
+        self._upstream_response = upstream_response
+
+    async def __call__(self, scope, receive, send):
+        try:
+            await super().__call__(scope, receive, send)
+        finally:
+            self._ticket.release()
+            try:
+                # runs the iterator's own cleanup if it was left suspended
+                await self.body_iterator.aclose()
+            finally:
+                if self._upstream_response is not None:
+                    await self._upstream_response.aclose()
+
+
+async def _relay_event_stream(resp, session_id: str, current_user: dict, model: str) -> AsyncIterator[str]:
+    """Relay upstream SSE lines as they arrive while assembling the reply text."""
+    parts: List[str] = []
+    try:
+        async for line in resp.aiter_lines():
+            parts.append(_sse_delta_text(line))
+            yield line + "\n"
+    finally:
+        _persist_streamed_reply(session_id, parts, current_user, model)
+
+
+async def _mock_event_stream(text: str, model: str, session_id: str, current_user: dict) -> AsyncIterator[str]:
+    """Synthetic OpenAI-style chunk stream used in MOCK_MODE."""
+    parts: List[str] = []
+    try:
+        for i, word in enumerate(text.split(" ")):
+            piece = word if i == 0 else " " + word
+            chunk = {
+                "id": f"mock-{session_id}",
+                "object": "chat.completion.chunk",
+                "model": model,
+                "choices": [{"index": 0, "delta": {"content": piece}, "finish_reason": None}],
+            }
+            parts.append(piece)
+            yield f"data: {json.dumps(chunk)}\n\n"
+            await asyncio.sleep(0)
+        done = {
+            "id": f"mock-{session_id}",
+            "object": "chat.completion.chunk",
+            "model": model,
+            "choices": [{"index": 0, "delta": {}, "finish_reason": "stop"}],
+        }
+        yield f"data: {json.dumps(done)}\n\n"
+        yield "data: [DONE]\n\n"
+    finally:
+        _persist_streamed_reply(session_id, parts, current_user, model)
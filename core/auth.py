@@ -15,61 +15,50 @@ import base64
 import hashlib
 import hmac
 import json
+import threading
+from collections import OrderedDict
 
 from fastapi import APIRouter, HTTPException, Depends, Request
+from fastapi.concurrency import run_in_threadpool
 from fastapi.security import OAuth2PasswordBearer
 from pydantic import BaseModel
 
+from core import passwords
+from core import ratelimit
+from core import timing
+
 router = APIRouter()
 
 oauth2_scheme = OAuth2PasswordBearer(tokenUrl="/auth/login")
 
 
-# Simple in-memory rate limiter for login attempts
-# Tracks failed login attempts per IP address with expiration after 5 minutes
-_login_attempts = {}  # {ip: [(timestamp, failed), ...]}
+# Rate limiter for failed login attempts: 5 per IP per 5 minutes, shared by
+# all workers through the database (see core/ratelimit.py)
 _RATE_LIMIT_MAX_ATTEMPTS = 5
 _RATE_LIMIT_WINDOW_SECONDS = 300  # 5 minutes
+_login_attempts = ratelimit.SlidingWindowLimiter(
+    "login", _RATE_LIMIT_MAX_ATTEMPTS, _RATE_LIMIT_WINDOW_SECONDS
+)
 
 
 def _get_client_ip(request: Request) -> str:
     """Extract client IP from request, handling X-Forwarded-For header."""
-    if request.headers.get("x-forwarded-for"):
-        return request.headers.get("x-forwarded-for").split(",")[0].strip()
-    return request.client.host if request.client else "unknown"
+    return ratelimit.client_ip(request)
 
 
 def _check_rate_limit(ip: str) -> bool:
-    """Check if IP is within rate limit. Remove expired entries. Returns True if OK."""
-    now = datetime.utcnow().timestamp()
-    
-    # Clean up expired entries
-    if ip in _login_attempts:
-        _login_attempts[ip] = [
-            ts for ts in _login_attempts[ip]
-            if now - ts < _RATE_LIMIT_WINDOW_SECONDS
-        ]
-        if not _login_attempts[ip]:
-            del _login_attempts[ip]
-    
-    # Check limit
-    if ip in _login_attempts and len(_login_attempts[ip]) >= _RATE_LIMIT_MAX_ATTEMPTS:
-        return False
-    return True
+    """Check if IP is within rate limit. Returns True if OK."""
+    return _login_attempts.allow(ip)
 
 
 def _record_failed_login(ip: str) -> None:
     """Record a failed login attempt for the given IP."""
-    now = datetime.utcnow().timestamp()
-    if ip not in _login_attempts:
-        _login_attempts[ip] = []
-    _login_attempts[ip].append(now)
+    _login_attempts.hit(ip)
 
 
 def _reset_login_attempts(ip: str) -> None:
     """Reset (clear) login attempts for the given IP after successful login."""
-    if ip in _login_attempts:
-        del _login_attempts[ip]
+    _login_attempts.reset(ip)
 
 
 class Token(BaseModel):
@@ -92,8 +81,8 @@ def hash_password(password: str) -> str:
 
     Requires bcrypt to be installed. Raises RuntimeError if bcrypt is unavailable.
     """
-    # bcrypt works with bytes
-    return bcrypt.hashpw(password.encode(), bcrypt.gensalt()).decode()
+    # bcrypt works with bytes; cost factor comes from BCRYPT_ROUNDS
+    return passwords.hash_sync(password)
 
 
 def verify_password(password: str, hashed: str) -> bool:
@@ -101,10 +90,7 @@ def verify_password(password: str, hashed: str) -> bool:
 
     Requires bcrypt to be installed. Raises RuntimeError if bcrypt is unavailable.
     """
-    try:
-        return bcrypt.checkpw(password.encode(), hashed.encode())
-    except Exception:
-        return False
+    return passwords.check_sync(password, hashed)
 
 
 def _get_jwt_secret() -> str:
@@ -115,6 +101,79 @@ def _get_jwt_secret() -> str:
     return secret
 
 
+# HMAC state keyed once with the current secret; copied per signature
+_hmac_key = (None, None)  # (secret, prepared hmac object)
+
+
+def _sign(message: bytes) -> bytes:
+    global _hmac_key
+    secret = _get_jwt_secret()
+    cached_secret, prepared = _hmac_key
+    if cached_secret != secret:
+        prepared = hmac.new(secret.encode(), digestmod=hashlib.sha256)
+        _hmac_key = (secret, prepared)
+    mac = prepared.copy()
+    mac.update(message)
+    return mac.digest()
+
+
+class _VerifiedTokenCache:
+    """Bounded LRU of already-verified tokens -> user dict.
+
+    Entries expire at the token's own ``exp`` and are tied to the secret they
+    were verified with, so rotating JWT_SECRET invalidates them.
+    """
+
+    def __init__(self, max_entries: int):
+        self.max_entries = max_entries
+        self._entries = OrderedDict()  # token -> (exp, secret, user)
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, token: str) -> Optional[Dict]:
+        now = datetime.utcnow().timestamp()
+        secret = os.getenv("JWT_SECRET")
+        with self._lock:
+            entry = self._entries.get(token)
+            if entry is not None:
+                exp, verified_secret, user = entry
+                if exp >= int(now) and verified_secret == secret:
+                    self._entries.move_to_end(token)
+                    self.hits += 1
+                    return dict(user)
+                del self._entries[token]
+            self.misses += 1
+            return None
+
+    def put(self, token: str, exp: int, user: Dict) -> None:
+        if self.max_entries <= 0:
+            return
+        with self._lock:
+            self._entries[token] = (exp, os.getenv("JWT_SECRET"), dict(user))
+            self._entries.move_to_end(token)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self) -> Dict:
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                "size": len(self._entries),
+                "max_entries": self.max_entries,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": (self.hits / total) if total else 0.0,
+            }
+
+
+_token_cache = _VerifiedTokenCache(int(os.getenv("AUTH_TOKEN_CACHE_SIZE", "4096")))
+
+
 def _b64url_encode(data: bytes) -> str:
     """Helper to produce URL-safe base64 without padding."""
     return base64.urlsafe_b64encode(data).decode().rstrip("=")
@@ -138,9 +197,7 @@ def create_access_token(data: Dict[str, Optional[str]]) -> str:
 
     header_b = _b64url_encode(json.dumps(header).encode())
     payload_b = _b64url_encode(json.dumps(payload).encode())
-    secret = _get_jwt_secret().encode()
-    sig = hmac.new(secret, f"{header_b}.{payload_b}".encode(), hashlib.sha256).digest()
-    sig_b = _b64url_encode(sig)
+    sig_b = _b64url_encode(_sign(f"{header_b}.{payload_b}".encode()))
     return f"{header_b}.{payload_b}.{sig_b}"
 
 
@@ -162,8 +219,7 @@ def decode_token(token: str) -> Dict:
         raise HTTPException(status_code=401, detail="Invalid authentication credentials")
     
     # Validate signature first (no change to existing logic)
-    secret = _get_jwt_secret().encode()
-    expected_sig = hmac.new(secret, f"{header_b}.{payload_b}".encode(), hashlib.sha256).digest()
+    expected_sig = _sign(f"{header_b}.{payload_b}".encode())
     if not hmac.compare_digest(_b64url_encode(expected_sig), sig_b):
         raise HTTPException(status_code=401, detail="Invalid authentication credentials")
     
@@ -206,45 +262,109 @@ def decode_token(token: str) -> Dict:
 def get_current_user(token: str = Depends(oauth2_scheme)) -> Dict:
     """Dependency that returns the decoded token payload as a user dict.
 
-    Expects the token to include `user_id` and `role` claims.
+    Expects the token to include `user_id` and `role` claims.  Tokens that
+    already passed :func:`decode_token` are served from an LRU until they expire.
     """
-    payload = decode_token(token)
-    user_id = payload.get("user_id")
-    role = payload.get("role")
-    if user_id is None:
-        raise HTTPException(status_code=401, detail="Invalid token payload")
-    return {"id": user_id, "role": role}
+    with timing.phase("auth"):
+        cached = _token_cache.get(token)
+        if cached is not None:
+            return cached
+        payload = decode_token(token)
+        user_id = payload.get("user_id")
+        role = payload.get("role")
+        if user_id is None:
+            raise HTTPException(status_code=401, detail="Invalid token payload")
+        user = {"id": user_id, "role": role}
+        _token_cache.put(token, int(payload["exp"]), user)
+        return user
+
+
+def token_cache_stats() -> Dict:
+    """Hit/miss counters of the verified-token cache."""
+    return _token_cache.stats()
+
+
+def _password_busy() -> HTTPException:
+    # bcrypt pool is saturated: shed load fast rather than queue behind it
+    return HTTPException(
+        status_code=503,
+        detail="Authentication is busy. Try again shortly.",
+        headers={"Retry-After": "1"},
+    )
+
+
+def _fetch_login_row(username: str):
+    from core.database import get_db
+
+    conn = get_db()
+    try:
+        c = conn.cursor()
+        c.execute("SELECT id, password_hash, role FROM users WHERE username = ?", (username,))
+        row = c.fetchone()
+        return dict(row) if row else None
+    finally:
+        conn.close()
+
+
+def _schedule_rehash(user_id: int, password: str) -> None:
+    """Upgrade a stored hash to the current BCRYPT_ROUNDS in the background."""
+    from core import database, writer
+
+    path = database.DB_PATH
+
+    def store(fut) -> None:
+        if fut.exception() is not None:
+            return
+
+        def update(c):
+            c.execute("UPDATE users SET password_hash = ? WHERE id = ?", (fut.result(), user_id))
+
+        writer.memory_writer.submit(path, update)
+
+    try:
+        passwords.pool.submit(passwords.hash_sync, password, passwords.rounds()).add_done_callback(store)
+    except passwords.PoolFull:
+        # not urgent; the next login will try again
+        pass
 
 
 @router.post("/login", response_model=Token)
-def login(req: LoginRequest, request: Request):
+async def login(req: LoginRequest, request: Request):
     """Verify credentials and emit a JWT.
     
-    Rate limited to 5 failed attempts per IP per 5 minutes.
+    Rate limited to 5 failed attempts per IP per 5 minutes.  bcrypt runs on
+    the bounded password pool; when it is full the request gets a 503.
     """
     ip = _get_client_ip(request)
     
     # Check rate limit before processing
-    if not _check_rate_limit(ip):
+    if not await run_in_threadpool(_check_rate_limit, ip):
         raise HTTPException(status_code=429, detail="Too many failed login attempts. Try again later.")
-    
-    from core.database import get_db
 
-    conn = get_db()
+    row = await run_in_threadpool(_fetch_login_row, req.username)
     try:
-        c = conn.cursor()
-        c.execute("SELECT id, password_hash, role FROM users WHERE username = ?", (req.username,))
-        row = c.fetchone()
-        if not row or not verify_password(req.password, row["password_hash"]):
-            # Record failed attempt and return 401
-            _record_failed_login(ip)
-            raise HTTPException(status_code=401, detail="Invalid username or password")
-        # Successful login: reset rate limit counter
-        _reset_login_attempts(ip)
-        token = create_access_token({"user_id": row["id"], "role": row["role"]})
-        return {"access_token": token, "token_type": "bearer"}
-    finally:
-        conn.close()
+        with timing.phase("password"):
+            ok = bool(row) and await passwords.verify_password(req.password, row["password_hash"])
+    except passwords.PoolFull:
+        raise _password_busy()
+    if not ok:
+        # Record failed attempt and return 401
+        await run_in_threadpool(_record_failed_login, ip)
+        raise HTTPException(status_code=401, detail="Invalid username or password")
+    # Successful login: reset rate limit counter
+    await run_in_threadpool(_reset_login_attempts, ip)
+    if passwords.needs_rehash(row["password_hash"]):
+        _schedule_rehash(row["id"], req.password)
+    token = create_access_token({"user_id": row["id"], "role": row["role"]})
+    return {"access_token": token, "token_type": "bearer"}
+
+
+@router.get("/token-cache")
+def token_cache(current_user: dict = Depends(get_current_user)):
+    """Verified-token cache counters for monitoring (admins only)."""
+    if current_user.get("role") != "admin":
+        raise HTTPException(status_code=403, detail="Only admins can view cache stats")
+    return token_cache_stats()
 
 
 class UserResponse(BaseModel):
@@ -253,41 +373,63 @@ class UserResponse(BaseModel):
     username: str
 
 
-@router.post("/register", response_model=UserResponse, status_code=201)
-def register(req: RegistrationRequest, current_user: dict = Depends(get_current_user)):
-    """Register a new user. Only admins can perform this action.
-
-    The registering user (derived from the bearer token) must have role == "admin".
-    """
+def _insert_user(username: str, hashed: str) -> int:
     from core.database import get_db
 
-    # Check that the current user is an admin
-    if current_user.get("role") != "admin":
-        raise HTTPException(status_code=403, detail="Only admins can register users")
-
-    # Validate username is provided
-    if not req.username:
-        raise HTTPException(status_code=400, detail="Username is required")
-    if not req.password:
-        raise HTTPException(status_code=400, detail="Password is required")
-
     conn = get_db()
     try:
         c = conn.cursor()
 
         # Check for duplicate username
-        c.execute("SELECT id FROM users WHERE username = ?", (req.username,))
+        c.execute("SELECT id FROM users WHERE username = ?", (username,))
         if c.fetchone():
             raise HTTPException(status_code=400, detail="Username already exists")
 
         # Insert new user with default role "user"
-        hashed = hash_password(req.password)
         c.execute(
             "INSERT INTO users (username, password_hash, role, created_at) VALUES (?, ?, ?, ?)",
-            (req.username, hashed, "user", datetime.utcnow().isoformat()),
+            (username, hashed, "user", datetime.utcnow().isoformat()),
         )
         conn.commit()
-        user_id = c.lastrowid
-        return {"id": user_id, "username": req.username}
+        return c.lastrowid
+    finally:
+        conn.close()
+
+
+def _username_taken(username: str) -> bool:
+    from core.database import get_db
+
+    conn = get_db()
+    try:
+        c = conn.cursor()
+        c.execute("SELECT id FROM users WHERE username = ?", (username,))
+        return c.fetchone() is not None
     finally:
         conn.close()
+
+
+@router.post("/register", response_model=UserResponse, status_code=201)
+async def register(req: RegistrationRequest, current_user: dict = Depends(get_current_user)):
+    """Register a new user. Only admins can perform this action.
+
+    The registering user (derived from the bearer token) must have role == "admin".
+    """
+    # Check that the current user is an admin
+    if current_user.get("role") != "admin":
+        raise HTTPException(status_code=403, detail="Only admins can register users")
+
+    # Validate username is provided
+    if not req.username:
+        raise HTTPException(status_code=400, detail="Username is required")
+    if not req.password:
+        raise HTTPException(status_code=400, detail="Password is required")
+
+    # cheap duplicate check first so taken names never cost a bcrypt hash
+    if await run_in_threadpool(_username_taken, req.username):
+        raise HTTPException(status_code=400, detail="Username already exists")
+    try:
+        hashed = await passwords.hash_password(req.password)
+    except passwords.PoolFull:
+        raise _password_busy()
+    user_id = await run_in_threadpool(_insert_user, req.username, hashed)
+    return {"id": user_id, "username": req.username}
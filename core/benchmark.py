@@ -0,0 +1,323 @@
+"""End-to-end load benchmark for the proxy and memory endpoints.
+
+Runs the app in-process against a throwaway database with MOCK_MODE=1, so
+numbers reflect BrainForce itself (auth, admission, SQLite, history
+trimming) rather than upstream latency.  Synthetic users and sessions are
+seeded with ``--history-depth`` messages each, then every scenario is driven
+by N closed-loop clients per concurrency level:
+
+- ``chat``     POST /api/openai/
+- ``save``     POST /memory/save/
+- ``session``  GET /memory/session/{id}/
+
+The report is JSON: per scenario and level, RPS, p50/p95/p99/mean latency in
+milliseconds, status counts and SQLite write-lock counters
+(:func:`core.database.lock_stats`).  ``--baseline FILE`` compares against an
+earlier report and exits 1 when p95 grows or RPS drops by more than
+``--tolerance`` (default 0.2, i.e. 20%).
+
+    python -m core.benchmark --concurrency 1,8,32 --duration 5 --output bench.json
+    python -m core.benchmark --baseline bench.json
+
+By default replies come from MOCK_MODE, which skips the upstream path.
+``--upstream fake`` runs the fake OpenAI server from core/mock.py in-process
+instead, so the HTTP client, JSON parsing, retries and breakers are measured
+too (shape it with the MOCK_UPSTREAM_* variables); ``--upstream URL`` uses a
+fake (or real) upstream already listening at that base URL.
+
+The token bucket of the admission controller is lifted (unless set in the
+environment) so it does not dominate the measurement; concurrency caps stay.
+"""
+import argparse
+import asyncio
+import json
+import math
+import os
+import platform
+import sys
+import tempfile
+import time
+from datetime import datetime, timezone
+from typing import Dict, List, Optional
+
+SCENARIOS = ("chat", "save", "session")
+
+# below this many milliseconds a p95 change is noise, not a regression
+_MIN_P95_DELTA_MS = 1.0
+
+
+def percentile(sorted_values: List[float], pct: float) -> float:
+    """Nearest-rank percentile of an already sorted list."""
+    if not sorted_values:
+        return 0.0
+    rank = max(1, math.ceil(pct / 100.0 * len(sorted_values)))
+    return sorted_values[min(rank, len(sorted_values)) - 1]
+
+
+_FAKE_UPSTREAM_URL = "http://fake-upstream/v1"
+
+
+def _configure_env(upstream: Optional[str]) -> None:
+    if upstream:
+        os.environ.pop("MOCK_MODE", None)
+        os.environ["OPENAI_BASE_URL"] = _FAKE_UPSTREAM_URL if upstream == "fake" else upstream
+        os.environ.setdefault("OPENAI_API_KEY", "benchmark")
+    else:
+        os.environ["MOCK_MODE"] = "1"
+    os.environ.setdefault("JWT_SECRET", "benchmark-secret")
+    os.environ.setdefault("ADMISSION_TOKENS_PER_MINUTE", "1000000000")
+    os.environ.setdefault("ADMISSION_TOKEN_BURST", "1000000000")
+
+
+def seed(users: int, sessions_per_user: int, history_depth: int) -> List[Dict]:
+    """Create users with sessions of ``history_depth`` messages; returns their clients' identities."""
+    from core import auth
+    from core import database
+    from core import history
+
+    now = datetime.now(timezone.utc).isoformat()
+    identities: List[Dict] = []
+    conn = database.get_db()
+    try:
+        c = conn.cursor()
+        for u in range(users):
+            c.execute(
+                "INSERT INTO users (username, password_hash, role, created_at) VALUES (?, ?, ?, ?)",
+                (f"bench{u}", "!", "user", now),
+            )
+            uid = c.lastrowid
+            session_ids = [f"bench-{u}-{s}" for s in range(sessions_per_user)]
+            for sid in session_ids:
+                rows = []
+                for i in range(history_depth):
+                    role = "user" if i % 2 == 0 else "assistant"
+                    message = f"{role} message {i} in {sid}: " + "lorem ipsum dolor sit amet " * 4
+                    rows.append((sid, uid, role, message, now, history.estimate_tokens(message)))
+                c.executemany(
+                    "INSERT INTO memory (session_id, user_id, role, message, timestamp, token_count) VALUES (?, ?, ?, ?, ?, ?)",
+                    rows,
+                )
+                c.execute(
+                    "INSERT INTO sessions (session_id, user_id, created_at, last_active, message_count, token_total) "
+                    "VALUES (?, ?, ?, ?, ?, ?)",
+                    (sid, uid, now, now, len(rows), sum(r[5] for r in rows)),
+                )
+            token = auth.create_access_token({"user_id": uid, "role": "user"})
+            identities.append({"headers": {"Authorization": f"Bearer {token}"}, "sessions": session_ids})
+        conn.commit()
+    finally:
+        conn.close()
+    return identities
+
+
+async def _request(client, scenario: str, identity: Dict, n: int):
+    sid = identity["sessions"][n % len(identity["sessions"])]
+    headers = identity["headers"]
+    if scenario == "chat":
+        return await client.post(
+            "/api/openai/", json={"prompt": f"benchmark prompt {n}"}, headers={**headers, "X-Session-Id": sid}
+        )
+    if scenario == "save":
+        return await client.post(
+            "/memory/save/", json={"session_id": sid, "role": "user", "message": f"benchmark note {n}"}, headers=headers
+        )
+    if scenario == "session":
+        return await client.get(f"/memory/session/{sid}/", headers=headers)
+    raise ValueError(f"unknown scenario {scenario!r}")
+
+
+async def run_level(client, scenario: str, identities: List[Dict], concurrency: int, duration: float,
+                    max_requests: Optional[int] = None) -> Dict:
+    """Drive ``scenario`` with ``concurrency`` closed-loop clients; returns its stats."""
+    from core import database
+    from core import writer
+
+    latencies: List[float] = []
+    statuses: Dict[str, int] = {}
+    issued = 0
+    database.reset_lock_stats()
+    started = time.perf_counter()
+    stop_at = started + duration
+
+    async def client_loop(worker: int) -> None:
+        nonlocal issued
+        identity = identities[worker % len(identities)]
+        while time.perf_counter() < stop_at and (max_requests is None or issued < max_requests):
+            n = issued
+            issued += 1
+            t0 = time.perf_counter()
+            try:
+                resp = await _request(client, scenario, identity, n)
+                status = str(resp.status_code)
+            except Exception as exc:
+                status = type(exc).__name__
+            latencies.append((time.perf_counter() - t0) * 1000.0)
+            statuses[status] = statuses.get(status, 0) + 1
+
+    await asyncio.gather(*(client_loop(w) for w in range(concurrency)))
+    elapsed = time.perf_counter() - started
+    # queued writes belong to this level's cost
+    await asyncio.to_thread(writer.memory_writer.flush, 30)
+
+    latencies.sort()
+    ok = sum(count for status, count in statuses.items() if status.startswith("2"))
+    return {
+        "requests": len(latencies),
+        "errors": len(latencies) - ok,
+        "status": statuses,
+        "seconds": round(elapsed, 3),
+        "rps": round(len(latencies) / elapsed, 2) if elapsed > 0 else 0.0,
+        "p50_ms": round(percentile(latencies, 50), 3),
+        "p95_ms": round(percentile(latencies, 95), 3),
+        "p99_ms": round(percentile(latencies, 99), 3),
+        "mean_ms": round(sum(latencies) / len(latencies), 3) if latencies else 0.0,
+        "sqlite_lock": database.lock_stats(),
+    }
+
+
+async def _run(identities: List[Dict], scenarios: List[str], levels: List[int], duration: float,
+               max_requests: Optional[int]) -> Dict:
+    import httpx
+    from core.main import app
+
+    results: Dict[str, Dict] = {}
+    transport = httpx.ASGITransport(app=app)
+    async with httpx.AsyncClient(transport=transport, base_url="http://benchmark", timeout=None) as client:
+        for scenario in scenarios:
+            results[scenario] = {}
+            for level in levels:
+                results[scenario][str(level)] = await run_level(
+                    client, scenario, identities, level, duration, max_requests
+                )
+    return results
+
+
+def run(scenarios=SCENARIOS, concurrency=(1, 8, 32), duration: float = 5.0, users: int = 8,
+        sessions_per_user: int = 4, history_depth: int = 50, max_requests: Optional[int] = None,
+        db_path: Optional[str] = None, upstream: Optional[str] = None) -> Dict:
+    """Seed a fresh database, run every scenario at every level and return the report.
+
+    ``upstream`` is None (MOCK_MODE), ``"fake"`` or an upstream base URL.
+    """
+    for scenario in scenarios:
+        if scenario not in SCENARIOS:
+            raise ValueError(f"unknown scenario {scenario!r}")
+    _configure_env(upstream)
+    import httpx
+    from core import database
+    from core import mock
+    from core import summaries
+    from core import upstream as upstream_module
+    from core import writer
+
+    saved_transport, saved_client = upstream_module._transport, upstream_module._client
+    if upstream == "fake":
+        upstream_module._transport = httpx.ASGITransport(app=mock.create_app())
+        upstream_module._client = None
+
+    with tempfile.TemporaryDirectory(prefix="brainforce-bench-") as tmp:
+        previous = database.DB_PATH
+        database.DB_PATH = db_path or os.path.join(tmp, "benchmark.db")
+        try:
+            database.init_db()
+            identities = seed(users, sessions_per_user, history_depth)
+            results = asyncio.run(_run(identities, list(scenarios), list(concurrency), duration, max_requests))
+            summaries.folder.wait(30)
+            writer.memory_writer.flush(30)
+        finally:
+            database.DB_PATH = previous
+            database.close_all()
+            upstream_module._transport, upstream_module._client = saved_transport, saved_client
+
+    return {
+        "config": {
+            "scenarios": list(scenarios),
+            "concurrency": list(concurrency),
+            "duration": duration,
+            "users": users,
+            "sessions_per_user": sessions_per_user,
+            "history_depth": history_depth,
+            "max_requests": max_requests,
+            "upstream": upstream or "mock_mode",
+            "python": platform.python_version(),
+            "timestamp": datetime.now(timezone.utc).isoformat(),
+        },
+        "results": results,
+    }
+
+
+def compare(current: Dict, baseline: Dict, tolerance: float = 0.2) -> List[str]:
+    """Regressions of ``current`` against ``baseline``; empty when within tolerance.
+
+    Only scenario/level pairs present in both reports are compared.
+    """
+    regressions: List[str] = []
+    for scenario, levels in current.get("results", {}).items():
+        for level, now in levels.items():
+            before = baseline.get("results", {}).get(scenario, {}).get(level)
+            if before is None:
+                continue
+            name = f"{scenario}@{level}"
+            if now["p95_ms"] > before["p95_ms"] * (1 + tolerance) and now["p95_ms"] - before["p95_ms"] > _MIN_P95_DELTA_MS:
+                regressions.append(f"{name}: p95 {before['p95_ms']}ms -> {now['p95_ms']}ms")
+            if now["rps"] < before["rps"] * (1 - tolerance):
+                regressions.append(f"{name}: rps {before['rps']} -> {now['rps']}")
+            if now["errors"] > before["errors"]:
+                regressions.append(f"{name}: errors {before['errors']} -> {now['errors']}")
+    return regressions
+
+
+def _int_list(value: str) -> List[int]:
+    return [int(part) for part in value.split(",") if part.strip()]
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(prog="python -m core.benchmark", description="BrainForce load benchmark (MOCK_MODE)")
+    parser.add_argument("--scenarios", default=",".join(SCENARIOS), help="comma separated: chat,save,session")
+    parser.add_argument("--concurrency", type=_int_list, default=[1, 8, 32], help="comma separated levels")
+    parser.add_argument("--duration", type=float, default=5.0, help="seconds per scenario and level")
+    parser.add_argument("--requests", type=int, default=None, help="stop a level after this many requests")
+    parser.add_argument("--users", type=int, default=8)
+    parser.add_argument("--sessions", type=int, default=4, help="sessions per user")
+    parser.add_argument("--history-depth", type=int, default=50, help="seeded messages per session")
+    parser.add_argument("--upstream", default=None, help="'fake' for the in-process fake upstream, or a base URL")
+    parser.add_argument("--db", default=None, help="database file to use instead of a temporary one")
+    parser.add_argument("--output", default=None, help="write the JSON report here (default stdout)")
+    parser.add_argument("--baseline", default=None, help="compare against this report and fail on regressions")
+    parser.add_argument("--tolerance", type=float, default=0.2)
+    args = parser.parse_args(argv)
+
+    baseline = None
+    if args.baseline:
+        # read first: --output may point at the same file
+        with open(args.baseline) as fh:
+            baseline = json.load(fh)
+    report = run(
+        scenarios=[s.strip() for s in args.scenarios.split(",") if s.strip()],
+        concurrency=args.concurrency,
+        duration=args.duration,
+        users=max(1, args.users),
+        sessions_per_user=max(1, args.sessions),
+        history_depth=max(0, args.history_depth),
+        max_requests=args.requests,
+        db_path=args.db,
+        upstream=args.upstream,
+    )
+    text = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, "w") as fh:
+            fh.write(text + "\n")
+    else:
+        print(text)
+
+    if baseline is not None:
+        regressions = compare(report, baseline, args.tolerance)
+        for line in regressions:
+            print(f"regression: {line}", file=sys.stderr)
+        if regressions:
+            return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,234 @@
+"""Request coalescing and a response cache for upstream chat completions.
+
+Two layers sit in front of the upstream call in ``openai_proxy``:
+
+- :class:`SingleFlight` lets identical requests that are in flight at the
+  same time (same model, trimmed messages, temperature and max_tokens) share
+  one upstream call.  Every caller still persists the reply to its own
+  session.
+- :class:`ResponseCache` keeps completions for ``temperature == 0`` requests
+  for RESPONSE_CACHE_TTL seconds (default 0, i.e. off).  A bounded LRU of
+  RESPONSE_CACHE_SIZE entries (default 1024) is backed by the
+  ``response_cache`` table, so entries survive restarts and are shared by
+  workers; RESPONSE_CACHE_DISK=0 keeps it in memory only.
+
+Both are keyed by :func:`request_key`, a hash of the canonical JSON payload.
+"""
+import asyncio
+import copy
+import hashlib
+import json
+import os
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import Future
+from typing import Awaitable, Callable, Dict, Optional
+
+from fastapi.concurrency import run_in_threadpool
+
+from core import database
+from core import writer
+
+_PRUNE_EVERY = 256
+
+
+def request_key(payload: dict) -> str:
+    """Stable hash of the fields that determine a completion."""
+    canonical = json.dumps(
+        {
+            "model": payload.get("model"),
+            "messages": payload.get("messages"),
+            "temperature": payload.get("temperature"),
+            "max_tokens": payload.get("max_tokens"),
+        },
+        sort_keys=True,
+        separators=(",", ":"),
+        ensure_ascii=False,
+    )
+    return hashlib.sha256(canonical.encode()).hexdigest()
+
+
+class _Abandoned(Exception):
+    """The leading call was cancelled; followers make their own call."""
+
+
+class SingleFlight:
+    """Runs one call per key at a time and hands its result to every waiter.
+
+    Calls are tracked with ``concurrent.futures.Future`` so callers on
+    different event loops (or threads) can share them.
+    """
+
+    def __init__(self):
+        self._calls: Dict[str, Future] = {}
+        self._lock = threading.Lock()
+        self.coalesced = 0
+
+    async def do(self, key: str, fn: Callable[[], Awaitable[dict]]) -> dict:
+        with self._lock:
+            shared = self._calls.get(key)
+            if shared is None:
+                shared = self._calls[key] = Future()
+                leader = True
+            else:
+                self.coalesced += 1
+                leader = False
+
+        if not leader:
+            try:
+                # shield: a cancelled follower must not cancel the shared call
+                return copy.deepcopy(await asyncio.shield(asyncio.wrap_future(shared)))
+            except _Abandoned:
+                return await fn()
+
+        try:
+            result = await fn()
+        except BaseException as exc:
+            shared.set_exception(_Abandoned() if isinstance(exc, asyncio.CancelledError) else exc)
+            raise
+        else:
+            shared.set_result(result)
+        finally:
+            with self._lock:
+                self._calls.pop(key, None)
+        # followers copy out of the shared result, the leader gets its own copy too
+        return copy.deepcopy(result)
+
+
+class ResponseCache:
+    """TTL'd LRU of completions with an optional SQLite tier."""
+
+    def __init__(self):
+        self._entries: "OrderedDict[tuple, tuple]" = OrderedDict()
+        self._lock = threading.Lock()
+        self._puts = 0
+        self.memory_hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+
+    def ttl(self) -> float:
+        try:
+            return max(0.0, float(os.getenv("RESPONSE_CACHE_TTL", 0)))
+        except ValueError:
+            return 0.0
+
+    def max_entries(self) -> int:
+        try:
+            return int(os.getenv("RESPONSE_CACHE_SIZE", 1024))
+        except ValueError:
+            return 1024
+
+    def disk_enabled(self) -> bool:
+        return os.getenv("RESPONSE_CACHE_DISK", "1") != "0"
+
+    def applies(self, payload: dict) -> bool:
+        """Only deterministic requests are cached."""
+        return self.ttl() > 0 and payload.get("temperature") == 0 and not payload.get("stream")
+
+    async def get(self, key: str) -> Optional[dict]:
+        now = time.time()
+        mem_key = (database.DB_PATH, key)
+        with self._lock:
+            entry = self._entries.get(mem_key)
+            if entry is not None:
+                expires_at, body = entry
+                if expires_at > now:
+                    self._entries.move_to_end(mem_key)
+                    self.memory_hits += 1
+                    return json.loads(body)
+                del self._entries[mem_key]
+
+        row = await run_in_threadpool(self._load, key, now) if self.disk_enabled() else None
+        with self._lock:
+            if row is None:
+                self.misses += 1
+                return None
+            self.disk_hits += 1
+            self._remember(mem_key, row["expires_at"], row["body"])
+        return json.loads(row["body"])
+
+    def _load(self, key: str, now: float):
+        conn = database.get_db()
+        try:
+            return conn.execute(
+                "SELECT body, expires_at FROM response_cache WHERE key = ? AND expires_at > ?",
+                (key, now),
+            ).fetchone()
+        finally:
+            conn.close()
+
+    def _remember(self, mem_key: tuple, expires_at: float, body: str) -> None:
+        if self.max_entries() <= 0:
+            return
+        self._entries[mem_key] = (expires_at, body)
+        self._entries.move_to_end(mem_key)
+        while len(self._entries) > self.max_entries():
+            self._entries.popitem(last=False)
+
+    def put(self, key: str, result: dict) -> None:
+        now = time.time()
+        expires_at = now + self.ttl()
+        body = json.dumps(result, separators=(",", ":"), ensure_ascii=False)
+        with self._lock:
+            self._remember((database.DB_PATH, key), expires_at, body)
+            self._puts += 1
+            prune = self._puts % _PRUNE_EVERY == 0
+        if not self.disk_enabled():
+            return
+
+        def upsert(c) -> None:
+            c.execute(
+                "INSERT OR REPLACE INTO response_cache (key, body, expires_at) VALUES (?, ?, ?)",
+                (key, body, expires_at),
+            )
+            if prune:
+                c.execute("DELETE FROM response_cache WHERE expires_at <= ?", (now,))
+
+        def log_failure(fut) -> None:
+            if fut.exception() is not None:
+                print(f"warning: failed to store cached response: {fut.exception()}")
+
+        writer.memory_writer.submit(database.DB_PATH, upsert).add_done_callback(log_failure)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self) -> dict:
+        with self._lock:
+            hits = self.memory_hits + self.disk_hits
+            lookups = hits + self.misses
+            return {
+                "entries": len(self._entries),
+                "memory_hits": self.memory_hits,
+                "disk_hits": self.disk_hits,
+                "misses": self.misses,
+                "hit_rate": round(hits / lookups, 4) if lookups else 0.0,
+                "coalesced": flights.coalesced,
+            }
+
+
+flights = SingleFlight()
+cache = ResponseCache()
+
+
+async def complete(payload: dict, call: Callable[[], Awaitable[dict]]) -> dict:
+    """Serve ``payload`` from the cache, a shared in-flight call, or ``call()``.
+
+    Only successful completions (a dict with ``choices``) are cached.
+    """
+    key = request_key(payload)
+    cacheable = cache.applies(payload)
+
+    async def fetch() -> dict:
+        if cacheable:
+            cached = await cache.get(key)
+            if cached is not None:
+                return cached
+        result = await call()
+        if cacheable and isinstance(result, dict) and result.get("choices"):
+            cache.put(key, result)
+        return result
+
+    return await flights.do(key, fetch)
@@ -1,53 +1,171 @@
 """Database helpers for BrainForce.
 
-Provides get_db() and a simple init_db() to ensure schema exists.
+Provides get_db() and init_db(), which migrates the schema to the latest version.
+
+Connections are pooled per database file.  get_db() hands out an idle
+connection (or opens a new one) and ``close()`` returns it to the pool, so
+callers keep the familiar ``conn = get_db() ... conn.close()`` shape while
+connection setup disappears from the hot path.  New connections are tuned
+with WAL journaling and these environment-configurable PRAGMAs:
+
+- SQLITE_BUSY_TIMEOUT_MS (default 5000)
+- SQLITE_CACHE_SIZE (default -16000, i.e. ~16 MiB of page cache)
+- SQLITE_MMAP_SIZE bytes (default 64 MiB)
+- SQLITE_STATEMENT_CACHE prepared statements per connection (default 256)
+- SQLITE_POOL_SIZE idle connections kept per database (default 8)
+
+Write transactions start with :func:`begin_immediate`, which counts how often
+taking the write lock had to wait (longer than SQLITE_LOCK_WAIT_MS, default 1)
+or gave up with "database is locked"; see :func:`lock_stats`.
 """
 import sqlite3
 import os
+import threading
+import time
+from typing import Dict, List, Optional
+
+from core import migrations
 
 DB_PATH = os.path.join(os.path.dirname(__file__), "../knowledge/brainforce.db")
 
 
-def ensure_db_dir():
-    d = os.path.dirname(DB_PATH)
+def _env_int(name: str, default: int) -> int:
+    try:
+        return int(os.getenv(name, default))
+    except (TypeError, ValueError):
+        return default
+
+
+def ensure_db_dir(path: Optional[str] = None):
+    d = os.path.dirname(path or DB_PATH)
     if d and not os.path.exists(d):
         os.makedirs(d, exist_ok=True)
 
 
-def get_db():
-    ensure_db_dir()
-    conn = sqlite3.connect(DB_PATH)
+def _connect(path: str) -> sqlite3.Connection:
+    ensure_db_dir(path)
+    conn = sqlite3.connect(
+        path,
+        check_same_thread=False,
+        cached_statements=_env_int("SQLITE_STATEMENT_CACHE", 256),
+    )
     conn.row_factory = sqlite3.Row
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    conn.execute(f"PRAGMA busy_timeout={_env_int('SQLITE_BUSY_TIMEOUT_MS', 5000)}")
+    conn.execute(f"PRAGMA cache_size={_env_int('SQLITE_CACHE_SIZE', -16000)}")
+    conn.execute(f"PRAGMA mmap_size={_env_int('SQLITE_MMAP_SIZE', 64 * 1024 * 1024)}")
+    conn.execute("PRAGMA foreign_keys=OFF")
     return conn
 
 
+class PooledConnection:
+    """sqlite3.Connection proxy whose close() hands the connection back to the pool."""
+
+    __slots__ = ("_conn", "_path")
+
+    def __init__(self, conn: sqlite3.Connection, path: str):
+        self._conn = conn
+        self._path = path
+
+    def __getattr__(self, name):
+        conn = self._conn
+        if conn is None:
+            raise sqlite3.ProgrammingError("Cannot operate on a closed database.")
+        return getattr(conn, name)
+
+    def close(self) -> None:
+        conn, self._conn = self._conn, None
+        if conn is not None:
+            _release(self._path, conn)
+
+
+_pool: Dict[str, List[sqlite3.Connection]] = {}
+_pool_lock = threading.Lock()
+
+
+def get_db(path: Optional[str] = None) -> PooledConnection:
+    """Borrow a tuned connection to ``path`` (default DB_PATH) from the pool."""
+    path = path or DB_PATH
+    with _pool_lock:
+        idle = _pool.get(path)
+        conn = idle.pop() if idle else None
+    if conn is None:
+        conn = _connect(path)
+    return PooledConnection(conn, path)
+
+
+def _release(path: str, conn: sqlite3.Connection) -> None:
+    try:
+        # never hand out a connection with a half-finished transaction
+        if conn.in_transaction:
+            conn.rollback()
+    except sqlite3.Error:
+        conn.close()
+        return
+    with _pool_lock:
+        idle = _pool.setdefault(path, [])
+        if len(idle) < _env_int("SQLITE_POOL_SIZE", 8):
+            idle.append(conn)
+            return
+    conn.close()
+
+
+def close_all() -> None:
+    """Close every idle pooled connection (called on app shutdown)."""
+    with _pool_lock:
+        conns = [c for idle in _pool.values() for c in idle]
+        _pool.clear()
+    for conn in conns:
+        try:
+            conn.close()
+        except sqlite3.Error:
+            pass
+
+
+_lock_stats = {"acquired": 0, "waits": 0, "wait_seconds": 0.0, "busy": 0}
+_lock_stats_lock = threading.Lock()
+
+
+def begin_immediate(c) -> None:
+    """Start a write transaction on cursor ``c``, recording any wait for the lock."""
+    started = time.perf_counter()
+    try:
+        c.execute("BEGIN IMMEDIATE")
+    except sqlite3.OperationalError as exc:
+        if "locked" in str(exc) or "busy" in str(exc):
+            with _lock_stats_lock:
+                _lock_stats["busy"] += 1
+                _lock_stats["wait_seconds"] += time.perf_counter() - started
+        raise
+    waited = time.perf_counter() - started
+    with _lock_stats_lock:
+        _lock_stats["acquired"] += 1
+        if waited * 1000.0 > _env_int("SQLITE_LOCK_WAIT_MS", 1):
+            _lock_stats["waits"] += 1
+            _lock_stats["wait_seconds"] += waited
+
+
+def lock_stats() -> dict:
+    """Write-lock counters since start (or the last :func:`reset_lock_stats`)."""
+    with _lock_stats_lock:
+        stats = dict(_lock_stats)
+    stats["wait_seconds"] = round(stats["wait_seconds"], 6)
+    return stats
+
+
+def reset_lock_stats() -> None:
+    with _lock_stats_lock:
+        _lock_stats.update(acquired=0, waits=0, wait_seconds=0.0, busy=0)
+
+
 def init_db():
-    """Initialize DB schema for memory and users (safe to call multiple times)."""
+    """Initialize DB schema for memory and users (safe to call multiple times).
+
+    Applies any pending versioned migrations, see core/migrations.py.
+    """
     conn = get_db()
-    c = conn.cursor()
-    # user table used for authentication
-    c.execute("""
-        CREATE TABLE IF NOT EXISTS users (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            username TEXT UNIQUE,
-            password_hash TEXT,
-            role TEXT,
-            created_at TEXT
-        )
-    """)
-    # memory table now tracks user_id so that sessions are scoped
-    c.execute("""
-        CREATE TABLE IF NOT EXISTS memory (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            session_id TEXT,
-            user_id INTEGER,
-            role TEXT,
-            message TEXT,
-            timestamp TEXT,
-            FOREIGN KEY(user_id) REFERENCES users(id)
-        )
-    """)
-    # index to speed lookups by session and user
-    c.execute("CREATE INDEX IF NOT EXISTS idx_memory_session ON memory(session_id)")
-    conn.commit()
-    conn.close()
+    try:
+        migrations.run(conn)
+    finally:
+        conn.close()
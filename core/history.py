@@ -0,0 +1,261 @@
+"""Session history window cache and turn-aware trimming.
+
+The proxy needs the newest messages of a session on every call.  Instead of
+re-reading up to 200 rows from SQLite and re-estimating their tokens each
+time, a bounded per-session window is kept in process:
+
+- entries carry the token_count persisted with each row at insert time
+- ``core.memory.save_memory`` updates a cached window write-through
+- whole sessions are evicted least-recently-used once the cache exceeds
+  HISTORY_CACHE_BYTES (default 16 MiB, 0 disables caching)
+
+Trimming walks the window from the newest entry and stops as soon as the
+token budget is exhausted, so its cost is proportional to what is included.
+
+The cache is per process: writes made by another worker process to a session
+this worker has cached are not seen until the window is evicted.
+"""
+import os
+import threading
+from collections import OrderedDict
+from typing import Callable, Dict, Iterator, List, Optional, Sequence, Tuple
+
+# keep as many rows as get_all_memory has always returned for a session
+WINDOW_ROWS = 200
+DEFAULT_TOKEN_BUDGET = 3000
+DEFAULT_CACHE_BYTES = 16 * 1024 * 1024
+# rough per-entry overhead of the dict and tuple wrappers
+_ENTRY_OVERHEAD = 200
+
+# (entry dict as stored in the memory table, estimated tokens of its message)
+CachedEntry = Tuple[Dict, int]
+
+
+def estimate_tokens(s: str) -> int:
+    return max(1, (len(s) + 3) // 4)
+
+
+def token_budget() -> int:
+    """Token budget for included history, configurable via MEMORY_TOKEN_BUDGET."""
+    env_val = os.getenv("MEMORY_TOKEN_BUDGET")
+    if env_val is not None:
+        try:
+            return int(env_val)
+        except Exception:
+            return DEFAULT_TOKEN_BUDGET
+    return DEFAULT_TOKEN_BUDGET
+
+
+def _entry_size(entry: Dict) -> int:
+    return len(entry.get("message") or "") + _ENTRY_OVERHEAD
+
+
+def _role(entry: Optional[Dict]) -> str:
+    return ((entry.get("role") if entry else "") or "").lower()
+
+
+def iter_turns(newest_first: Sequence[CachedEntry]) -> Iterator[Tuple[Optional[CachedEntry], Optional[CachedEntry]]]:
+    """Yield (user, assistant) turns from newest-first entries, lazily.
+
+    An assistant message is paired with the user message directly before it;
+    unpaired assistant messages and other roles form single-message turns.
+    """
+    i = 0
+    n = len(newest_first)
+    while i < n:
+        item = newest_first[i]
+        if _role(item[0]) == "assistant":
+            # try to pair with a user entry after this assistant
+            if i + 1 < n and _role(newest_first[i + 1][0]) == "user":
+                yield newest_first[i + 1], item
+                i += 2
+            else:
+                # assistant without paired user
+                yield None, item
+                i += 1
+        else:
+            # user without assistant yet (other roles are treated the same)
+            yield item, None
+            i += 1
+
+
+def select_turns(newest_first: Sequence[CachedEntry], budget: int) -> Tuple[List[tuple], int]:
+    """Pick the turns that fit in ``budget``, newest first.
+
+    Returns the included (user entry, assistant entry) pairs and how many of
+    the newest entries they span; everything after that index was left out.
+    """
+    included_newest_first: List[tuple] = []
+    total_tokens = 0
+    spanned = 0
+    seen_user_included = False
+    for user_item, assistant_item in iter_turns(newest_first):
+        user_entry = user_item[0] if user_item else None
+        assistant_entry = assistant_item[0] if assistant_item else None
+        user_text = (user_entry.get("message") if user_entry else "") or ""
+        assistant_text = (assistant_entry.get("message") if assistant_entry else "") or ""
+        t_user = user_item[1] if user_item else estimate_tokens(user_text)
+        t_assist = assistant_item[1] if assistant_text else 0
+
+        if not seen_user_included and user_text:
+            # Always include the most recent user message even if it exceeds the budget.
+            # Include assistant reply in the same turn only if it fits.
+            included_newest_first.append((user_entry, assistant_entry))
+            total_tokens += t_user
+            if assistant_text and total_tokens + t_assist <= budget:
+                total_tokens += t_assist
+            seen_user_included = True
+        # For subsequent turns include the full turn only if it fits in remaining budget
+        elif total_tokens + t_user + t_assist <= budget:
+            included_newest_first.append((user_entry, assistant_entry))
+            total_tokens += t_user + t_assist
+        else:
+            # stop when budget exhausted
+            break
+        spanned += (user_item is not None) + (assistant_item is not None)
+    return included_newest_first, spanned
+
+
+def to_messages(included_newest_first: Sequence[tuple]) -> List[Dict]:
+    """Flatten turns picked by :func:`select_turns` to chat messages, oldest first."""
+    messages: List[Dict] = []
+    for user_entry, assistant_entry in reversed(included_newest_first):
+        if user_entry:
+            messages.append({"role": user_entry.get("role", "user"), "content": user_entry.get("message", "")})
+        if assistant_entry:
+            messages.append({"role": assistant_entry.get("role", "assistant"), "content": assistant_entry.get("message", "")})
+    return messages
+
+
+def trim_to_budget(newest_first: Sequence[CachedEntry], budget: int) -> List[Dict]:
+    """Return chat messages (oldest-first) for the turns that fit in ``budget``.
+
+    The most recent user message is always included even if it exceeds the
+    budget; its assistant reply only if it fits.  Older turns are included
+    whole or not at all, and the walk stops at the first turn that does not fit.
+    """
+    return to_messages(select_turns(newest_first, budget)[0])
+
+
+def to_cached(entry: Dict, model: Optional[str] = None) -> CachedEntry:
+    # rows carry the token_count persisted at insert time; count only as a fallback
+    tokens = entry.get("token_count")
+    if tokens is None:
+        from core import tokenizer
+
+        tokens = tokenizer.count_tokens(entry.get("message") or "", model)
+    return entry, tokens
+
+
+class _Window:
+    __slots__ = ("entries", "size")
+
+    def __init__(self, entries: List[CachedEntry]):
+        # oldest-first so appends are O(1)
+        self.entries = entries
+        self.size = sum(_entry_size(e) for e, _ in entries)
+
+
+class HistoryCache:
+    """LRU of per-session history windows bounded by an approximate byte budget."""
+
+    def __init__(self, max_bytes: Optional[int] = None):
+        if max_bytes is None:
+            try:
+                max_bytes = int(os.getenv("HISTORY_CACHE_BYTES", DEFAULT_CACHE_BYTES))
+            except ValueError:
+                max_bytes = DEFAULT_CACHE_BYTES
+        self.max_bytes = max_bytes
+        self._windows: "OrderedDict[tuple, _Window]" = OrderedDict()
+        self._bytes = 0
+        # keys currently being loaded (with loader count) and those written meanwhile
+        self._loading: Dict[tuple, int] = {}
+        self._dirty: set = set()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    @property
+    def enabled(self) -> bool:
+        return self.max_bytes > 0
+
+    def get_or_load(self, key: tuple, loader: Callable[[], List[Dict]]) -> List[CachedEntry]:
+        """Return a newest-first snapshot of the window for ``key``.
+
+        ``loader`` returns the newest-first rows from SQLite and is only
+        called on a miss.
+        """
+        with self._lock:
+            window = self._windows.get(key)
+            if window is not None:
+                self._windows.move_to_end(key)
+                self.hits += 1
+                return window.entries[::-1]
+            self.misses += 1
+            if self.enabled:
+                self._loading[key] = self._loading.get(key, 0) + 1
+
+        rows = loader()
+        cached = [to_cached(row) for row in reversed(rows)]
+        if not self.enabled:
+            return cached[::-1]
+
+        with self._lock:
+            dirty = key in self._dirty
+            remaining = self._loading.get(key, 1) - 1
+            if remaining:
+                self._loading[key] = remaining
+            else:
+                self._loading.pop(key, None)
+                self._dirty.discard(key)
+            # a write raced the load; the rows may already be stale, so don't cache them
+            if not dirty and key not in self._windows:
+                self._install(key, _Window(cached))
+        return cached[::-1]
+
+    def append(self, key: tuple, entry: Dict) -> None:
+        """Write-through hook for a newly inserted row."""
+        if not self.enabled:
+            return
+        with self._lock:
+            if key in self._loading:
+                self._dirty.add(key)
+            window = self._windows.get(key)
+            if window is None:
+                return
+            window.entries.append(to_cached(entry))
+            window.size += _entry_size(entry)
+            self._bytes += _entry_size(entry)
+            while len(window.entries) > WINDOW_ROWS:
+                old, _ = window.entries.pop(0)
+                window.size -= _entry_size(old)
+                self._bytes -= _entry_size(old)
+            self._windows.move_to_end(key)
+            self._evict()
+
+    def invalidate(self, key: tuple) -> None:
+        with self._lock:
+            if key in self._loading:
+                self._dirty.add(key)
+            window = self._windows.pop(key, None)
+            if window is not None:
+                self._bytes -= window.size
+
+    def clear(self) -> None:
+        with self._lock:
+            self._windows.clear()
+            self._dirty.update(self._loading)
+            self._bytes = 0
+
+    def _install(self, key: tuple, window: _Window) -> None:
+        self._windows[key] = window
+        self._bytes += window.size
+        self._evict()
+
+    def _evict(self) -> None:
+        while self._bytes > self.max_bytes and self._windows:
+            _, window = self._windows.popitem(last=False)
+            self._bytes -= window.size
+
+
+cache = HistoryCache()
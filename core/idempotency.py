@@ -0,0 +1,188 @@
+"""Idempotency-Key handling for endpoints that write memory or call upstream.
+
+A client that retries with the same ``Idempotency-Key`` header gets the
+stored result of the first attempt instead of a second prompt row and a
+second upstream call.  Keys are scoped per user and endpoint and live in the
+``idempotency_keys`` table for IDEMPOTENCY_TTL seconds (default 86400):
+
+- a completed key replays its stored JSON body with ``Idempotent-Replayed: true``
+- a retry that arrives while the first attempt is still running in this
+  process waits for it and shares its result; one running in another worker
+  gets 409 with a Retry-After
+- reusing a key for a different request body is a 422
+- a failed attempt releases its key, so the client can simply retry
+
+A pending claim expires after IDEMPOTENCY_PENDING_TTL seconds (default 300)
+in case its worker died mid-request.
+"""
+import asyncio
+import hashlib
+import json
+import os
+import threading
+import time
+from concurrent.futures import Future
+from typing import Awaitable, Callable, Dict, Optional, Tuple
+
+from fastapi import HTTPException
+from fastapi.concurrency import run_in_threadpool
+from fastapi.responses import JSONResponse
+
+from core import database
+from core import writer
+
+MAX_KEY_LENGTH = 255
+_PRUNE_EVERY = 256
+
+_inflight: Dict[tuple, Tuple[str, Future]] = {}
+_lock = threading.Lock()
+_claims = 0
+
+
+class _Abandoned(Exception):
+    """The attempt holding the key was cancelled before it finished."""
+
+
+def _env_float(name: str, default: float) -> float:
+    try:
+        return float(os.getenv(name, default))
+    except (TypeError, ValueError):
+        return default
+
+
+def fingerprint(*parts) -> str:
+    """Hash of the request fields a replay must match."""
+    canonical = json.dumps(parts, sort_keys=True, separators=(",", ":"), default=str)
+    return hashlib.sha256(canonical.encode()).hexdigest()
+
+
+def _mismatch() -> HTTPException:
+    return HTTPException(status_code=422, detail="Idempotency-Key was already used with a different request")
+
+
+def _in_progress() -> HTTPException:
+    return HTTPException(
+        status_code=409,
+        detail="A request with this Idempotency-Key is still in progress",
+        headers={"Retry-After": "1"},
+    )
+
+
+def _replay(body: str) -> JSONResponse:
+    return JSONResponse(content=json.loads(body), headers={"Idempotent-Replayed": "true"})
+
+
+def _claim(path: str, uid, endpoint: str, key: str, fp: str) -> Optional[tuple]:
+    """Take the key for this attempt, or return the live (fingerprint, body) row."""
+    global _claims
+    now = time.time()
+    with _lock:
+        _claims += 1
+        prune = _claims % _PRUNE_EVERY == 0
+    conn = database.get_db(path)
+    try:
+        c = conn.cursor()
+        database.begin_immediate(c)
+        row = c.execute(
+            "SELECT fingerprint, body, expires_at FROM idempotency_keys WHERE user_id = ? AND endpoint = ? AND key = ?",
+            (uid, endpoint, key),
+        ).fetchone()
+        if row is not None and row["expires_at"] > now:
+            conn.commit()
+            return row["fingerprint"], row["body"]
+        c.execute(
+            "INSERT OR REPLACE INTO idempotency_keys (user_id, endpoint, key, fingerprint, body, expires_at) "
+            "VALUES (?, ?, ?, ?, NULL, ?)",
+            (uid, endpoint, key, fp, now + _env_float("IDEMPOTENCY_PENDING_TTL", 300)),
+        )
+        if prune:
+            c.execute("DELETE FROM idempotency_keys WHERE expires_at <= ?", (now,))
+        conn.commit()
+        return None
+    finally:
+        conn.close()
+
+
+def _finish(local: tuple, op) -> None:
+    """Commit ``op`` and only then stop answering retries from memory."""
+    path = local[0]
+
+    def forget(fut) -> None:
+        if fut.exception() is not None:
+            print(f"warning: failed to update idempotency key: {fut.exception()}")
+        with _lock:
+            _inflight.pop(local, None)
+
+    writer.memory_writer.submit(path, op).add_done_callback(forget)
+
+
+async def run(endpoint: str, key: Optional[str], current_user: dict, fp: str, fn: Callable[[], Awaitable]):
+    """Run ``fn()`` at most once per (user, endpoint, key); replay it otherwise.
+
+    ``fn`` must return something JSON serializable.
+    """
+    if not key:
+        return await fn()
+    if len(key) > MAX_KEY_LENGTH:
+        raise HTTPException(status_code=400, detail=f"Idempotency-Key must be at most {MAX_KEY_LENGTH} characters")
+
+    uid = current_user["id"]
+    local = (database.DB_PATH, uid, endpoint, key)
+    with _lock:
+        entry = _inflight.get(local)
+        if entry is None:
+            shared: Future = Future()
+            _inflight[local] = (fp, shared)
+    if entry is not None:
+        # a retry of an attempt still running here: wait for it
+        if entry[0] != fp:
+            raise _mismatch()
+        try:
+            return _replay(await asyncio.shield(asyncio.wrap_future(entry[1])))
+        except _Abandoned:
+            raise _in_progress()
+
+    try:
+        existing = await run_in_threadpool(_claim, local[0], uid, endpoint, key, fp)
+    except BaseException as exc:
+        with _lock:
+            _inflight.pop(local, None)
+        shared.set_exception(_Abandoned() if isinstance(exc, asyncio.CancelledError) else exc)
+        raise
+    if existing is not None:
+        with _lock:
+            _inflight.pop(local, None)
+        stored_fp, body = existing
+        error = _mismatch() if stored_fp != fp else (_in_progress() if body is None else None)
+        if error is not None:
+            shared.set_exception(error)
+            raise error
+        shared.set_result(body)
+        return _replay(body)
+
+    try:
+        result = await fn()
+        body = json.dumps(result, separators=(",", ":"), ensure_ascii=False, default=str)
+    except BaseException as exc:
+        shared.set_exception(_Abandoned() if isinstance(exc, asyncio.CancelledError) else exc)
+
+        def release(c) -> None:
+            c.execute(
+                "DELETE FROM idempotency_keys WHERE user_id = ? AND endpoint = ? AND key = ? AND body IS NULL",
+                (uid, endpoint, key),
+            )
+
+        _finish(local, release)
+        raise
+
+    expires_at = time.time() + _env_float("IDEMPOTENCY_TTL", 86400)
+    shared.set_result(body)
+
+    def complete(c) -> None:
+        c.execute(
+            "UPDATE idempotency_keys SET body = ?, expires_at = ? WHERE user_id = ? AND endpoint = ? AND key = ?",
+            (body, expires_at, uid, endpoint, key),
+        )
+
+    _finish(local, complete)
+    return result
@@ -2,6 +2,7 @@ from fastapi import APIRouter, Request
 import os
 import json
 from datetime import datetime, timezone
+from core import writer
 
 router = APIRouter()
 
@@ -12,9 +13,9 @@ os.makedirs(LOG_DIR, exist_ok=True)
 async def log_event(req: Request):
     data = await req.json()
     log_path = os.path.join(LOG_DIR, f"{datetime.now(timezone.utc).date()}.log.json")
-    with open(log_path, "a") as f:
-        f.write(json.dumps({
-            "timestamp": datetime.now(timezone.utc).isoformat(),
-            **data
-        }) + "\n")
+    # appended by the write-behind log writer, batched with concurrent events
+    writer.log_writer.submit(log_path, json.dumps({
+        "timestamp": datetime.now(timezone.utc).isoformat(),
+        **data
+    }) + "\n")
     return {"status": "logged"}
@@ -1,8 +1,17 @@
 from fastapi import FastAPI
+from fastapi import Header, HTTPException
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import PlainTextResponse
 from core import api, memory, logger, mock
 from core import auth
+from core import passwords
+from core import summaries
+from core import upstream
+from core import writer
+from core import database
+from core import timing
 from core.database import init_db
+import hmac
 import os
 
 # Ensure DB schema is initialized before the app starts handling requests
@@ -21,6 +30,19 @@ def _check_jwt_secret():
         # raising here prevents the app from starting and produces a clear message
         raise RuntimeError("JWT_SECRET environment variable must be set for authentication")
 
+# release pooled upstream connections when the server stops
+@app.on_event("shutdown")
+async def _close_upstream_client():
+    await upstream.aclose()
+
+# drain queued memory/log writes before the process exits
+@app.on_event("shutdown")
+def _drain_writers():
+    summaries.folder.close()
+    writer.close_all()
+    database.close_all()
+    passwords.pool.shutdown()
+
 app.include_router(api.router, prefix="/api")
 app.include_router(memory.router, prefix="/memory")
 app.include_router(logger.router, prefix="/logs")
@@ -33,6 +55,10 @@ cors_origins_str = os.getenv("CORS_ALLOWED_ORIGINS", "http://localhost:5173")
 # Parse comma-separated list and strip whitespace
 cors_origins = [origin.strip() for origin in cors_origins_str.split(",")]
 
+# per-phase Server-Timing headers and the /metrics histograms (REQUEST_TIMING=0 to leave out)
+if timing.enabled():
+    app.add_middleware(timing.TimingMiddleware)
+
 app.add_middleware(
     CORSMiddleware,
     allow_origins=cors_origins,
@@ -45,6 +71,17 @@ app.add_middleware(
 def read_root():
     return {"msg": "BrainForce backend API running"}
 
+@app.get("/metrics", response_class=PlainTextResponse)
+def metrics(authorization: str = Header(None)):
+    """Request and phase latency histograms in the Prometheus text format.
+
+    When METRICS_TOKEN is set, scrapers must send it as a bearer token.
+    """
+    expected = os.getenv("METRICS_TOKEN")
+    if expected and not hmac.compare_digest(authorization or "", f"Bearer {expected}"):
+        raise HTTPException(status_code=401, detail="Invalid metrics token")
+    return PlainTextResponse(timing.render(), media_type="text/plain; version=0.0.4")
+
 if __name__ == "__main__":
     import uvicorn
     uvicorn.run("main:app", host="127.0.0.1", port=8000, reload=True)
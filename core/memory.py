@@ -1,12 +1,37 @@
-from fastapi import APIRouter, HTTPException, Depends
+from fastapi import APIRouter, HTTPException, Depends, Header
+from fastapi.concurrency import run_in_threadpool
+from fastapi.responses import StreamingResponse
 from pydantic import BaseModel
-from typing import Optional, List
+from typing import Iterator, Optional, List
+from concurrent.futures import Future
+import asyncio
+import json
+import os
 from datetime import datetime, timezone
+from core import database
+from core import history
+from core import idempotency
+from core import search as search_module
+from core import sessions
+from core import summaries
+from core import timing
+from core import tokenizer
+from core import writer
 from core.database import get_db
 from core.auth import get_current_user
 
 router = APIRouter()
 
+# bound parameters per IN (...) list, well under SQLite's variable limit
+_IN_CHUNK = 500
+
+
+def _env_int(name: str, default: int) -> int:
+    try:
+        return int(os.getenv(name, default))
+    except (TypeError, ValueError):
+        return default
+
 
 class MemorySave(BaseModel):
     session_id: str
@@ -17,62 +42,468 @@ class MemorySave(BaseModel):
 
 
 @router.post("/save/")
-def save_memory(data: MemorySave, current_user: dict = Depends(get_current_user)):
-    """Save a memory entry tied to a session_id and the authenticated user."""
+async def save_memory(
+    data: MemorySave,
+    idempotency_key: Optional[str] = Header(None, alias="Idempotency-Key"),
+    current_user: dict = Depends(get_current_user),
+):
+    """Save a memory entry tied to a session_id and the authenticated user.
+
+    A retry carrying the same Idempotency-Key does not insert the row again.
+    """
+    async def save() -> dict:
+        with timing.phase("save"):
+            await asyncio.wrap_future(store_memory(data, current_user))
+        return {"status": "saved"}
+
+    return await idempotency.run(
+        "memory.save", idempotency_key, current_user, idempotency.fingerprint(data.model_dump()), save
+    )
+
+
+class MemoryBatch(BaseModel):
+    items: List[MemorySave]
+
+
+@router.post("/save_batch/")
+async def save_memory_batch(
+    data: MemoryBatch,
+    idempotency_key: Optional[str] = Header(None, alias="Idempotency-Key"),
+    current_user: dict = Depends(get_current_user),
+):
+    """Save many memory entries in one transaction and return their ids.
+
+    Meant for importing transcripts: ownership is checked once per distinct
+    session and all rows are inserted together, or none are when any session
+    belongs to someone else.  At most MEMORY_BATCH_MAX_ITEMS (default 10000)
+    items per call.
+    """
+    limit = _env_int("MEMORY_BATCH_MAX_ITEMS", 10000)
+    if len(data.items) > limit:
+        raise HTTPException(status_code=413, detail=f"At most {limit} items per batch")
+
+    async def save() -> dict:
+        with timing.phase("save"):
+            # token counting for thousands of rows stays off the event loop
+            saved = await run_in_threadpool(store_memories, data.items, current_user)
+            stored = await asyncio.wrap_future(saved)
+        return {"status": "saved", "ids": [entry["id"] for entry in stored]}
+
+    return await idempotency.run(
+        "memory.save_batch", idempotency_key, current_user, idempotency.fingerprint(data.model_dump()), save
+    )
+
+
+def store_memory(data: MemorySave, current_user: dict, model: Optional[str] = None) -> Future:
+    """Queue a memory insert on the write-behind writer.
+
+    The ownership check and insert run together in the writer's transaction.
+    The returned future resolves to the stored row once it is committed (and
+    the history cache updated); wait on it when the row must be durable.
+    ``token_count`` is counted with ``model``'s tokenizer, the one the
+    session's history will be trimmed for.
+    """
     if not data.session_id:
         raise HTTPException(status_code=400, detail="session_id is required")
 
     uid = current_user["id"]
+    # a session known to belong to someone else is rejected before queuing
+    sessions.check_owner_cached(data.session_id, uid)
+    timestamp = datetime.now(timezone.utc).isoformat()
+    token_count = tokenizer.count_tokens(data.message or "", model)
+
+    def insert(c) -> dict:
+        # session_id must not be reused by another user
+        sessions.check_owner(c, data.session_id, uid)
+        c.execute(
+            "INSERT INTO memory (session_id, user_id, role, message, timestamp, token_count) VALUES (?, ?, ?, ?, ?, ?)",
+            (data.session_id, uid, data.role or "", data.message, timestamp, token_count)
+        )
+        sessions.record_messages(c, data.session_id, uid, timestamp, 1, token_count)
+        return {
+            "id": c.lastrowid,
+            "session_id": data.session_id,
+            "user_id": uid,
+            "role": data.role or "",
+            "message": data.message,
+            "timestamp": timestamp,
+            "token_count": token_count,
+        }
+
+    key = _window_key(data.session_id, uid)
+    path = database.DB_PATH
+
+    def after_commit(entry: dict) -> None:
+        sessions.owners.put(data.session_id, uid, path)
+        history.cache.append(key, entry)
+
+    return writer.memory_writer.submit(path, insert, after_commit=after_commit)
+
+
+def store_memories(items: List[MemorySave], current_user: dict,
+                   models: Optional[List[Optional[str]]] = None) -> Future:
+    """Queue many memory inserts as one write-behind op (one transaction).
+
+    Ownership is checked once per distinct session; if any session belongs
+    to someone else nothing is written.  Rows go in with one executemany; the
+    future resolves to the stored rows, with their ids, in order.  ``models``
+    gives each item's model for its token count (default family otherwise).
+    """
+    if any(not item.session_id for item in items):
+        raise HTTPException(status_code=400, detail="session_id is required")
+    uid = current_user["id"]
+    for session_id in {item.session_id for item in items}:
+        sessions.check_owner_cached(session_id, uid)
+    timestamp = datetime.now(timezone.utc).isoformat()
+    models = models or [None] * len(items)
+    counts = [tokenizer.count_tokens(item.message or "", model) for item, model in zip(items, models)]
+    rows = [
+        (item.session_id, uid, item.role or "", item.message, timestamp, tokens)
+        for item, tokens in zip(items, counts)
+    ]
+
+    def insert(c) -> List[dict]:
+        totals: dict = {}
+        for row in rows:
+            count, tokens = totals.get(row[0], (0, 0))
+            totals[row[0]] = (count + 1, tokens + row[5])
+        for session_id in totals:
+            sessions.check_owner(c, session_id, uid)
+        if not rows:
+            return []
+        c.executemany(
+            "INSERT INTO memory (session_id, user_id, role, message, timestamp, token_count) VALUES (?, ?, ?, ?, ?, ?)",
+            rows,
+        )
+        # the writer holds the write lock, so one statement's ids are contiguous
+        first = c.execute("SELECT last_insert_rowid()").fetchone()[0] - len(rows) + 1
+        stored = [
+            dict(zip(("session_id", "user_id", "role", "message", "timestamp", "token_count"), row), id=first + i)
+            for i, row in enumerate(rows)
+        ]
+        for session_id, (count, tokens) in totals.items():
+            sessions.record_messages(c, session_id, uid, timestamp, count, tokens)
+        return stored
+
+    path = database.DB_PATH
+
+    def after_commit(stored: List[dict]) -> None:
+        for entry in stored:
+            sessions.owners.put(entry["session_id"], uid, path)
+            history.cache.append(_window_key(entry["session_id"], uid), entry)
+
+    return writer.memory_writer.submit(path, insert, after_commit=after_commit)
+
+
+def session_owners(session_ids: List[str]) -> dict:
+    """Owner user_id of each existing session among ``session_ids``."""
+    writer.memory_writer.flush()
+    owners: dict = {}
     conn = get_db()
     try:
-        c = conn.cursor()
-        # session_id must not be reused by another user
-        c.execute("SELECT user_id FROM memory WHERE session_id = ? LIMIT 1", (data.session_id,))
-        row = c.fetchone()
-        if row and row["user_id"] != uid:
-            raise HTTPException(status_code=400, detail="session_id already used by another user")
-
-        # ensure schema is still present (init_db handles this on startup too)
-        c.execute("""
-            CREATE TABLE IF NOT EXISTS memory (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                session_id TEXT,
-                user_id INTEGER,
-                role TEXT,
-                message TEXT,
-                timestamp TEXT,
-                FOREIGN KEY(user_id) REFERENCES users(id)
+        for start in range(0, len(session_ids), _IN_CHUNK):
+            chunk = session_ids[start:start + _IN_CHUNK]
+            marks = ",".join("?" * len(chunk))
+            for row in conn.execute(f"SELECT session_id, user_id FROM sessions WHERE session_id IN ({marks})", chunk):
+                owners[row["session_id"]] = row["user_id"]
+    finally:
+        conn.close()
+    return owners
+
+
+def load_session_windows(session_ids: List[str], current_user: dict) -> dict:
+    """Newest-first (entry, tokens) windows for many sessions in one query."""
+    writer.memory_writer.flush()
+    windows: dict = {session_id: [] for session_id in session_ids}
+    conn = get_db()
+    try:
+        for start in range(0, len(session_ids), _IN_CHUNK):
+            chunk = session_ids[start:start + _IN_CHUNK]
+            marks = ",".join("?" * len(chunk))
+            c = conn.execute(
+                f"""
+                SELECT * FROM (
+                    SELECT m.*, ROW_NUMBER() OVER (PARTITION BY session_id ORDER BY id DESC) AS rn
+                    FROM memory m WHERE user_id = ? AND session_id IN ({marks})
+                ) WHERE rn <= ? ORDER BY session_id, id DESC
+                """,
+                [current_user["id"], *chunk, history.WINDOW_ROWS],
             )
-        """)
+            for row in c:
+                entry = dict(row)
+                del entry["rn"]
+                windows[entry["session_id"]].append(history.to_cached(entry))
+    finally:
+        conn.close()
+    return windows
+
+
+def _window_key(session_id: str, uid) -> tuple:
+    # DB_PATH is part of the key so separate databases never share cached rows
+    return (database.DB_PATH, uid, session_id)
+
+
+def _load_session_rows(session_id: str, uid) -> List[dict]:
+    conn = get_db()
+    try:
+        c = conn.cursor()
         c.execute(
-            "INSERT INTO memory (session_id, user_id, role, message, timestamp) VALUES (?, ?, ?, ?, ?)",
-            (data.session_id, uid, data.role or "", data.message, datetime.now(timezone.utc).isoformat())
+            "SELECT * FROM memory WHERE session_id = ? AND user_id = ? ORDER BY id DESC LIMIT 200",
+            (session_id, uid)
         )
-        conn.commit()
-        return {"status": "saved"}
+        return [dict(row) for row in c.fetchall()]
     finally:
         conn.close()
 
 
-@router.get("/all/")
-def get_all_memory(session_id: Optional[str] = None, current_user: dict = Depends(get_current_user)) -> List[dict]:
-    """Return recent memory entries for the authenticated user.
+def get_session_window(session_id: str, current_user: dict) -> List[history.CachedEntry]:
+    """Return the newest-first (entry, tokens) window for a session, cached."""
+    # queued writes land in the cache when committed; wait for them first
+    writer.memory_writer.flush()
+    uid = current_user["id"]
+    return history.cache.get_or_load(
+        _window_key(session_id, uid), lambda: _load_session_rows(session_id, uid)
+    )
+
+
+# Turn-aware budget trimming done inside SQLite.  Mirrors history.trim_to_budget:
+# an assistant row pairs with the row just before it when that row is a user
+# message; the newest turn with user text is always kept (its reply only counts
+# if it fits); other turns are kept whole while the running sum stays within the
+# budget, and nothing older than the first turn that does not fit is returned.
+_TRIM_SQL = """
+WITH w AS (
+    SELECT id, role, message, token_count FROM memory
+    WHERE session_id = ? AND user_id = ?
+    ORDER BY id DESC LIMIT ?
+),
+r AS (
+    SELECT *,
+        LOWER(COALESCE(role, '')) AS lrole,
+        LAG(LOWER(COALESCE(role, ''))) OVER (ORDER BY id) AS prev_role,
+        LAG(id) OVER (ORDER BY id) AS prev_id
+    FROM w
+),
+m AS (
+    SELECT *,
+        CASE WHEN lrole = 'assistant' AND prev_role = 'user' THEN prev_id ELSE id END AS turn_id
+    FROM r
+),
+t AS (
+    SELECT turn_id,
+        COALESCE(MAX(CASE WHEN lrole != 'assistant' THEN token_count END), 1) AS t_user,
+        COALESCE(MAX(CASE WHEN lrole = 'assistant' AND COALESCE(message, '') != '' THEN token_count END), 0) AS t_assist,
+        MAX(CASE WHEN lrole != 'assistant' AND COALESCE(message, '') != '' THEN 1 ELSE 0 END) AS has_user_text
+    FROM m GROUP BY turn_id
+),
+a AS (
+    SELECT *,
+        (SELECT MAX(turn_id) FROM t WHERE has_user_text = 1) AS anchor_id,
+        COALESCE(SUM(t_user + t_assist) OVER (
+            ORDER BY turn_id DESC ROWS BETWEEN UNBOUNDED PRECEDING AND 1 PRECEDING), 0) AS before
+    FROM t
+),
+c AS (
+    SELECT turn_id, anchor_id,
+        SUM(CASE
+            WHEN turn_id = anchor_id AND before + t_user + t_assist > ? THEN t_user
+            ELSE t_user + t_assist
+        END) OVER (ORDER BY turn_id DESC ROWS UNBOUNDED PRECEDING) AS running
+    FROM a
+),
+keep AS (
+    SELECT turn_id FROM c
+    WHERE turn_id > COALESCE(
+        (SELECT MAX(turn_id) FROM c WHERE running > ? AND turn_id IS NOT anchor_id), -1)
+)
+SELECT role, message FROM m WHERE turn_id IN (SELECT turn_id FROM keep) ORDER BY id
+"""
+
+
+def get_trimmed_messages(session_id: str, current_user: dict, budget: int) -> List[dict]:
+    """Return the session's chat messages (oldest-first) that fit in ``budget``.
+
+    Served from the history cache when it is enabled; otherwise the trimming
+    runs in SQLite and only the rows that fit are read.
+    """
+    if history.cache.enabled:
+        with timing.phase("history"):
+            window = get_session_window(session_id, current_user)
+        with timing.phase("trim"):
+            return history.trim_to_budget(window, budget)
+    with timing.phase("history"):
+        writer.memory_writer.flush()
+        conn = get_db()
+        try:
+            c = conn.cursor()
+            c.execute(_TRIM_SQL, (session_id, current_user["id"], history.WINDOW_ROWS, budget, budget))
+            return [{"role": row["role"], "content": row["message"]} for row in c.fetchall()]
+        finally:
+            conn.close()
+
 
-    If session_id is provided, filter to that session; otherwise return all for the user.
+def get_context_messages(session_id: str, current_user: dict, budget: int) -> List[dict]:
+    """Like :func:`get_trimmed_messages`, plus the session summary when enabled.
+
+    Turns trimmed out of the budget are folded into the summary in the
+    background (see core/summaries.py).
     """
+    if not summaries.enabled():
+        return get_trimmed_messages(session_id, current_user, budget)
     uid = current_user["id"]
+    with timing.phase("history"):
+        if history.cache.enabled:
+            window = get_session_window(session_id, current_user)
+        else:
+            writer.memory_writer.flush()
+            window = [history.to_cached(row) for row in _load_session_rows(session_id, uid)]
+    with timing.phase("summary"):
+        summary = summaries.load(session_id, uid)
+    with timing.phase("trim"):
+        return summaries.context_messages(window, summary, budget, session_id, uid)
+
+
+def _page_limit(limit: int) -> int:
+    return max(1, min(limit, max(1, _env_int("MEMORY_PAGE_MAX", 1000))))
+
+
+def _memory_page(uid, session_id: Optional[str], before_id: Optional[int], after_id: Optional[int],
+                 limit: int) -> List[dict]:
+    """One keyset page, newest first; walks idx_memory_user / idx_memory_session_user."""
+    where = ["user_id = ?"]
+    params: list = [uid]
+    if session_id:
+        where.append("session_id = ?")
+        params.append(session_id)
+    if before_id is not None:
+        where.append("id < ?")
+        params.append(before_id)
+    if after_id is not None:
+        where.append("id > ?")
+        params.append(after_id)
+    # paging forward reads the rows right after after_id, not the newest ones
+    order = "ASC" if after_id is not None and before_id is None else "DESC"
+    params.append(limit)
+    conn = get_db()
+    try:
+        rows = conn.execute(
+            f"SELECT * FROM memory WHERE {' AND '.join(where)} ORDER BY id {order} LIMIT ?", params
+        ).fetchall()
+    finally:
+        conn.close()
+    page = [dict(row) for row in rows]
+    if order == "ASC":
+        page.reverse()
+    return page
+
+
+@router.get("/all/")
+def get_all_memory(
+    session_id: Optional[str] = None,
+    before_id: Optional[int] = None,
+    after_id: Optional[int] = None,
+    limit: int = 200,
+    current_user: dict = Depends(get_current_user),
+) -> List[dict]:
+    """Return memory entries for the authenticated user, newest first.
+
+    If session_id is provided, filter to that session; the newest page is
+    served from the history cache.  Older pages are fetched by keyset: pass
+    the smallest id seen as ``before_id`` (or the largest as ``after_id`` to
+    page towards newer rows).  ``limit`` is capped at MEMORY_PAGE_MAX
+    (default 1000).
+    """
+    limit = _page_limit(limit)
+    with timing.phase("history"):
+        if session_id and before_id is None and after_id is None and limit <= history.WINDOW_ROWS:
+            return [dict(entry) for entry, _ in get_session_window(session_id, current_user)[:limit]]
+        writer.memory_writer.flush()
+        return _memory_page(current_user["id"], session_id, before_id, after_id, limit)
+
+
+def _export_lines(path: str, uid, session_id: Optional[str], after_id: int, upto: int, chunk: int) -> Iterator[str]:
+    # each chunk is its own short read, so a long export never pins a WAL snapshot
+    where = "user_id = ? AND id > ? AND id <= ?" + (" AND session_id = ?" if session_id else "")
+    last = after_id
+    while True:
+        params = [uid, last, upto] + ([session_id] if session_id else []) + [chunk]
+        conn = database.get_db(path)
+        try:
+            rows = conn.execute(f"SELECT * FROM memory WHERE {where} ORDER BY id LIMIT ?", params).fetchall()
+        finally:
+            conn.close()
+        if not rows:
+            return
+        yield "".join(json.dumps(dict(row), ensure_ascii=False) + "\n" for row in rows)
+        last = rows[-1]["id"]
+        if len(rows) < chunk:
+            return
+
+
+@router.get("/export/")
+def export_memory(
+    session_id: Optional[str] = None,
+    after_id: int = 0,
+    current_user: dict = Depends(get_current_user),
+) -> StreamingResponse:
+    """Stream every memory entry of the user as NDJSON, oldest first.
+
+    Rows are read in keyset chunks of MEMORY_EXPORT_CHUNK rows (default 1000)
+    and written straight to the response, so memory use does not grow with
+    the history.  The export stops at the newest row that existed when it
+    started; resume an interrupted one with ``after_id`` = last id received.
+    """
+    writer.memory_writer.flush()
+    path = database.DB_PATH
+    conn = get_db()
+    try:
+        upto = conn.execute("SELECT COALESCE(MAX(id), 0) FROM memory").fetchone()[0]
+    finally:
+        conn.close()
+    chunk = max(1, _env_int("MEMORY_EXPORT_CHUNK", 1000))
+    return StreamingResponse(
+        _export_lines(path, current_user["id"], session_id, after_id, upto, chunk),
+        media_type="application/x-ndjson",
+        headers={"Content-Disposition": 'attachment; filename="memory.ndjson"'},
+    )
+
+
+@router.get("/search/")
+def search_memory(
+    q: str,
+    session_id: Optional[str] = None,
+    since: Optional[str] = None,
+    until: Optional[str] = None,
+    cursor: Optional[str] = None,
+    limit: int = 20,
+    current_user: dict = Depends(get_current_user),
+) -> dict:
+    """Full-text search of the user's messages, best match first.
+
+    Results carry a highlighted ``snippet``; pass ``next_cursor`` back as
+    ``cursor`` for the next page.  ``since``/``until`` are ISO timestamps.
+    """
+    with timing.phase("search"):
+        return search_module.search(
+            current_user["id"], q, session_id=session_id, since=since, until=until,
+            cursor=cursor, limit=max(1, min(limit, 100)),
+        )
+
+
+@router.get("/sessions/")
+def list_sessions(limit: int = 50, current_user: dict = Depends(get_current_user)) -> List[dict]:
+    """List the authenticated user's sessions, most recently active first."""
+    limit = max(1, min(limit, 500))
+    writer.memory_writer.flush()
     conn = get_db()
     try:
         c = conn.cursor()
-        if session_id:
-            c.execute(
-                "SELECT * FROM memory WHERE session_id = ? AND user_id = ? ORDER BY id DESC LIMIT 200",
-                (session_id, uid)
-            )
-        else:
-            c.execute("SELECT * FROM memory WHERE user_id = ? ORDER BY id DESC LIMIT 200", (uid,))
-        rows = c.fetchall()
-        return [dict(row) for row in rows]
+        c.execute(
+            "SELECT session_id, created_at, last_active, message_count, token_total FROM sessions"
+            " WHERE user_id = ? ORDER BY last_active DESC LIMIT ?",
+            (current_user["id"], limit)
+        )
+        return [dict(row) for row in c.fetchall()]
     finally:
         conn.close()
 
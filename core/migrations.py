@@ -0,0 +1,298 @@
+"""Versioned schema migrations for the BrainForce database.
+
+The schema version lives in ``PRAGMA user_version``.  ``run()`` applies every
+migration newer than the stored version, in order.  A migration's DDL runs
+in one IMMEDIATE transaction (so concurrent workers starting together do not
+apply it twice) and must be idempotent; its optional backfill then runs in
+chunks, each committed on its own so a large table is never locked for long.
+The version is bumped only after the backfill finishes, so an interrupted
+upgrade simply resumes on the next start.
+"""
+import sqlite3
+from typing import Callable, List, NamedTuple, Optional
+
+# SQL twin of core.history.estimate_tokens, used to backfill token_count
+TOKEN_ESTIMATE_SQL = "MAX(1, (LENGTH(COALESCE(message, '')) + 3) / 4)"
+BACKFILL_CHUNK_ROWS = 5000
+
+
+class Migration(NamedTuple):
+    version: int
+    description: str
+    apply: Callable
+    # returns the number of rows touched; called until it touches fewer than a chunk
+    backfill: Optional[Callable] = None
+
+
+def _columns(c, table: str) -> set:
+    return {row[1] for row in c.execute(f"PRAGMA table_info({table})")}
+
+
+def _base_schema(c) -> None:
+    # user table used for authentication
+    c.execute("""
+        CREATE TABLE IF NOT EXISTS users (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            username TEXT UNIQUE,
+            password_hash TEXT,
+            role TEXT,
+            created_at TEXT
+        )
+    """)
+    # memory table now tracks user_id so that sessions are scoped
+    c.execute("""
+        CREATE TABLE IF NOT EXISTS memory (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            session_id TEXT,
+            user_id INTEGER,
+            role TEXT,
+            message TEXT,
+            timestamp TEXT,
+            FOREIGN KEY(user_id) REFERENCES users(id)
+        )
+    """)
+    # databases created before sessions were user scoped lack the column
+    if "user_id" not in _columns(c, "memory"):
+        c.execute("ALTER TABLE memory ADD COLUMN user_id INTEGER REFERENCES users(id)")
+    c.execute("CREATE INDEX IF NOT EXISTS idx_memory_session ON memory(session_id)")
+
+
+def _add_token_count(c) -> None:
+    if "token_count" not in _columns(c, "memory"):
+        c.execute("ALTER TABLE memory ADD COLUMN token_count INTEGER")
+
+
+def _backfill_token_count(c) -> int:
+    c.execute(
+        f"UPDATE memory SET token_count = {TOKEN_ESTIMATE_SQL} "
+        "WHERE id IN (SELECT id FROM memory WHERE token_count IS NULL LIMIT ?)",
+        (BACKFILL_CHUNK_ROWS,),
+    )
+    return c.rowcount
+
+
+def _history_indexes(c) -> None:
+    # session and user history reads (ORDER BY id DESC LIMIT n) become index range scans
+    c.execute("CREATE INDEX IF NOT EXISTS idx_memory_session_user ON memory(session_id, user_id, id DESC)")
+    c.execute("CREATE INDEX IF NOT EXISTS idx_memory_user ON memory(user_id, id DESC)")
+    # the session-only index is a prefix of idx_memory_session_user
+    c.execute("DROP INDEX IF EXISTS idx_memory_session")
+
+
+def _sessions_table(c) -> None:
+    # one row per session: primary-key ownership checks and cheap per-user listings
+    c.execute("""
+        CREATE TABLE IF NOT EXISTS sessions (
+            session_id TEXT PRIMARY KEY,
+            user_id INTEGER,
+            created_at TEXT,
+            last_active TEXT,
+            message_count INTEGER NOT NULL DEFAULT 0,
+            token_total INTEGER NOT NULL DEFAULT 0,
+            FOREIGN KEY(user_id) REFERENCES users(id)
+        )
+    """)
+    c.execute("CREATE INDEX IF NOT EXISTS idx_sessions_user ON sessions(user_id, last_active DESC)")
+
+
+def _backfill_sessions(c) -> int:
+    # a chunk of sessions not yet summarized; the owner is whoever wrote first
+    c.execute(
+        """
+        INSERT INTO sessions (session_id, user_id, created_at, last_active, message_count, token_total)
+        SELECT m.session_id,
+               (SELECT user_id FROM memory f WHERE f.session_id = m.session_id ORDER BY f.id LIMIT 1),
+               MIN(m.timestamp), MAX(m.timestamp), COUNT(*), COALESCE(SUM(m.token_count), 0)
+        FROM memory m
+        WHERE m.session_id IN (
+            SELECT DISTINCT session_id FROM memory
+            WHERE session_id IS NOT NULL
+              AND session_id NOT IN (SELECT session_id FROM sessions)
+            LIMIT ?
+        )
+        GROUP BY m.session_id
+        """,
+        (BACKFILL_CHUNK_ROWS,),
+    )
+    return c.rowcount
+
+
+def _rate_limits_table(c) -> None:
+    # fixed-size counter slots shared by all workers, see core/ratelimit.py
+    c.execute("""
+        CREATE TABLE IF NOT EXISTS rate_limits (
+            scope TEXT NOT NULL,
+            slot INTEGER NOT NULL,
+            key TEXT,
+            window_start INTEGER NOT NULL,
+            curr INTEGER NOT NULL DEFAULT 0,
+            prev INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (scope, slot)
+        ) WITHOUT ROWID
+    """)
+
+
+def _rate_limit_recency(c) -> None:
+    # last hit per slot, so a full slot set evicts its least recently used key
+    if "touched" not in _columns(c, "rate_limits"):
+        c.execute("ALTER TABLE rate_limits ADD COLUMN touched REAL NOT NULL DEFAULT 0")
+
+
+def _response_cache_table(c) -> None:
+    # on-disk tier of the completion cache, see core/completions.py
+    c.execute("""
+        CREATE TABLE IF NOT EXISTS response_cache (
+            key TEXT PRIMARY KEY,
+            body TEXT NOT NULL,
+            expires_at REAL NOT NULL
+        ) WITHOUT ROWID
+    """)
+    c.execute("CREATE INDEX IF NOT EXISTS idx_response_cache_expires ON response_cache(expires_at)")
+
+
+def _idempotency_table(c) -> None:
+    # stored results for Idempotency-Key retries, see core/idempotency.py
+    c.execute("""
+        CREATE TABLE IF NOT EXISTS idempotency_keys (
+            user_id INTEGER NOT NULL,
+            endpoint TEXT NOT NULL,
+            key TEXT NOT NULL,
+            fingerprint TEXT NOT NULL,
+            body TEXT,
+            expires_at REAL NOT NULL,
+            PRIMARY KEY (user_id, endpoint, key)
+        ) WITHOUT ROWID
+    """)
+    c.execute("CREATE INDEX IF NOT EXISTS idx_idempotency_expires ON idempotency_keys(expires_at)")
+
+
+def _session_summaries_table(c) -> None:
+    # running summary of turns trimmed out of the prompt, see core/summaries.py
+    c.execute("""
+        CREATE TABLE IF NOT EXISTS session_summaries (
+            session_id TEXT PRIMARY KEY,
+            user_id INTEGER,
+            summary TEXT NOT NULL,
+            covered_id INTEGER NOT NULL,
+            token_count INTEGER NOT NULL,
+            updated_at TEXT,
+            FOREIGN KEY(user_id) REFERENCES users(id)
+        )
+    """)
+
+
+def fts_available(c) -> bool:
+    return c.execute("SELECT 1 FROM sqlite_master WHERE name = 'memory_fts'").fetchone() is not None
+
+
+def create_memory_fts(c) -> None:
+    """External-content FTS5 index over memory.message, kept in sync by triggers.
+
+    ``user_id`` is indexed too so a search can be scoped to one user inside
+    the index; ranking ignores it (bm25 weight 0).
+    """
+    c.execute("""
+        CREATE VIRTUAL TABLE IF NOT EXISTS memory_fts USING fts5(
+            message, user_id,
+            content='memory', content_rowid='id',
+            tokenize='unicode61 remove_diacritics 2'
+        )
+    """)
+    c.execute("INSERT INTO memory_fts(memory_fts, rank) VALUES ('rank', 'bm25(1.0, 0.0)')")
+    c.execute("""
+        CREATE TRIGGER IF NOT EXISTS memory_fts_ai AFTER INSERT ON memory BEGIN
+            INSERT INTO memory_fts(rowid, message, user_id) VALUES (new.id, new.message, new.user_id);
+        END
+    """)
+    c.execute("""
+        CREATE TRIGGER IF NOT EXISTS memory_fts_ad AFTER DELETE ON memory BEGIN
+            INSERT INTO memory_fts(memory_fts, rowid, message, user_id) VALUES ('delete', old.id, old.message, old.user_id);
+        END
+    """)
+    c.execute("""
+        CREATE TRIGGER IF NOT EXISTS memory_fts_au AFTER UPDATE OF message, user_id ON memory BEGIN
+            INSERT INTO memory_fts(memory_fts, rowid, message, user_id) VALUES ('delete', old.id, old.message, old.user_id);
+            INSERT INTO memory_fts(rowid, message, user_id) VALUES (new.id, new.message, new.user_id);
+        END
+    """)
+
+
+def _memory_fts(c) -> None:
+    # full-text search over memory, see core/search.py
+    try:
+        create_memory_fts(c)
+    except sqlite3.OperationalError as exc:
+        if "fts5" not in str(exc):
+            raise
+        print(f"warning: SQLite has no FTS5, memory search is disabled: {exc}")
+        return
+    # rows up to here are indexed by the backfill, newer ones by the triggers
+    c.execute("CREATE TABLE IF NOT EXISTS memory_fts_backfill (upto INTEGER NOT NULL)")
+    if c.execute("SELECT 1 FROM memory_fts_backfill").fetchone() is None:
+        c.execute("INSERT INTO memory_fts_backfill (upto) SELECT COALESCE(MAX(id), 0) FROM memory")
+
+
+def _backfill_memory_fts(c) -> int:
+    if not fts_available(c) or c.execute(
+        "SELECT 1 FROM sqlite_master WHERE name = 'memory_fts_backfill'"
+    ).fetchone() is None:
+        return 0
+    upto = c.execute("SELECT upto FROM memory_fts_backfill").fetchone()[0]
+    # one docsize row per indexed document: resume after the last one below upto
+    done = c.execute("SELECT COALESCE(MAX(id), 0) FROM memory_fts_docsize WHERE id <= ?", (upto,)).fetchone()[0]
+    c.execute(
+        "INSERT INTO memory_fts(rowid, message, user_id) "
+        "SELECT id, message, user_id FROM memory WHERE id > ? AND id <= ? ORDER BY id LIMIT ?",
+        (done, upto, BACKFILL_CHUNK_ROWS),
+    )
+    return c.rowcount
+
+
+MIGRATIONS: List[Migration] = [
+    Migration(1, "users and memory tables", _base_schema),
+    Migration(2, "memory.token_count", _add_token_count, _backfill_token_count),
+    Migration(3, "history indexes", _history_indexes),
+    Migration(4, "sessions table", _sessions_table, _backfill_sessions),
+    Migration(5, "rate limit counters", _rate_limits_table),
+    Migration(6, "response cache", _response_cache_table),
+    Migration(7, "idempotency keys", _idempotency_table),
+    Migration(8, "session summaries", _session_summaries_table),
+    Migration(9, "memory full-text index", _memory_fts, _backfill_memory_fts),
+    Migration(10, "rate limit slot recency", _rate_limit_recency),
+]
+
+LATEST_VERSION = MIGRATIONS[-1].version
+
+
+def current_version(conn) -> int:
+    return conn.execute("PRAGMA user_version").fetchone()[0]
+
+
+def run(conn) -> int:
+    """Bring the database behind ``conn`` up to LATEST_VERSION; returns the version."""
+    c = conn.cursor()
+    for migration in MIGRATIONS:
+        if current_version(conn) >= migration.version:
+            continue
+        c.execute("BEGIN IMMEDIATE")
+        try:
+            # another worker may have finished this migration while we waited
+            if current_version(conn) >= migration.version:
+                conn.commit()
+                continue
+            migration.apply(c)
+            conn.commit()
+        except BaseException:
+            conn.rollback()
+            raise
+        if migration.backfill is not None:
+            while True:
+                touched = migration.backfill(c)
+                conn.commit()
+                if touched < BACKFILL_CHUNK_ROWS:
+                    break
+        c.execute(f"PRAGMA user_version = {migration.version}")
+        conn.commit()
+    if current_version(conn) > LATEST_VERSION:
+        print(f"warning: database schema version {current_version(conn)} is newer than this code ({LATEST_VERSION})")
+    return current_version(conn)
@@ -1,6 +1,236 @@
-from fastapi import APIRouter
+"""Mock endpoints and a local stand-in for the OpenAI chat completions API.
+
+``router`` is the small ``/mock`` router mounted by the main app.
+
+``upstream_router`` (served on its own by :func:`create_app`) is a fake
+OpenAI-compatible upstream, so the real proxy path (HTTP client, JSON
+parsing, timeouts, retries, breakers) can be load-tested offline.  Point the
+proxy at it with OPENAI_BASE_URL and leave MOCK_MODE unset:
+
+    python -m core.mock --port 8001
+    OPENAI_BASE_URL=http://127.0.0.1:8001/v1 OPENAI_API_KEY=fake uvicorn core.main:app
+
+It answers ``POST /v1/chat/completions`` with ``usage`` counts, streamed or
+not.  Behaviour comes from the environment, read per request:
+
+- MOCK_UPSTREAM_LATENCY: time to first byte, ``fixed:MS``, ``uniform:LO:HI``,
+  ``normal:MEAN:STDDEV``, ``lognormal:MEDIAN:SIGMA`` or ``exponential:MEAN``
+  in milliseconds (default ``fixed:0``)
+- MOCK_UPSTREAM_429_RATE: share of requests refused with 429 and
+  Retry-After MOCK_UPSTREAM_RETRY_AFTER seconds (default 1)
+- MOCK_UPSTREAM_ERROR_RATE: share of requests failing, after the latency,
+  with MOCK_UPSTREAM_ERROR_STATUS (default 503)
+- MOCK_UPSTREAM_CHUNK_MS: delay between streamed chunks (default 0)
+
+``POST /_control`` with a JSON object of the same names overrides them at
+runtime, e.g. to start a brownout halfway through a load test;
+``DELETE /_control`` drops the overrides.
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import time
+import uuid
+from typing import Callable, Dict, List
+
+from fastapi import APIRouter, Request
+from fastapi.responses import JSONResponse, StreamingResponse
+
+from core import tokenizer
+
 router = APIRouter()
 
 @router.get("/openai/")
 def mock_openai():
     return {"response": "Detta är mock-läge. Ingen riktig OpenAI-anslutning."}
+
+
+upstream_router = APIRouter()
+
+# runtime overrides set through /_control, consulted before the environment
+_overrides: Dict[str, str] = {}
+
+
+def _setting(name: str, default: str) -> str:
+    if name in _overrides:
+        return _overrides[name]
+    return os.getenv(name, default)
+
+
+def _setting_float(name: str, default: float) -> float:
+    try:
+        return float(_setting(name, str(default)))
+    except (TypeError, ValueError):
+        return default
+
+
+def latency_sampler(spec: str) -> Callable[[], float]:
+    """Parse a latency spec into a function returning seconds.
+
+    Raises ValueError for an unknown distribution or bad numbers.
+    """
+    kind, _, rest = (spec or "fixed:0").partition(":")
+    args = [float(part) for part in rest.split(":") if part]
+    draws = {
+        "fixed": (1, lambda a: a[0]),
+        "uniform": (2, lambda a: random.uniform(a[0], a[1])),
+        "normal": (2, lambda a: random.gauss(a[0], a[1])),
+        "lognormal": (2, lambda a: a[0] * random.lognormvariate(0.0, a[1])),
+        "exponential": (1, lambda a: random.expovariate(1.0 / a[0]) if a[0] > 0 else 0.0),
+    }
+    if kind not in draws:
+        raise ValueError(f"unknown latency distribution {kind!r}")
+    arity, draw = draws[kind]
+    if len(args) != arity:
+        raise ValueError(f"{kind} latency takes {arity} value(s), got {len(args)}")
+    return lambda: max(0.0, draw(args)) / 1000.0
+
+
+def _error(status: int, message: str, kind: str, headers: Dict[str, str] = None) -> JSONResponse:
+    # same envelope as the OpenAI API
+    return JSONResponse(
+        status_code=status,
+        content={"error": {"message": message, "type": kind, "param": None, "code": None}},
+        headers=headers,
+    )
+
+
+def reply_for(messages: List[Dict], max_tokens) -> str:
+    """Deterministic reply, the same text MOCK_MODE produces."""
+    prompt = ""
+    for message in reversed(messages):
+        if message.get("role") == "user":
+            prompt = str(message.get("content") or "")
+            break
+    words = f"MOCK_REPLY: reply to {prompt[:64]}".split(" ")
+    if isinstance(max_tokens, int) and max_tokens > 0:
+        words = words[:max_tokens]
+    return " ".join(words)
+
+
+def usage_for(messages: List[Dict], reply: str, model: str) -> Dict[str, int]:
+    # ~3 tokens of chat framing per message, as the real API counts them
+    prompt_tokens = sum(tokenizer.count_many((str(m.get("content") or "") for m in messages), model)) + 3 * len(messages)
+    completion_tokens = tokenizer.count_tokens(reply, model)
+    return {
+        "prompt_tokens": prompt_tokens,
+        "completion_tokens": completion_tokens,
+        "total_tokens": prompt_tokens + completion_tokens,
+    }
+
+
+async def _chunks(completion_id: str, created: int, model: str, reply: str, usage, delay: float):
+    def chunk(delta: Dict, finish_reason=None) -> str:
+        body = {
+            "id": completion_id,
+            "object": "chat.completion.chunk",
+            "created": created,
+            "model": model,
+            "choices": [{"index": 0, "delta": delta, "finish_reason": finish_reason}],
+        }
+        return f"data: {json.dumps(body, ensure_ascii=False)}\n\n"
+
+    yield chunk({"role": "assistant", "content": ""})
+    for i, word in enumerate(reply.split(" ")):
+        if delay > 0:
+            await asyncio.sleep(delay)
+        yield chunk({"content": word if i == 0 else " " + word})
+    yield chunk({}, "stop")
+    if usage is not None:
+        body = {"id": completion_id, "object": "chat.completion.chunk", "created": created, "model": model,
+                "choices": [], "usage": usage}
+        yield f"data: {json.dumps(body)}\n\n"
+    yield "data: [DONE]\n\n"
+
+
+@upstream_router.post("/v1/chat/completions")
+async def fake_chat_completions(request: Request):
+    """OpenAI-compatible chat completion with injected latency and failures."""
+    if not request.headers.get("authorization", "").startswith("Bearer "):
+        return _error(401, "You didn't provide an API key.", "invalid_request_error")
+    try:
+        body = await request.json()
+    except ValueError:
+        return _error(400, "We could not parse the JSON body of your request.", "invalid_request_error")
+    messages = body.get("messages") if isinstance(body, dict) else None
+    if not isinstance(messages, list) or not messages:
+        return _error(400, "'messages' must be a non-empty array.", "invalid_request_error")
+
+    if random.random() < _setting_float("MOCK_UPSTREAM_429_RATE", 0.0):
+        return _error(
+            429, "Rate limit reached.", "requests",
+            headers={"Retry-After": _setting("MOCK_UPSTREAM_RETRY_AFTER", "1")},
+        )
+    try:
+        delay = latency_sampler(_setting("MOCK_UPSTREAM_LATENCY", "fixed:0"))()
+    except ValueError as exc:
+        return _error(500, f"bad MOCK_UPSTREAM_LATENCY: {exc}", "server_error")
+    if delay > 0:
+        await asyncio.sleep(delay)
+    if random.random() < _setting_float("MOCK_UPSTREAM_ERROR_RATE", 0.0):
+        status = int(_setting_float("MOCK_UPSTREAM_ERROR_STATUS", 503))
+        return _error(status, "The server is overloaded or not ready yet.", "server_error")
+
+    model = body.get("model") or "gpt-3.5-turbo"
+    reply = reply_for(messages, body.get("max_tokens"))
+    usage = usage_for(messages, reply, model)
+    completion_id = f"chatcmpl-{uuid.uuid4().hex[:24]}"
+    created = int(time.time())
+    if body.get("stream"):
+        include_usage = bool((body.get("stream_options") or {}).get("include_usage"))
+        return StreamingResponse(
+            _chunks(completion_id, created, model, reply, usage if include_usage else None,
+                    _setting_float("MOCK_UPSTREAM_CHUNK_MS", 0.0) / 1000.0),
+            media_type="text/event-stream",
+        )
+    return {
+        "id": completion_id,
+        "object": "chat.completion",
+        "created": created,
+        "model": model,
+        "choices": [
+            {"index": 0, "message": {"role": "assistant", "content": reply}, "finish_reason": "stop"}
+        ],
+        "usage": usage,
+    }
+
+
+@upstream_router.post("/_control")
+async def set_control(request: Request):
+    """Override MOCK_UPSTREAM_* settings at runtime; returns the active overrides."""
+    body = await request.json()
+    if not isinstance(body, dict) or any(not str(k).startswith("MOCK_UPSTREAM_") for k in body):
+        return _error(400, "expected an object of MOCK_UPSTREAM_* settings", "invalid_request_error")
+    if "MOCK_UPSTREAM_LATENCY" in body:
+        try:
+            latency_sampler(str(body["MOCK_UPSTREAM_LATENCY"]))
+        except ValueError as exc:
+            return _error(400, str(exc), "invalid_request_error")
+    _overrides.update({str(k): str(v) for k, v in body.items()})
+    return dict(_overrides)
+
+
+@upstream_router.delete("/_control")
+def clear_control():
+    _overrides.clear()
+    return {}
+
+
+def create_app():
+    """Standalone fake upstream app."""
+    from fastapi import FastAPI
+
+    app = FastAPI(title="BrainForce fake upstream")
+    app.include_router(upstream_router)
+    return app
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(prog="python -m core.mock", description="Fake OpenAI-compatible upstream")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8001)
+    args = parser.parse_args()
+    import uvicorn
+    uvicorn.run(create_app(), host=args.host, port=args.port)
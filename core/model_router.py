@@ -0,0 +1,401 @@
+"""Routing chat completions across model backends.
+
+Backends are enabled by MODEL_BACKENDS (default ``openai,ollama``), in order
+of preference, and each one only takes part while it is configured:
+
+- ``openai``: OPENAI_API_KEY is set; natively serves models matching
+  OPENAI_MODEL_PREFIXES (default ``gpt-,o1,o3,o4,chatgpt-``) and passes
+  through any other model no enabled backend serves natively (``ft:``
+  fine-tunes, ``text-*``, new model families)
+- ``ollama``: OLLAMA_HOST is set; serves any model, mapping names it does not
+  list in OLLAMA_MODELS to OLLAMA_MODEL (default ``llama3``)
+- ``offline``: always available, a deterministic local reply that needs no
+  network (the offline mode of the old model_interface)
+
+A model written as ``<backend>/<model>`` pins that backend.  Every backend
+keeps exponentially weighted latency and error rates (ROUTER_EWMA_ALPHA,
+default 0.2) plus a window of recent latencies.  MODEL_ROUTING_POLICY picks
+the order in which capable backends are tried:
+
+- ``fastest`` (default): lowest latency EWMA, penalized by the error EWMA
+- ``cheapest``: lowest COST_PER_1K, ties broken by speed
+- ``capability``: backends that natively serve the model first, then
+  MODEL_BACKENDS order
+
+With ROUTER_HEDGE=1 a second request goes to the runner-up when the first
+has not answered within its p95 latency (once ROUTER_HEDGE_MIN_SAMPLES
+latencies are known); whichever answers first wins and the other is
+cancelled.
+
+Each attempt is bounded by the request deadline and each backend has a
+circuit breaker; retryable failures are retried within the retry budget
+(see core/resilience.py), skipping backends whose breaker is open.
+"""
+import asyncio
+import math
+import os
+import threading
+import time
+from collections import deque
+from typing import Dict, List, Optional, Tuple
+
+from fastapi import HTTPException
+
+from core import resilience
+from core import upstream
+
+
+def _env_float(name: str, default: float) -> float:
+    try:
+        return float(os.getenv(name, default))
+    except (TypeError, ValueError):
+        return default
+
+
+def _split(value: str) -> List[str]:
+    return [part.strip() for part in (value or "").split(",") if part.strip()]
+
+
+def _completion(model: str, text: str, prompt_tokens: int = 0, completion_tokens: int = 0) -> dict:
+    """An OpenAI-shaped chat completion body."""
+    return {
+        "object": "chat.completion",
+        "created": int(time.time()),
+        "model": model,
+        "choices": [{"index": 0, "message": {"role": "assistant", "content": text}, "finish_reason": "stop"}],
+        "usage": {
+            "prompt_tokens": prompt_tokens,
+            "completion_tokens": completion_tokens,
+            "total_tokens": prompt_tokens + completion_tokens,
+        },
+    }
+
+
+class BackendStats:
+    """Rolling latency/error figures for one backend."""
+
+    def __init__(self, window: int = 100):
+        self._lock = threading.Lock()
+        self.latency: Optional[float] = None
+        self.error_rate = 0.0
+        self.requests = 0
+        self.errors = 0
+        self._recent: deque = deque(maxlen=window)
+
+    def record(self, seconds: float, ok: bool) -> None:
+        alpha = min(1.0, max(0.0, _env_float("ROUTER_EWMA_ALPHA", 0.2)))
+        with self._lock:
+            self.requests += 1
+            self.errors += 0 if ok else 1
+            self.error_rate += alpha * ((0.0 if ok else 1.0) - self.error_rate)
+            if ok:
+                self._recent.append(seconds)
+                self.latency = seconds if self.latency is None else self.latency + alpha * (seconds - self.latency)
+
+    def p95(self, min_samples: int) -> Optional[float]:
+        with self._lock:
+            if len(self._recent) < max(1, min_samples):
+                return None
+            ordered = sorted(self._recent)
+        return ordered[min(len(ordered) - 1, math.ceil(0.95 * len(ordered)) - 1)]
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            return {
+                "latency_ewma_ms": None if self.latency is None else round(self.latency * 1000, 3),
+                "error_rate_ewma": round(self.error_rate, 4),
+                "requests": self.requests,
+                "errors": self.errors,
+            }
+
+
+class Backend:
+    """One place completions can come from; subclasses implement ``_complete``."""
+
+    name = "backend"
+    # also takes models that no enabled backend serves natively
+    catch_all = False
+
+    def __init__(self):
+        self.stats = BackendStats()
+        self.breaker = resilience.CircuitBreaker()
+
+    def available(self) -> bool:
+        return True
+
+    def cost(self) -> float:
+        """Relative price per 1k tokens (COST_PER_1K_<NAME>)."""
+        return _env_float(f"COST_PER_1K_{self.name.upper()}", 0.0)
+
+    def native(self, model: str) -> bool:
+        """True when the backend serves ``model`` as-is rather than as a stand-in."""
+        return False
+
+    def supports(self, model: str) -> bool:
+        return True
+
+    async def complete(self, payload: dict) -> dict:
+        """One attempt, bounded by the request deadline.
+
+        Callers claim ``breaker.allow()`` first; the outcome is recorded here.
+        """
+        started = time.monotonic()
+        try:
+            result = await resilience.bounded(self._complete(payload), "upstream")
+        except asyncio.CancelledError:
+            # a cancelled hedge says nothing about the backend's health
+            self.breaker.release_probe()
+            raise
+        except resilience.DeadlineExceeded:
+            # the client's deadline, not necessarily the backend's fault
+            self.stats.record(time.monotonic() - started, False)
+            self.breaker.release_probe()
+            raise
+        except Exception as exc:
+            self.stats.record(time.monotonic() - started, False)
+            # 429 means the backend is alive but throttling us
+            self.breaker.record(getattr(exc, "status_code", None) == 429)
+            raise
+        self.stats.record(time.monotonic() - started, True)
+        self.breaker.record(True)
+        return result
+
+    async def _complete(self, payload: dict) -> dict:
+        raise NotImplementedError
+
+
+class OpenAIBackend(Backend):
+    name = "openai"
+    catch_all = True
+
+    def available(self) -> bool:
+        return bool(os.getenv("OPENAI_API_KEY"))
+
+    def native(self, model: str) -> bool:
+        prefixes = _split(os.getenv("OPENAI_MODEL_PREFIXES", "gpt-,o1,o3,o4,chatgpt-"))
+        return any(model.startswith(p) for p in prefixes)
+
+    def supports(self, model: str) -> bool:
+        return self.native(model)
+
+    async def _complete(self, payload: dict) -> dict:
+        import httpx
+
+        headers = {
+            "Authorization": f"Bearer {os.getenv('OPENAI_API_KEY')}",
+            "Content-Type": "application/json",
+        }
+        try:
+            resp = await upstream.get_client().post(upstream.chat_url(), headers=headers, json=payload)
+        except httpx.TimeoutException:
+            raise HTTPException(status_code=504, detail="Upstream timed out")
+        except httpx.HTTPError as exc:
+            raise HTTPException(status_code=502, detail=f"Upstream request failed: {exc}")
+        try:
+            result = resp.json()
+        except ValueError:
+            raise HTTPException(status_code=502, detail="Upstream returned invalid JSON")
+        if resp.status_code == 429 or resp.status_code >= 500:
+            retry_after = resp.headers.get("retry-after")
+            raise HTTPException(
+                status_code=resp.status_code,
+                detail=result,
+                headers={"Retry-After": retry_after} if retry_after else None,
+            )
+        # other client errors are the caller's problem and are passed through as before
+        return result
+
+
+class OllamaBackend(Backend):
+    name = "ollama"
+
+    def available(self) -> bool:
+        return bool(os.getenv("OLLAMA_HOST"))
+
+    def native(self, model: str) -> bool:
+        return model in _split(os.getenv("OLLAMA_MODELS", ""))
+
+    async def _complete(self, payload: dict) -> dict:
+        import httpx
+
+        model = payload.get("model") or ""
+        if not self.native(model):
+            model = os.getenv("OLLAMA_MODEL", "llama3")
+        body = {
+            "model": model,
+            "messages": payload.get("messages") or [],
+            "stream": False,
+            "options": {"temperature": payload.get("temperature"), "num_predict": payload.get("max_tokens")},
+        }
+        url = os.getenv("OLLAMA_HOST").rstrip("/") + "/api/chat"
+        try:
+            resp = await upstream.get_client().post(url, json=body)
+            resp.raise_for_status()
+            data = resp.json()
+        except httpx.TimeoutException:
+            raise HTTPException(status_code=504, detail="Ollama timed out")
+        except (httpx.HTTPError, ValueError) as exc:
+            raise HTTPException(status_code=502, detail=f"Ollama request failed: {exc}")
+        text = (data.get("message") or {}).get("content") or ""
+        return _completion(model, text, data.get("prompt_eval_count") or 0, data.get("eval_count") or 0)
+
+
+class OfflineBackend(Backend):
+    """Answers locally without a model; useful offline and in tests."""
+
+    name = "offline"
+
+    def __init__(self, name: str = "offline", latency: float = 0.0, fail: bool = False):
+        super().__init__()
+        self.name = name
+        self.latency = latency
+        self.fail = fail
+
+    async def _complete(self, payload: dict) -> dict:
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        if self.fail:
+            raise HTTPException(status_code=502, detail=f"{self.name} backend failed")
+        messages = payload.get("messages") or []
+        prompt = next((m.get("content") or "" for m in reversed(messages) if m.get("role") == "user"), "")
+        return _completion(payload.get("model") or self.name, f"[Offline mode] {prompt[:150]}")
+
+
+class Router:
+    def __init__(self, backends: Optional[List[Backend]] = None):
+        self._registry: Dict[str, Backend] = {}
+        self._explicit = backends is not None
+        self.hedges = 0
+        self.retries = 0
+        for backend in backends or [OpenAIBackend(), OllamaBackend(), OfflineBackend()]:
+            self.register(backend)
+
+    def register(self, backend: Backend) -> None:
+        self._registry[backend.name] = backend
+
+    def backend(self, name: str) -> Optional[Backend]:
+        return self._registry.get(name)
+
+    def _enabled(self) -> List[Backend]:
+        if self._explicit:
+            names = list(self._registry)
+        else:
+            names = _split(os.getenv("MODEL_BACKENDS", "openai,ollama"))
+        return [self._registry[n] for n in names if n in self._registry and self._registry[n].available()]
+
+    def candidates(self, model: str) -> List[Tuple[Backend, dict]]:
+        """Capable backends in the order the policy prefers, each with its model name."""
+        enabled = self._enabled()
+        pinned, _, rest = model.partition("/")
+        if rest and pinned in {b.name for b in enabled}:
+            return [(b, rest) for b in enabled if b.name == pinned]
+
+        claimed = any(b.native(model) for b in enabled)
+        capable = [b for b in enabled if b.supports(model) or (b.catch_all and not claimed)]
+        policy = os.getenv("MODEL_ROUTING_POLICY", "fastest")
+        order = {b.name: i for i, b in enumerate(capable)}
+
+        def speed(b: Backend) -> float:
+            snap = b.stats
+            # unmeasured backends go first so they get measured
+            latency = 0.0 if snap.latency is None else snap.latency
+            # expected time until a successful answer when failures are retried
+            return latency / max(0.05, 1.0 - snap.error_rate)
+
+        if policy == "cheapest":
+            capable.sort(key=lambda b: (b.cost(), speed(b), order[b.name]))
+        elif policy == "capability":
+            capable.sort(key=lambda b: (not b.native(model), order[b.name]))
+        else:
+            capable.sort(key=lambda b: (speed(b), order[b.name]))
+        return [(b, model) for b in capable]
+
+    async def complete(self, payload: dict) -> dict:
+        """Run ``payload`` on the preferred backend whose breaker is closed.
+
+        Retryable failures are retried (possibly on the next backend once a
+        breaker opens) within the deadline and the retry budget.
+        """
+        chosen = self.candidates(payload.get("model") or "")
+        if not chosen:
+            if not self._enabled():
+                raise HTTPException(status_code=403, detail="Ingen API-nyckel satt")
+            raise HTTPException(status_code=400, detail=f"No configured backend serves model {payload.get('model')!r}")
+        resilience.budget.deposit()
+        attempt = 1
+        while True:
+            target = next((i for i, (b, _) in enumerate(chosen) if b.breaker.allow()), None)
+            if target is None:
+                raise HTTPException(
+                    status_code=503,
+                    detail="All model backends are unavailable",
+                    headers={"Retry-After": str(min(b.breaker.retry_after() for b, _ in chosen))},
+                )
+            try:
+                return await self._attempt(payload, chosen, target)
+            except HTTPException as exc:
+                if not resilience.is_retryable(exc) or attempt >= resilience.max_attempts():
+                    raise
+                delay = resilience.backoff(attempt, exc)
+                left = resilience.remaining()
+                if left is not None and delay >= left:
+                    raise
+                if not resilience.budget.withdraw():
+                    raise
+            self.retries += 1
+            attempt += 1
+            await asyncio.sleep(delay)
+
+    async def _attempt(self, payload: dict, chosen: List[Tuple[Backend, str]], target: int) -> dict:
+        primary, model = chosen[target]
+        first = dict(payload, model=model)
+        if os.getenv("ROUTER_HEDGE") != "1":
+            return await primary.complete(first)
+        delay = primary.stats.p95(int(_env_float("ROUTER_HEDGE_MIN_SAMPLES", 20)))
+        # only a backend with a closed breaker is worth a hedge
+        backups = [(b, m) for b, m in chosen[target + 1:] if b.breaker.state == resilience.CircuitBreaker.CLOSED]
+        if delay is None or not backups:
+            return await primary.complete(first)
+        backup, backup_model = backups[0]
+        return await self._hedged(primary.complete(first), backup.complete(dict(payload, model=backup_model)), delay)
+
+    async def _hedged(self, first, second, delay: float) -> dict:
+        primary = asyncio.ensure_future(first)
+        try:
+            done, _ = await asyncio.wait({primary}, timeout=delay)
+        except BaseException:
+            primary.cancel()
+            second.close()
+            raise
+        if done:
+            second.close()
+            return primary.result()
+        self.hedges += 1
+        pending = {primary, asyncio.ensure_future(second)}
+        error: Optional[BaseException] = None
+        try:
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.exception() is None:
+                        return task.result()
+                    error = task.exception()
+            raise error
+        finally:
+            for task in pending:
+                task.cancel()
+
+    def stats(self) -> dict:
+        return {
+            "policy": os.getenv("MODEL_ROUTING_POLICY", "fastest"),
+            "hedges": self.hedges,
+            "retries": self.retries,
+            "retry_budget": round(resilience.budget.balance(), 2),
+            "backends": {
+                name: dict(b.stats.snapshot(), available=b.available(), cost_per_1k=b.cost(), breaker=b.breaker.state)
+                for name, b in self._registry.items()
+            },
+        }
+
+
+router = Router()
@@ -0,0 +1,161 @@
+"""bcrypt hashing on a dedicated, bounded process pool.
+
+Login and registration hand their bcrypt work to this pool instead of
+running it on a request thread, so a burst of logins cannot starve the
+threadpool the chat proxy needs.  The pool is bounded twice:
+
+- BCRYPT_WORKERS processes (default 2; 0 skips the processes, e.g. in dev,
+  and runs bcrypt in the event loop's default thread pool, or inline when
+  called outside a loop)
+- BCRYPT_MAX_PENDING jobs queued or running (default 4 per worker); once
+  full, ``submit`` raises :class:`PoolFull` immediately so callers can shed
+  load with a 503 instead of queueing without bound
+
+BCRYPT_ROUNDS sets the cost factor for new hashes (default 12); hashes with
+a lower cost report :func:`needs_rehash` so login can upgrade them.
+
+This module only imports bcrypt so that worker processes start quickly.
+"""
+import asyncio
+import multiprocessing
+import os
+import threading
+from concurrent.futures import Future, ProcessPoolExecutor
+from typing import Optional
+
+import bcrypt
+
+DEFAULT_ROUNDS = 12
+
+
+class PoolFull(Exception):
+    """Raised when the bcrypt pool already has BCRYPT_MAX_PENDING jobs."""
+
+
+def _env_int(name: str, default: int) -> int:
+    try:
+        return int(os.getenv(name, default))
+    except (TypeError, ValueError):
+        return default
+
+
+def rounds() -> int:
+    # bcrypt accepts cost factors 4..31
+    return min(31, max(4, _env_int("BCRYPT_ROUNDS", DEFAULT_ROUNDS)))
+
+
+def hash_sync(password: str, cost: Optional[int] = None) -> str:
+    return bcrypt.hashpw(password.encode(), bcrypt.gensalt(cost or rounds())).decode()
+
+
+def check_sync(password: str, hashed: str) -> bool:
+    try:
+        return bcrypt.checkpw(password.encode(), hashed.encode())
+    except Exception:
+        return False
+
+
+def hash_cost(hashed: str) -> Optional[int]:
+    """Cost factor encoded in a ``$2b$NN$...`` hash, or None if unparseable."""
+    try:
+        return int(hashed.split("$")[2])
+    except (AttributeError, IndexError, ValueError):
+        return None
+
+
+def needs_rehash(hashed: str) -> bool:
+    cost = hash_cost(hashed)
+    return cost is not None and cost < rounds()
+
+
+class _BcryptPool:
+    def __init__(self):
+        self._executor: Optional[ProcessPoolExecutor] = None
+        self._lock = threading.Lock()
+        self._pending = 0
+        self.shed = 0
+
+    def _workers(self) -> int:
+        return max(0, _env_int("BCRYPT_WORKERS", 2))
+
+    def _max_pending(self) -> int:
+        return max(1, _env_int("BCRYPT_MAX_PENDING", 4 * max(1, self._workers())))
+
+    def submit(self, fn, *args) -> Future:
+        """Run ``fn(*args)`` on the pool; raises PoolFull when at capacity."""
+        with self._lock:
+            if self._pending >= self._max_pending():
+                self.shed += 1
+                raise PoolFull()
+            self._pending += 1
+            workers = self._workers()
+            if workers and self._executor is None:
+                # spawn keeps workers independent of this process's threads and locks
+                self._executor = ProcessPoolExecutor(
+                    max_workers=workers, mp_context=multiprocessing.get_context("spawn")
+                )
+            executor = self._executor if workers else None
+
+        if executor is None:
+            try:
+                loop = asyncio.get_running_loop()
+            except RuntimeError:
+                loop = None
+            if loop is not None:
+                # ~250ms of bcrypt must not run on the event loop itself
+                return self._in_default_executor(loop, fn, args)
+            future: Future = Future()
+            try:
+                future.set_result(fn(*args))
+            except Exception as exc:
+                future.set_exception(exc)
+            self._done(future)
+            return future
+        try:
+            future = executor.submit(fn, *args)
+        except Exception:
+            self._done(None)
+            raise
+        future.add_done_callback(self._done)
+        return future
+
+    def _in_default_executor(self, loop, fn, args) -> Future:
+        future: Future = Future()
+        future.set_running_or_notify_cancel()
+
+        def copy(task) -> None:
+            error = asyncio.CancelledError() if task.cancelled() else task.exception()
+            if error is not None:
+                future.set_exception(error)
+            else:
+                future.set_result(task.result())
+
+        future.add_done_callback(self._done)
+        try:
+            task = loop.run_in_executor(None, fn, *args)
+        except Exception as exc:
+            future.set_exception(exc)
+            return future
+        task.add_done_callback(copy)
+        return future
+
+    def _done(self, _future) -> None:
+        with self._lock:
+            self._pending -= 1
+
+    def shutdown(self) -> None:
+        with self._lock:
+            executor, self._executor = self._executor, None
+        if executor is not None:
+            executor.shutdown(wait=False, cancel_futures=True)
+
+
+pool = _BcryptPool()
+
+
+async def hash_password(password: str) -> str:
+    return await asyncio.wrap_future(pool.submit(hash_sync, password, rounds()))
+
+
+async def verify_password(password: str, hashed: str) -> bool:
+    return await asyncio.wrap_future(pool.submit(check_sync, password, hashed))
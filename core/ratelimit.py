@@ -0,0 +1,191 @@
+"""Sliding-window rate limiting shared by every worker process.
+
+Counters live in the ``rate_limits`` table of the main database, so all
+uvicorn workers pointed at the same file enforce a single limit.  Memory is
+fixed: each limiter scope has RATE_LIMIT_SLOTS slots (default 4096), grouped
+into sets of RATE_LIMIT_WAYS (default 4).  A key is hashed (stable across
+processes) onto one set and owns at most one slot in it; every slot records
+its key, so keys that collide never share a counter.  When a set is full a
+new key takes over the least recently hit slot.  Eviction can only forget
+hits, so flooding a set with junk keys never locks anyone else out.
+
+Each slot keeps a sliding-window counter: the count for the current window
+plus the previous window's count weighted by how much of it still overlaps.
+
+Besides the login limiter in core/auth.py, :func:`limit_dependency` turns a
+limiter into a FastAPI dependency for any other endpoint.
+"""
+import hashlib
+import math
+import os
+import time
+from typing import Callable, Optional
+
+from fastapi import HTTPException, Request
+
+from core import database
+
+
+def _slots() -> int:
+    try:
+        return max(1, int(os.getenv("RATE_LIMIT_SLOTS", 4096)))
+    except ValueError:
+        return 4096
+
+
+def _ways() -> int:
+    try:
+        return max(1, int(os.getenv("RATE_LIMIT_WAYS", 4)))
+    except ValueError:
+        return 4
+
+
+def _slot_range(key: str, slots: int, ways: int) -> range:
+    """The set of slots ``key`` may occupy."""
+    ways = min(ways, slots)
+    # Python's hash() is salted per process, so it cannot be shared across workers
+    digest = hashlib.blake2b(key.encode(), digest_size=8).digest()
+    first = (int.from_bytes(digest, "big") % (slots // ways)) * ways
+    return range(first, first + ways)
+
+
+class SlidingWindowLimiter:
+    """At most ``limit`` hits per ``window`` seconds per key within ``scope``."""
+
+    def __init__(self, scope: str, limit: int, window: float, slots: Optional[int] = None,
+                 ways: Optional[int] = None):
+        self.scope = scope
+        self.limit = limit
+        self.window = window
+        self.slots = slots or _slots()
+        self.ways = ways or _ways()
+
+    def _set(self, key: str) -> range:
+        return _slot_range(key, self.slots, self.ways)
+
+    def _now_window(self):
+        now = time.time()
+        index = int(now // self.window)
+        return now, index
+
+    def _estimate(self, row, now: float, index: int) -> float:
+        if row is None:
+            return 0.0
+        start, curr, prev = row["window_start"], row["curr"], row["prev"]
+        if start == index:
+            previous = prev
+        elif start == index - 1:
+            curr, previous = 0, curr
+        else:
+            return 0.0
+        overlap = 1.0 - (now - index * self.window) / self.window
+        return curr + previous * overlap
+
+    def count(self, key: str) -> int:
+        """Current (rounded-up) sliding-window count for ``key``."""
+        now, index = self._now_window()
+        conn = database.get_db()
+        slots = self._set(key)
+        try:
+            row = conn.execute(
+                "SELECT window_start, curr, prev FROM rate_limits "
+                "WHERE scope = ? AND slot BETWEEN ? AND ? AND key = ?",
+                (self.scope, slots.start, slots.stop - 1, key),
+            ).fetchone()
+        finally:
+            conn.close()
+        return math.ceil(self._estimate(row, now, index) - 1e-9)
+
+    def allow(self, key: str) -> bool:
+        """True while ``key`` is below the limit (does not count a hit)."""
+        return self.count(key) < self.limit
+
+    def hit(self, key: str) -> None:
+        """Record one hit for ``key``, rolling the window forward if needed."""
+        now, index = self._now_window()
+        slots = self._set(key)
+        conn = database.get_db()
+        try:
+            c = conn.cursor()
+            # pick the slot and write it in one transaction, so two workers
+            # cannot hand the same free slot to different keys
+            database.begin_immediate(c)
+            rows = {
+                row["slot"]: row
+                for row in c.execute(
+                    "SELECT slot, key, window_start, curr, prev, touched FROM rate_limits "
+                    "WHERE scope = ? AND slot BETWEEN ? AND ?",
+                    (self.scope, slots.start, slots.stop - 1),
+                )
+            }
+            own = next((row for row in rows.values() if row["key"] == key), None)
+            if own is not None:
+                slot = own["slot"]
+                curr, prev = own["curr"], own["prev"]
+                if own["window_start"] == index - 1:
+                    curr, prev = 0, curr
+                elif own["window_start"] != index:
+                    curr, prev = 0, 0
+            else:
+                free = [n for n in slots if n not in rows]
+                # a free slot, else the least recently hit key gives up its slot
+                slot = free[0] if free else min(rows.values(), key=lambda row: row["touched"])["slot"]
+                curr, prev = 0, 0
+            c.execute(
+                "INSERT OR REPLACE INTO rate_limits (scope, slot, key, window_start, curr, prev, touched) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (self.scope, slot, key, index, curr + 1, prev, now),
+            )
+            conn.commit()
+        finally:
+            conn.close()
+
+    def reset(self, key: str) -> None:
+        """Forget ``key``'s hits."""
+        slots = self._set(key)
+        conn = database.get_db()
+        try:
+            conn.execute(
+                "DELETE FROM rate_limits WHERE scope = ? AND slot BETWEEN ? AND ? AND key = ?",
+                (self.scope, slots.start, slots.stop - 1, key),
+            )
+            conn.commit()
+        finally:
+            conn.close()
+
+    def clear(self) -> None:
+        """Drop every counter in this scope."""
+        conn = database.get_db()
+        try:
+            conn.execute("DELETE FROM rate_limits WHERE scope = ?", (self.scope,))
+            conn.commit()
+        finally:
+            conn.close()
+
+    def retry_after(self) -> int:
+        """Seconds until the current window rolls over (a safe Retry-After)."""
+        now, index = self._now_window()
+        return max(1, math.ceil((index + 1) * self.window - now))
+
+
+def client_ip(request: Request) -> str:
+    """Extract client IP from request, handling X-Forwarded-For header."""
+    if request.headers.get("x-forwarded-for"):
+        return request.headers.get("x-forwarded-for").split(",")[0].strip()
+    return request.client.host if request.client else "unknown"
+
+
+def limit_dependency(limiter: SlidingWindowLimiter, key_func: Callable[[Request], str] = client_ip):
+    """FastAPI dependency counting every call and answering 429 past the limit."""
+
+    def dependency(request: Request) -> None:
+        key = key_func(request)
+        if not limiter.allow(key):
+            raise HTTPException(
+                status_code=429,
+                detail="Too many requests. Try again later.",
+                headers={"Retry-After": str(limiter.retry_after())},
+            )
+        limiter.hit(key)
+
+    return dependency
@@ -0,0 +1,201 @@
+"""Deadlines, retries and circuit breaking for upstream model calls.
+
+- Every chat request gets a deadline: REQUEST_TIMEOUT_MS (default 60000),
+  shortened by the client's ``X-Request-Timeout-Ms`` header.  It is kept in a
+  context variable, so the history fetch, trimming and the upstream call all
+  see the same remaining time; running out is a 504.
+- Failed upstream attempts (429, 502, 503, 504, timeouts) are retried up to
+  RETRY_MAX_ATTEMPTS times in total (default 3) with full-jitter exponential
+  backoff (RETRY_BASE_DELAY_MS, default 100; RETRY_MAX_DELAY_MS, default
+  2000), or exactly the upstream's Retry-After when it sends one.  Retries
+  draw on a process-wide budget: each request deposits RETRY_BUDGET_RATIO
+  (default 0.1) of a retry plus RETRY_BUDGET_PER_SEC (default 1) per second,
+  up to RETRY_BUDGET_CAP (default 20), so an outage cannot multiply traffic.
+- Each backend has a :class:`CircuitBreaker`.  BREAKER_FAILURES consecutive
+  failures (default 5) open it for BREAKER_COOLDOWN seconds (default 30);
+  while open, calls fail fast, and afterwards a single probe decides whether
+  it closes again.
+"""
+import asyncio
+import contextvars
+import os
+import random
+import threading
+import time
+from typing import Awaitable, Optional
+
+from fastapi import HTTPException
+
+RETRYABLE_STATUS = {429, 502, 503, 504}
+
+_deadline: contextvars.ContextVar = contextvars.ContextVar("request_deadline", default=None)
+
+
+def _env_float(name: str, default: float) -> float:
+    try:
+        return float(os.getenv(name, default))
+    except (TypeError, ValueError):
+        return default
+
+
+class DeadlineExceeded(HTTPException):
+    def __init__(self, phase: str):
+        super().__init__(status_code=504, detail=f"Request deadline exceeded during {phase}")
+
+
+def start_deadline(timeout_ms: Optional[str] = None) -> float:
+    """Set the deadline for the current request; returns it (monotonic seconds)."""
+    budget = _env_float("REQUEST_TIMEOUT_MS", 60000)
+    if timeout_ms:
+        try:
+            # clients may only shorten the server's limit
+            budget = min(budget, max(0.0, float(timeout_ms)))
+        except ValueError:
+            raise HTTPException(status_code=400, detail="X-Request-Timeout-Ms must be a number")
+    deadline = time.monotonic() + budget / 1000.0
+    _deadline.set(deadline)
+    return deadline
+
+
+def remaining() -> Optional[float]:
+    """Seconds left before the current deadline, or None without one."""
+    deadline = _deadline.get()
+    if deadline is None:
+        return None
+    return deadline - time.monotonic()
+
+
+def check(phase: str) -> None:
+    left = remaining()
+    if left is not None and left <= 0:
+        raise DeadlineExceeded(phase)
+
+
+async def bounded(awaitable: Awaitable, phase: str):
+    """Await ``awaitable`` but give up (504) when the deadline passes."""
+    left = remaining()
+    if left is None:
+        return await awaitable
+    if left <= 0:
+        if asyncio.iscoroutine(awaitable):
+            awaitable.close()
+        raise DeadlineExceeded(phase)
+    try:
+        return await asyncio.wait_for(awaitable, left)
+    except asyncio.TimeoutError:
+        raise DeadlineExceeded(phase)
+
+
+class RetryBudget:
+    """Caps retries at a fraction of recent traffic."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._balance: Optional[float] = None
+        self._updated = time.monotonic()
+        self.denied = 0
+
+    def _refill_locked(self) -> float:
+        now = time.monotonic()
+        cap = _env_float("RETRY_BUDGET_CAP", 20)
+        if self._balance is None:
+            self._balance = cap
+        self._balance = min(cap, self._balance + (now - self._updated) * _env_float("RETRY_BUDGET_PER_SEC", 1))
+        self._updated = now
+        return cap
+
+    def deposit(self) -> None:
+        with self._lock:
+            cap = self._refill_locked()
+            self._balance = min(cap, self._balance + _env_float("RETRY_BUDGET_RATIO", 0.1))
+
+    def withdraw(self) -> bool:
+        with self._lock:
+            self._refill_locked()
+            if self._balance >= 1.0:
+                self._balance -= 1.0
+                return True
+            self.denied += 1
+            return False
+
+    def balance(self) -> float:
+        with self._lock:
+            self._refill_locked()
+            return self._balance
+
+
+budget = RetryBudget()
+
+
+class CircuitBreaker:
+    CLOSED, OPEN, HALF_OPEN = "closed", "open", "half_open"
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.state = self.CLOSED
+        self._failures = 0
+        self._opened_at = 0.0
+        self._probing = False
+        self.opens = 0
+
+    def _cooldown(self) -> float:
+        return _env_float("BREAKER_COOLDOWN", 30)
+
+    def allow(self) -> bool:
+        """True if a call may go out now (claims the probe when half-open)."""
+        with self._lock:
+            if self.state == self.OPEN and time.monotonic() - self._opened_at >= self._cooldown():
+                self.state = self.HALF_OPEN
+                self._probing = False
+            if self.state == self.CLOSED:
+                return True
+            if self.state == self.HALF_OPEN and not self._probing:
+                self._probing = True
+                return True
+            return False
+
+    def retry_after(self) -> int:
+        with self._lock:
+            left = self._cooldown() - (time.monotonic() - self._opened_at)
+        return max(1, int(left + 0.999))
+
+    def record(self, ok: bool) -> None:
+        with self._lock:
+            if ok:
+                self.state = self.CLOSED
+                self._failures = 0
+                self._probing = False
+                return
+            self._failures += 1
+            if self.state == self.HALF_OPEN or self._failures >= int(_env_float("BREAKER_FAILURES", 5)):
+                if self.state != self.OPEN:
+                    self.opens += 1
+                self.state = self.OPEN
+                self._opened_at = time.monotonic()
+                self._probing = False
+
+    def release_probe(self) -> None:
+        """Give back an unused half-open probe (e.g. the call was cancelled)."""
+        with self._lock:
+            self._probing = False
+
+
+def is_retryable(exc: BaseException) -> bool:
+    return isinstance(exc, HTTPException) and exc.status_code in RETRYABLE_STATUS and not isinstance(exc, DeadlineExceeded)
+
+
+def backoff(attempt: int, exc: BaseException) -> float:
+    """Delay before retry number ``attempt`` (1-based)."""
+    retry_after = (getattr(exc, "headers", None) or {}).get("Retry-After")
+    if retry_after is not None:
+        try:
+            return max(0.0, float(retry_after))
+        except ValueError:
+            pass
+    base = _env_float("RETRY_BASE_DELAY_MS", 100) / 1000.0
+    cap = _env_float("RETRY_MAX_DELAY_MS", 2000) / 1000.0
+    return random.uniform(0, min(cap, base * (2 ** (attempt - 1))))
+
+
+def max_attempts() -> int:
+    return max(1, int(_env_float("RETRY_MAX_ATTEMPTS", 3)))
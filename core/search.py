@@ -0,0 +1,134 @@
+"""Full-text search over conversation memory.
+
+``memory_fts`` is an FTS5 external-content index on ``memory.message``
+(migration 9), kept in sync by triggers on ``memory``.  :func:`search`
+scopes every query to one user inside the index (``user_id`` is an indexed
+column), ranks by bm25 and pages by keyset on ``(rank, id)``, so a page
+costs the same however deep it is.
+
+User input is never passed to FTS5 as syntax: each word becomes a quoted
+term, all terms must match, and a trailing ``*`` keeps prefix matching.
+
+Rebuild the index from the memory table (e.g. after restoring a backup made
+without it) with:
+
+    python -m core.search --rebuild [--db PATH]
+"""
+import argparse
+import re
+from typing import Dict, List, Optional, Tuple
+
+from fastapi import HTTPException
+
+from core import database
+from core import migrations
+from core import writer
+
+SNIPPET_TOKENS = 12
+_WORDS = re.compile(r"[\w']+\*?", re.UNICODE)
+
+
+def match_expression(query: str, uid) -> str:
+    """FTS5 MATCH string for ``query`` restricted to ``uid``'s rows."""
+    terms = []
+    for word in _WORDS.findall(query or ""):
+        prefix = word.endswith("*")
+        word = word.rstrip("*").replace('"', '""')
+        if word:
+            terms.append(f'"{word}"' + ("*" if prefix else ""))
+    if not terms:
+        raise HTTPException(status_code=400, detail="q must contain at least one word")
+    return f"message : ({' '.join(terms)}) AND user_id : \"{int(uid)}\""
+
+
+def encode_cursor(rank: float, row_id: int) -> str:
+    return f"{rank!r}:{row_id}"
+
+
+def decode_cursor(cursor: str) -> Tuple[float, int]:
+    try:
+        rank, row_id = cursor.rsplit(":", 1)
+        return float(rank), int(row_id)
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+
+
+def search(uid, query: str, session_id: Optional[str] = None, since: Optional[str] = None,
+           until: Optional[str] = None, cursor: Optional[str] = None, limit: int = 20) -> Dict:
+    """One page of ``uid``'s messages matching ``query``, best first.
+
+    ``since``/``until`` bound the ISO timestamp (inclusive).  Returns
+    ``{"results": [...], "next_cursor": str | None}``.
+    """
+    expression = match_expression(query, uid)
+    where = ["memory_fts MATCH ?", "m.user_id = ?"]
+    params: list = [expression, uid]
+    if session_id:
+        where.append("m.session_id = ?")
+        params.append(session_id)
+    if since:
+        where.append("m.timestamp >= ?")
+        params.append(since)
+    if until:
+        where.append("m.timestamp <= ?")
+        params.append(until)
+    if cursor:
+        rank, last_id = decode_cursor(cursor)
+        where.append("(memory_fts.rank > ? OR (memory_fts.rank = ? AND m.id > ?))")
+        params.extend([rank, rank, last_id])
+    params.append(limit + 1)
+
+    # matches must include writes still queued on the write-behind writer
+    writer.memory_writer.flush()
+    conn = database.get_db()
+    try:
+        if not migrations.fts_available(conn):
+            raise HTTPException(status_code=501, detail="Full-text search is not available on this database")
+        rows = conn.execute(
+            f"""
+            SELECT m.id, m.session_id, m.role, m.timestamp, memory_fts.rank AS rank,
+                   snippet(memory_fts, 0, '<mark>', '</mark>', '…', {SNIPPET_TOKENS}) AS snippet
+            FROM memory_fts JOIN memory m ON m.id = memory_fts.rowid
+            WHERE {' AND '.join(where)}
+            ORDER BY memory_fts.rank, m.id
+            LIMIT ?
+            """,
+            params,
+        ).fetchall()
+    finally:
+        conn.close()
+    results: List[Dict] = [dict(row) for row in rows[:limit]]
+    next_cursor = None
+    if len(rows) > limit:
+        last = results[-1]
+        next_cursor = encode_cursor(last["rank"], last["id"])
+    return {"results": results, "next_cursor": next_cursor}
+
+
+def rebuild(path: Optional[str] = None) -> int:
+    """Create the index if missing and rebuild it from ``memory``; returns the row count."""
+    conn = database.get_db(path)
+    try:
+        migrations.run(conn)
+        c = conn.cursor()
+        database.begin_immediate(c)
+        migrations.create_memory_fts(c)
+        c.execute("INSERT INTO memory_fts(memory_fts) VALUES ('rebuild')")
+        c.execute("INSERT INTO memory_fts(memory_fts) VALUES ('optimize')")
+        # the rebuild covers every row, nothing is left for the migration backfill
+        c.execute("DROP TABLE IF EXISTS memory_fts_backfill")
+        count = c.execute("SELECT COUNT(*) FROM memory").fetchone()[0]
+        conn.commit()
+        return count
+    finally:
+        conn.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(prog="python -m core.search", description="Memory full-text index maintenance")
+    parser.add_argument("--rebuild", action="store_true", help="rebuild the index from the memory table")
+    parser.add_argument("--db", default=None, help=f"database file (default {database.DB_PATH})")
+    args = parser.parse_args()
+    if not args.rebuild:
+        parser.error("nothing to do; pass --rebuild")
+    print(f"indexed {rebuild(args.db)} memory rows")
@@ -0,0 +1,99 @@
+"""Session ownership and per-session stats backed by the ``sessions`` table.
+
+Every memory insert upserts its session row in the same transaction, so the
+owner, message count and token total stay exact without scanning ``memory``.
+A session's owner never changes once set, which makes positive ownership
+lookups safe to cache in process (SESSION_OWNER_CACHE_SIZE entries, LRU).
+"""
+import os
+import threading
+from collections import OrderedDict
+from typing import Optional
+
+from fastapi import HTTPException
+
+from core import database
+
+_MISSING = object()
+
+
+class OwnerCache:
+    """Bounded LRU of (db path, session_id) -> owner user_id."""
+
+    def __init__(self, max_entries: Optional[int] = None):
+        if max_entries is None:
+            try:
+                max_entries = int(os.getenv("SESSION_OWNER_CACHE_SIZE", 10000))
+            except ValueError:
+                max_entries = 10000
+        self.max_entries = max_entries
+        self._owners: "OrderedDict[tuple, object]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, session_id: str):
+        key = (database.DB_PATH, session_id)
+        with self._lock:
+            owner = self._owners.get(key, _MISSING)
+            if owner is not _MISSING:
+                self._owners.move_to_end(key)
+            return owner
+
+    def put(self, session_id: str, owner, path: Optional[str] = None) -> None:
+        if self.max_entries <= 0:
+            return
+        key = (path or database.DB_PATH, session_id)
+        with self._lock:
+            self._owners[key] = owner
+            self._owners.move_to_end(key)
+            while len(self._owners) > self.max_entries:
+                self._owners.popitem(last=False)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._owners.clear()
+
+
+owners = OwnerCache()
+
+
+def _reject() -> HTTPException:
+    return HTTPException(status_code=400, detail="session_id already used by another user")
+
+
+def check_owner_cached(session_id: str, uid) -> bool:
+    """Fail fast if the cached owner differs; True when ``uid`` is the known owner."""
+    owner = owners.get(session_id)
+    if owner is _MISSING:
+        return False
+    if owner != uid:
+        raise _reject()
+    return True
+
+
+def check_owner(c, session_id: str, uid) -> None:
+    """Primary-key ownership check inside the caller's transaction."""
+    if check_owner_cached(session_id, uid):
+        return
+    c.execute("SELECT user_id FROM sessions WHERE session_id = ?", (session_id,))
+    row = c.fetchone()
+    if row is None:
+        return
+    owners.put(session_id, row["user_id"])
+    # session_id must not be reused by another user
+    if row["user_id"] != uid:
+        raise _reject()
+
+
+def record_messages(c, session_id: str, uid, timestamp: str, count: int, tokens: int) -> None:
+    """Create or bump the session row for ``count`` newly inserted messages."""
+    c.execute(
+        """
+        INSERT INTO sessions (session_id, user_id, created_at, last_active, message_count, token_total)
+        VALUES (?, ?, ?, ?, ?, ?)
+        ON CONFLICT(session_id) DO UPDATE SET
+            last_active = excluded.last_active,
+            message_count = message_count + excluded.message_count,
+            token_total = token_total + excluded.token_total
+        """,
+        (session_id, uid, timestamp, timestamp, count, tokens),
+    )
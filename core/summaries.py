@@ -0,0 +1,274 @@
+"""Incremental per-session summaries of history that no longer fits the budget.
+
+Trimming drops the oldest turns once a session outgrows MEMORY_TOKEN_BUDGET.
+Instead of losing them, turns that fall out of the budget are folded into a
+running summary kept in the ``session_summaries`` table, which the proxy
+prepends as a system message.  The summary's tokens come out of the same
+budget, so prompt size stays flat however long the conversation gets.
+
+- SESSION_SUMMARIES=0 turns the feature off
+- a fold starts once SUMMARY_MIN_EVICTED messages (default 6) have been
+  evicted since the last one, and runs in the background: the request that
+  notices it does not wait
+- the summary is capped at SUMMARY_MAX_TOKENS (default 400)
+- SUMMARY_MODEL (default ``gpt-3.5-turbo``) writes it through the model
+  router; in MOCK_MODE a deterministic local summarizer is used instead
+
+``covered_id`` records the newest memory row folded in, so every message is
+summarized once.  The proxy only sees the newest 200 rows of a session; when
+more than that arrive between folds (a bulk ``/memory/save_batch/`` import),
+the fold first loads the rows between ``covered_id`` and the window from the
+database, oldest first and at most a window's worth at a time.
+"""
+import asyncio
+import os
+import threading
+from concurrent.futures import Future
+from datetime import datetime, timezone
+from typing import Dict, List, NamedTuple, Optional
+
+from core import database
+from core import history
+from core import tokenizer
+from core import writer
+
+PREFIX = "Summary of the earlier conversation:\n"
+# session ids per IN (...) query, well under SQLite's bound-parameter limit
+_IN_CHUNK = 500
+
+
+class Summary(NamedTuple):
+    text: str
+    covered_id: int
+    tokens: int
+
+
+def _env_int(name: str, default: int) -> int:
+    try:
+        return int(os.getenv(name, default))
+    except (TypeError, ValueError):
+        return default
+
+
+def enabled() -> bool:
+    return os.getenv("SESSION_SUMMARIES", "1") != "0"
+
+
+def max_tokens() -> int:
+    return max(1, _env_int("SUMMARY_MAX_TOKENS", 400))
+
+
+def min_evicted() -> int:
+    return max(1, _env_int("SUMMARY_MIN_EVICTED", 6))
+
+
+def load(session_id: str, uid) -> Optional[Summary]:
+    conn = database.get_db()
+    try:
+        row = conn.execute(
+            "SELECT summary, covered_id, token_count FROM session_summaries WHERE session_id = ? AND user_id = ?",
+            (session_id, uid),
+        ).fetchone()
+    finally:
+        conn.close()
+    return Summary(row["summary"], row["covered_id"], row["token_count"]) if row else None
+
+
+def load_many(session_ids: List[str], uid) -> Dict[str, Summary]:
+    """:func:`load` for many sessions at once; sessions without a summary are left out."""
+    found: Dict[str, Summary] = {}
+    conn = database.get_db()
+    try:
+        for start in range(0, len(session_ids), _IN_CHUNK):
+            chunk = session_ids[start:start + _IN_CHUNK]
+            rows = conn.execute(
+                "SELECT session_id, summary, covered_id, token_count FROM session_summaries "
+                f"WHERE user_id = ? AND session_id IN ({','.join('?' * len(chunk))})",
+                [uid, *chunk],
+            )
+            for row in rows:
+                found[row["session_id"]] = Summary(row["summary"], row["covered_id"], row["token_count"])
+    finally:
+        conn.close()
+    return found
+
+
+def _load_gap(path: str, session_id: str, uid, after_id: int, before_id: int) -> List[Dict]:
+    """Rows older than the window that the summary has not covered yet, oldest first."""
+    conn = database.get_db(path)
+    try:
+        rows = conn.execute(
+            "SELECT * FROM memory WHERE session_id = ? AND user_id = ? AND id > ? AND id < ? ORDER BY id LIMIT ?",
+            (session_id, uid, after_id, before_id, history.WINDOW_ROWS),
+        ).fetchall()
+    finally:
+        conn.close()
+    return [dict(row) for row in rows]
+
+
+def as_message(summary: Summary) -> Dict:
+    return {"role": "system", "content": PREFIX + summary.text}
+
+
+def _transcript(entries: List[Dict]) -> List[str]:
+    return [f"{entry.get('role') or 'user'}: {entry.get('message') or ''}" for entry in entries]
+
+
+def mock_summarize(previous: str, entries: List[Dict], tokens: int) -> str:
+    """Deterministic stand-in: the first words of each folded message."""
+    lines = [previous] if previous else []
+    for line in _transcript(entries):
+        lines.append(" ".join(line.split()[:12]))
+    return tokenizer.clip_tail("\n".join(lines), tokens)
+
+
+async def summarize(previous: str, entries: List[Dict], tokens: int) -> str:
+    if os.getenv("MOCK_MODE") == "1":
+        return mock_summarize(previous, entries, tokens)
+    from core import model_router
+
+    payload = {
+        "model": os.getenv("SUMMARY_MODEL", "gpt-3.5-turbo"),
+        "messages": [
+            {
+                "role": "system",
+                "content": "Fold the new conversation turns into the running summary. Keep facts, names, "
+                           f"decisions and open questions. Answer with the updated summary only, at most {tokens * 3 // 4} words.",
+            },
+            {
+                "role": "user",
+                "content": f"Summary so far:\n{previous or '(none)'}\n\nNew turns:\n" + "\n".join(_transcript(entries)),
+            },
+        ],
+        "temperature": 0,
+        "max_tokens": tokens,
+    }
+    result = await model_router.router.complete(payload)
+    return tokenizer.clip_tail(result["choices"][0]["message"]["content"].strip(), tokens)
+
+
+class _Folder:
+    """Runs folds on a background event loop, at most one per session."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._running: Dict[tuple, Future] = {}
+        self.folds = 0
+        self.failures = 0
+
+    def _get_loop(self) -> asyncio.AbstractEventLoop:
+        with self._lock:
+            if self._loop is None or self._loop.is_closed():
+                loop = asyncio.new_event_loop()
+                threading.Thread(target=loop.run_forever, name="summarizer", daemon=True).start()
+                self._loop = loop
+            return self._loop
+
+    def schedule(self, session_id: str, uid, previous: Optional[Summary], entries: List[Dict],
+                 gap_before: Optional[int] = None) -> None:
+        """Fold ``entries`` in the background; with ``gap_before``, older unsummarized rows first."""
+        key = (database.DB_PATH, session_id)
+        with self._lock:
+            if key in self._running:
+                return
+            self._running[key] = None
+        loop = self._get_loop()
+        future = asyncio.run_coroutine_threadsafe(self._fold(key, uid, previous, entries, gap_before), loop)
+        with self._lock:
+            self._running[key] = future
+        future.add_done_callback(lambda _: self._done(key))
+
+    def _done(self, key: tuple) -> None:
+        with self._lock:
+            self._running.pop(key, None)
+
+    async def _fold(self, key: tuple, uid, previous: Optional[Summary], entries: List[Dict],
+                    gap_before: Optional[int]) -> None:
+        path, session_id = key
+        try:
+            if gap_before is not None:
+                gap = await asyncio.get_running_loop().run_in_executor(
+                    None, _load_gap, path, session_id, uid, previous.covered_id if previous else 0, gap_before
+                )
+                # the window's own evicted rows wait until the gap is caught up
+                entries = gap if len(gap) >= history.WINDOW_ROWS else gap + entries
+                if len(entries) < min_evicted():
+                    return
+            text = await summarize(previous.text if previous else "", entries, max_tokens())
+        except Exception as exc:
+            self.failures += 1
+            print(f"warning: failed to summarize session {session_id}: {exc}")
+            return
+        covered_id = entries[-1]["id"]
+        tokens = tokenizer.count_tokens(PREFIX + text)
+        timestamp = datetime.now(timezone.utc).isoformat()
+
+        def upsert(c) -> None:
+            # never move backwards if an older fold finishes last
+            c.execute(
+                """
+                INSERT INTO session_summaries (session_id, user_id, summary, covered_id, token_count, updated_at)
+                VALUES (?, ?, ?, ?, ?, ?)
+                ON CONFLICT(session_id) DO UPDATE SET
+                    summary = excluded.summary,
+                    covered_id = excluded.covered_id,
+                    token_count = excluded.token_count,
+                    updated_at = excluded.updated_at
+                WHERE excluded.covered_id > session_summaries.covered_id
+                """,
+                (session_id, uid, text, covered_id, tokens, timestamp),
+            )
+
+        try:
+            await asyncio.wrap_future(writer.memory_writer.submit(path, upsert))
+        except Exception as exc:
+            self.failures += 1
+            print(f"warning: failed to store summary for session {session_id}: {exc}")
+            return
+        self.folds += 1
+
+    def wait(self, timeout: Optional[float] = None) -> None:
+        """Block until the folds scheduled so far are stored (tests, shutdown)."""
+        with self._lock:
+            pending = list(self._running.values())
+        for future in pending:
+            if future is None:
+                continue
+            try:
+                future.result(timeout)
+            except Exception:
+                pass
+
+    def close(self, timeout: float = 5.0) -> None:
+        self.wait(timeout)
+        with self._lock:
+            loop, self._loop = self._loop, None
+        if loop is not None:
+            loop.call_soon_threadsafe(loop.stop)
+
+
+folder = _Folder()
+
+
+def context_messages(newest_first: List[history.CachedEntry], summary: Optional[Summary], budget: int,
+                     session_id: str, uid) -> List[Dict]:
+    """Trimmed messages for a window, led by the session summary when there is one.
+
+    Schedules a fold once enough evicted messages are not yet summarized, or
+    when a full window may have pushed unsummarized rows out of sight.
+    """
+    reserve = summary.tokens if summary else 0
+    included, spanned = history.select_turns(newest_first, max(0, budget - reserve))
+    covered_id = summary.covered_id if summary else 0
+    # evicted entries are newest-first; fold oldest-first
+    pending = [entry for entry, _ in reversed(newest_first[spanned:]) if (entry.get("id") or 0) > covered_id]
+    oldest_id = (newest_first[-1][0].get("id") or 0) if newest_first else 0
+    # a full window that starts past the summary may hide rows no fold has seen
+    gap_before = oldest_id if len(newest_first) >= history.WINDOW_ROWS and oldest_id > covered_id else None
+    if gap_before is not None or len(pending) >= min_evicted():
+        folder.schedule(session_id, uid, summary, pending, gap_before)
+    messages = history.to_messages(included)
+    if summary:
+        messages.insert(0, as_message(summary))
+    return messages
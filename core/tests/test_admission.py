@@ -0,0 +1,93 @@
+import asyncio
+
+import pytest
+from fastapi import HTTPException
+
+from core import admission
+
+
+def test_token_bucket_rejects_with_retry_after(monkeypatch):
+    monkeypatch.setenv("ADMISSION_TOKENS_PER_MINUTE", "600")
+    monkeypatch.setenv("ADMISSION_TOKEN_BURST", "100")
+    monkeypatch.setenv("ADMISSION_MAX_WAIT", "1")
+    controller = admission.AdmissionController()
+    alice = {"id": 1, "role": "user"}
+
+    async def scenario():
+        ticket = await controller.admit(alice, 90)
+        ticket.release()
+        # 10 tokens left, 10/s refill: 200 more would take ~19s
+        with pytest.raises(HTTPException) as exc:
+            await controller.admit(alice, 200)
+        assert exc.value.status_code == 429
+        assert int(exc.value.headers["Retry-After"]) >= 19
+        # another user has their own bucket
+        (await controller.admit({"id": 2, "role": "user"}, 90)).release()
+        # settling refunds what the request did not use
+        ticket = await controller.admit({"id": 2, "role": "user"}, 10)
+        ticket.settle(0)
+        ticket.release()
+        (await controller.admit({"id": 2, "role": "user"}, 10)).release()
+
+    asyncio.run(scenario())
+    assert controller.stats()["rejected_rate"] == 1
+
+
+def test_concurrency_queue_is_weighted_and_times_out(monkeypatch):
+    monkeypatch.setenv("ADMISSION_MAX_CONCURRENCY", "1")
+    monkeypatch.setenv("ADMISSION_MAX_WAIT", "0.2")
+    controller = admission.AdmissionController()
+    order = []
+
+    async def request(user, tag):
+        ticket = await controller.admit(user, 10)
+        order.append(tag)
+        await asyncio.sleep(0.01)
+        ticket.release()
+
+    async def scenario():
+        holder = await controller.admit({"id": 1, "role": "user"}, 10)
+        # queued in arrival order user, user, admin; the admin's share is 4x
+        tasks = [
+            asyncio.create_task(request({"id": 2, "role": "user"}, "u1")),
+            asyncio.create_task(request({"id": 3, "role": "user"}, "u2")),
+            asyncio.create_task(request({"id": 4, "role": "admin"}, "a")),
+        ]
+        await asyncio.sleep(0.01)
+        assert controller.stats()["waiting"] == 3
+        holder.release()
+        await asyncio.gather(*tasks)
+
+        # a slot held past the deadline turns queued requests away with 503
+        holder = await controller.admit({"id": 1, "role": "user"}, 10)
+        with pytest.raises(HTTPException) as exc:
+            await controller.admit({"id": 2, "role": "user"}, 10)
+        assert exc.value.status_code == 503
+        assert exc.value.headers["Retry-After"] == "1"
+        holder.release()
+
+    asyncio.run(scenario())
+    assert order[0] == "a"
+    assert controller.stats() == {"inflight": 0, "waiting": 0, "rejected_rate": 0, "rejected_capacity": 1}
+
+
+def test_cancelled_rate_wait_refunds_its_tokens(monkeypatch):
+    monkeypatch.setenv("ADMISSION_TOKENS_PER_MINUTE", "600")
+    monkeypatch.setenv("ADMISSION_TOKEN_BURST", "100")
+    monkeypatch.setenv("ADMISSION_MAX_WAIT", "5")
+    controller = admission.AdmissionController()
+    alice = {"id": 1, "role": "user"}
+
+    async def scenario():
+        (await controller.admit(alice, 100)).release()
+        # each retry would wait ~3s for its 30 tokens; the client gives up first
+        for _ in range(3):
+            task = asyncio.create_task(controller.admit(alice, 30))
+            await asyncio.sleep(0.01)
+            task.cancel()
+            with pytest.raises(asyncio.CancelledError):
+                await task
+
+    asyncio.run(scenario())
+    # only the refill since the burst was spent, no debt from the abandoned waits
+    assert controller._buckets[1].tokens > -1
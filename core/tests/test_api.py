@@ -600,3 +600,417 @@ def test_login_rate_limit_reset_on_success(tmp_path, monkeypatch):
     assert r.status_code == 429
 
 
+
+
+def test_openai_proxy_uses_pooled_upstream_client(tmp_path, monkeypatch):
+    """Without mock mode the proxy calls upstream through the shared async client."""
+    import httpx
+    import json
+    import core.database as database
+    from core import upstream
+    db_file = tmp_path / "test_upstream.db"
+    monkeypatch.setattr(database, "DB_PATH", str(db_file))
+    monkeypatch.setenv("JWT_SECRET", "upsecret")
+    monkeypatch.delenv("MOCK_MODE", raising=False)
+    monkeypatch.setenv("OPENAI_API_KEY", "sk-test")
+    database.init_db()
+
+    seen = []
+
+    def handler(request: httpx.Request) -> httpx.Response:
+        seen.append(json.loads(request.content))
+        assert request.headers["Authorization"] == "Bearer sk-test"
+        return httpx.Response(200, json={"choices": [{"message": {"role": "assistant", "content": "upstream says hi"}}]})
+
+    monkeypatch.setattr(upstream, "_transport", httpx.MockTransport(handler))
+    monkeypatch.setattr(upstream, "_client", None)
+
+    from core.main import app
+    from core.auth import _login_attempts
+    _login_attempts.clear()
+    client = TestClient(app)
+    token = create_test_user(client)
+    auth_headers = {"Authorization": f"Bearer {token}"}
+
+    r = client.post("/api/openai/", json={"prompt": "hello upstream"}, headers={"X-Session-Id": "up-1", **auth_headers})
+    assert r.status_code == 200
+    body = r.json()
+    assert body["session_id"] == "up-1"
+    assert body["choices"][0]["message"]["content"] == "upstream says hi"
+    assert seen and seen[0]["messages"][-1]["content"] == "hello upstream"
+
+    mem = client.get("/memory/session/up-1/", headers=auth_headers).json()
+    assert any(m.get("role") == "assistant" and m.get("message") == "upstream says hi" for m in mem)
+
+
+def test_openai_mock_stream_relays_chunks_and_persists_reply(tmp_path, monkeypatch):
+    import json
+    import core.database as database
+    db_file = tmp_path / "test_stream_mock.db"
+    monkeypatch.setattr(database, "DB_PATH", str(db_file))
+    monkeypatch.setenv("JWT_SECRET", "streamsecret")
+    monkeypatch.setenv("MOCK_MODE", "1")
+    database.init_db()
+
+    from core.main import app
+    from core.auth import _login_attempts
+    _login_attempts.clear()
+    client = TestClient(app)
+    token = create_test_user(client)
+    auth_headers = {"Authorization": f"Bearer {token}"}
+
+    headers = {"X-Session-Id": "stream-1", **auth_headers}
+    with client.stream("POST", "/api/openai/", json={"prompt": "stream please", "stream": True}, headers=headers) as r:
+        assert r.status_code == 200
+        assert r.headers["content-type"].startswith("text/event-stream")
+        events = [line[len("data: "):] for line in r.iter_lines() if line.startswith("data: ")]
+
+    assert events[-1] == "[DONE]"
+    chunks = [json.loads(e) for e in events[:-1]]
+    text = "".join(c["choices"][0]["delta"].get("content", "") for c in chunks)
+    assert text == "MOCK_REPLY: reply to stream please"
+    assert len(chunks) > 2
+
+    mem = client.get("/memory/session/stream-1/", headers=auth_headers).json()
+    assert any(m.get("role") == "assistant" and m.get("message") == text for m in mem)
+
+
+def test_openai_upstream_stream_passthrough(tmp_path, monkeypatch):
+    import httpx
+    import json
+    import core.database as database
+    from core import upstream
+    db_file = tmp_path / "test_stream_up.db"
+    monkeypatch.setattr(database, "DB_PATH", str(db_file))
+    monkeypatch.setenv("JWT_SECRET", "streamsecret")
+    monkeypatch.delenv("MOCK_MODE", raising=False)
+    monkeypatch.setenv("OPENAI_API_KEY", "sk-test")
+    database.init_db()
+
+    def handler(request: httpx.Request) -> httpx.Response:
+        assert json.loads(request.content)["stream"] is True
+        body = "".join(
+            f"data: {json.dumps({'choices': [{'index': 0, 'delta': {'content': piece}}]})}\n\n"
+            for piece in ["Hej", " där"]
+        ) + "data: [DONE]\n\n"
+        return httpx.Response(200, content=body.encode(), headers={"content-type": "text/event-stream"})
+
+    monkeypatch.setattr(upstream, "_transport", httpx.MockTransport(handler))
+    monkeypatch.setattr(upstream, "_client", None)
+
+    from core.main import app
+    from core.auth import _login_attempts
+    _login_attempts.clear()
+    client = TestClient(app)
+    token = create_test_user(client)
+    auth_headers = {"Authorization": f"Bearer {token}"}
+
+    r = client.post("/api/openai/", json={"prompt": "hi", "stream": True}, headers={"X-Session-Id": "stream-2", **auth_headers})
+    assert r.status_code == 200
+    assert "data: [DONE]" in r.text
+
+    mem = client.get("/memory/session/stream-2/", headers=auth_headers).json()
+    assert any(m.get("role") == "assistant" and m.get("message") == "Hej där" for m in mem)
+
+
+def test_list_sessions_reports_stats_and_respects_ownership(tmp_path, monkeypatch):
+    import core.database as database
+    db_file = tmp_path / "test_sessions.db"
+    monkeypatch.setattr(database, "DB_PATH", str(db_file))
+    monkeypatch.setenv("JWT_SECRET", "sesssecret")
+    database.init_db()
+    from core.main import app
+    from core.auth import _login_attempts
+    _login_attempts.clear()
+    client = TestClient(app)
+
+    h1 = {"Authorization": f"Bearer {create_test_user(client, username='a', password='pa')}"}
+    h2 = {"Authorization": f"Bearer {create_test_user(client, username='b', password='pb')}"}
+
+    for msg in ["abcd", "abcdefgh"]:
+        r = client.post("/memory/save/", json={"session_id": "first", "role": "user", "message": msg}, headers=h1)
+        assert r.status_code == 200
+    client.post("/memory/save/", json={"session_id": "second", "role": "user", "message": "x"}, headers=h1)
+
+    listed = client.get("/memory/sessions/", headers=h1).json()
+    assert [s["session_id"] for s in listed] == ["second", "first"]
+    first = listed[1]
+    assert first["message_count"] == 2 and first["token_total"] == 3
+
+    # the cached owner rejects a foreign user without touching the session
+    r = client.post("/memory/save/", json={"session_id": "first", "role": "user", "message": "hijack"}, headers=h2)
+    assert r.status_code == 400
+    assert client.get("/memory/sessions/", headers=h2).json() == []
+    assert client.get("/memory/sessions/", headers=h1).json()[1]["message_count"] == 2
+
+
+def test_verified_token_cache_hits_and_expiry(monkeypatch):
+    import pytest
+    from fastapi import HTTPException
+    from core import auth
+    monkeypatch.setenv("JWT_SECRET", "cachesecret")
+    monkeypatch.setattr(auth, "_token_cache", auth._VerifiedTokenCache(2))
+
+    token = auth.create_access_token({"user_id": 7, "role": "user"})
+    assert auth.get_current_user(token) == {"id": 7, "role": "user"}
+    assert auth.get_current_user(token) == {"id": 7, "role": "user"}
+    stats = auth.token_cache_stats()
+    assert stats["hits"] == 1 and stats["misses"] == 1 and stats["size"] == 1
+
+    # rotating the secret invalidates cached verifications
+    monkeypatch.setenv("JWT_SECRET", "rotated")
+    with pytest.raises(HTTPException) as exc:
+        auth.get_current_user(token)
+    assert exc.value.status_code == 401
+
+    # entries do not outlive the token's exp claim
+    monkeypatch.setenv("JWT_SECRET", "cachesecret")
+    auth._token_cache.put(token, int(datetime.utcnow().timestamp()) - 10, {"id": 7, "role": "user"})
+    assert auth._token_cache.get(token) is None
+
+
+def test_login_sheds_load_and_rehashes_weak_hashes(tmp_path, monkeypatch):
+    import core.database as database
+    from core import passwords, writer
+    db_file = tmp_path / "test_bcrypt.db"
+    monkeypatch.setattr(database, "DB_PATH", str(db_file))
+    monkeypatch.setenv("JWT_SECRET", "bcryptsecret")
+    monkeypatch.setenv("BCRYPT_WORKERS", "0")
+    database.init_db()
+    from core.main import app
+    from core.auth import _login_attempts
+    _login_attempts.clear()
+    client = TestClient(app)
+
+    conn = database.get_db()
+    conn.execute(
+        "INSERT INTO users (username, password_hash, role, created_at) VALUES (?, ?, ?, ?)",
+        ("weak", passwords.hash_sync("pw", 4), "user", datetime.utcnow().isoformat()),
+    )
+    conn.commit()
+    conn.close()
+
+    # a saturated pool answers 503 with Retry-After instead of queueing
+    monkeypatch.setenv("BCRYPT_MAX_PENDING", "1")
+    monkeypatch.setattr(passwords.pool, "_pending", 1)
+    r = client.post("/auth/login", json={"username": "weak", "password": "pw"})
+    assert r.status_code == 503 and r.headers["Retry-After"] == "1"
+    monkeypatch.setattr(passwords.pool, "_pending", 0)
+
+    # a successful login upgrades the cost factor transparently
+    monkeypatch.setenv("BCRYPT_ROUNDS", "5")
+    r = client.post("/auth/login", json={"username": "weak", "password": "pw"})
+    assert r.status_code == 200
+    writer.memory_writer.flush(5)
+    conn = database.get_db()
+    stored = conn.execute("SELECT password_hash FROM users WHERE username = 'weak'").fetchone()[0]
+    conn.close()
+    assert passwords.hash_cost(stored) == 5 and passwords.check_sync("pw", stored)
+
+
+def test_deterministic_completions_are_cached_per_request_key(tmp_path, monkeypatch):
+    import httpx
+    import core.database as database
+    from core import completions, upstream
+    monkeypatch.setattr(database, "DB_PATH", str(tmp_path / "test_cache.db"))
+    monkeypatch.setenv("JWT_SECRET", "cachesecret")
+    monkeypatch.delenv("MOCK_MODE", raising=False)
+    monkeypatch.setenv("OPENAI_API_KEY", "sk-test")
+    monkeypatch.setenv("RESPONSE_CACHE_TTL", "60")
+    database.init_db()
+    calls = []
+
+    def handler(request: httpx.Request) -> httpx.Response:
+        calls.append(request)
+        return httpx.Response(200, json={"choices": [{"message": {"role": "assistant", "content": "cached hi"}}]})
+
+    monkeypatch.setattr(upstream, "_transport", httpx.MockTransport(handler))
+    monkeypatch.setattr(upstream, "_client", None)
+    monkeypatch.setattr(completions, "cache", completions.ResponseCache())
+
+    from core.main import app
+    from core.auth import _login_attempts
+    _login_attempts.clear()
+    client = TestClient(app)
+    auth_headers = {"Authorization": f"Bearer {create_test_user(client)}"}
+
+    body = {"prompt": "same question", "temperature": 0}
+    for sid in ("c-1", "c-2"):
+        r = client.post("/api/openai/", json=body, headers={"X-Session-Id": sid, **auth_headers})
+        assert r.status_code == 200
+        assert r.json()["session_id"] == sid
+    assert len(calls) == 1
+
+    # the on-disk tier answers once the in-memory LRU is gone
+    completions.cache.clear()
+    client.post("/api/openai/", json=body, headers={"X-Session-Id": "c-3", **auth_headers})
+    assert len(calls) == 1
+    # sampled requests always go upstream
+    client.post("/api/openai/", json={"prompt": "same question"}, headers={"X-Session-Id": "c-4", **auth_headers})
+    assert len(calls) == 2
+
+    # every session still got its own copy of the reply
+    for sid in ("c-1", "c-2", "c-3"):
+        mem = client.get(f"/memory/session/{sid}/", headers=auth_headers).json()
+        assert sorted(m["role"] for m in mem) == ["assistant", "user"]
+    stats = completions.cache.stats()
+    assert (stats["memory_hits"], stats["disk_hits"], stats["misses"]) == (1, 1, 1)
+
+
+def test_idempotency_key_replays_chat_and_save(tmp_path, monkeypatch):
+    import core.database as database
+    monkeypatch.setattr(database, "DB_PATH", str(tmp_path / "test_idem.db"))
+    monkeypatch.setenv("JWT_SECRET", "idemsecret")
+    monkeypatch.setenv("MOCK_MODE", "1")
+    database.init_db()
+    from core.main import app
+    from core.auth import _login_attempts
+    _login_attempts.clear()
+    client = TestClient(app)
+    auth_headers = {"Authorization": f"Bearer {create_test_user(client)}"}
+
+    headers = {"X-Session-Id": "idem-1", "Idempotency-Key": "retry-me", **auth_headers}
+    first = client.post("/api/openai/", json={"prompt": "only once"}, headers=headers)
+    again = client.post("/api/openai/", json={"prompt": "only once"}, headers=headers)
+    assert first.status_code == again.status_code == 200
+    assert again.json() == first.json()
+    assert again.headers["Idempotent-Replayed"] == "true"
+    assert "Idempotent-Replayed" not in first.headers
+    mem = client.get("/memory/session/idem-1/", headers=auth_headers).json()
+    assert len(mem) == 2
+
+    # the same key for a different request is refused
+    r = client.post("/api/openai/", json={"prompt": "something else"}, headers=headers)
+    assert r.status_code == 422
+
+    save = {"session_id": "idem-2", "role": "user", "message": "imported"}
+    for _ in range(2):
+        r = client.post("/memory/save/", json=save, headers={"Idempotency-Key": "row-1", **auth_headers})
+        assert r.status_code == 200
+    assert len(client.get("/memory/session/idem-2/", headers=auth_headers).json()) == 1
+
+
+def test_openai_batch_streams_ndjson_and_saves_once(tmp_path, monkeypatch):
+    import json
+    import core.database as database
+    monkeypatch.setattr(database, "DB_PATH", str(tmp_path / "test_batch.db"))
+    monkeypatch.setenv("JWT_SECRET", "batchsecret")
+    monkeypatch.setenv("MOCK_MODE", "1")
+    database.init_db()
+    from core.main import app
+    from core.auth import _login_attempts
+    _login_attempts.clear()
+    client = TestClient(app)
+    h1 = {"Authorization": f"Bearer {create_test_user(client, username='a', password='pa')}"}
+    h2 = {"Authorization": f"Bearer {create_test_user(client, username='b', password='pb')}"}
+
+    # history written earlier is part of the batch turn's context
+    client.post("/api/openai/", json={"prompt": "earlier"}, headers={"X-Session-Id": "b-1", **h1})
+    client.post("/memory/save/", json={"session_id": "theirs", "role": "user", "message": "x"}, headers=h2)
+
+    items = [{"session_id": "b-1", "prompt": "first"}, {"session_id": "b-2", "prompt": "second"},
+             {"session_id": "theirs", "prompt": "sneaky"}]
+    r = client.post("/api/openai/batch", json={"items": items}, headers=h1)
+    assert r.status_code == 200
+    assert r.headers["content-type"].startswith("application/x-ndjson")
+    lines = [json.loads(line) for line in r.text.splitlines()]
+    by_index = {line["index"]: line for line in lines if "index" in line}
+    assert by_index[0]["response"] == "MOCK_REPLY: reply to first"
+    assert [m["content"] for m in by_index[0]["messages"]][-1] == "first"
+    assert by_index[0]["messages"][0]["content"] == "earlier"
+    assert by_index[1]["session_id"] == "b-2"
+    assert by_index[2]["error"]["status"] == 400
+    assert lines[-1] == {"saved": 4}
+
+    mem = client.get("/memory/session/b-1/", headers=h1).json()
+    assert [m["message"] for m in mem][:2] == ["MOCK_REPLY: reply to first", "first"]
+    assert len(client.get("/memory/session/b-2/", headers=h1).json()) == 2
+    assert len(client.get("/memory/session/theirs/", headers=h2).json()) == 1
+
+
+def test_openai_batch_deadline_applies_per_item(tmp_path, monkeypatch):
+    import asyncio
+    import json
+    import core.database as database
+    from core import model_router
+    monkeypatch.setattr(database, "DB_PATH", str(tmp_path / "test_batch_deadline.db"))
+    monkeypatch.setenv("JWT_SECRET", "batchsecret")
+    monkeypatch.delenv("MOCK_MODE", raising=False)
+    monkeypatch.setenv("BATCH_CONCURRENCY", "1")
+    monkeypatch.setenv("REQUEST_TIMEOUT_MS", "300")
+    database.init_db()
+
+    async def slow_complete(payload):
+        await asyncio.sleep(0.1)
+        return {"choices": [{"message": {"role": "assistant", "content": "slow but fine"}}]}
+
+    monkeypatch.setattr(model_router.router, "complete", slow_complete)
+    from core.main import app
+    from core.auth import _login_attempts
+    _login_attempts.clear()
+    client = TestClient(app)
+    headers = {"Authorization": f"Bearer {create_test_user(client)}"}
+
+    # the whole batch takes ~0.6s, twice the per-request timeout
+    items = [{"session_id": f"slow-{i}", "prompt": f"p{i}"} for i in range(6)]
+    r = client.post("/api/openai/batch", json={"items": items}, headers=headers)
+    assert r.status_code == 200
+    lines = [json.loads(line) for line in r.text.splitlines()]
+    assert not [line for line in lines if "error" in line]
+    assert lines[-1] == {"saved": 12}
+
+
+def test_stream_dropped_before_first_chunk_releases_ticket_and_upstream(tmp_path, monkeypatch):
+    import asyncio
+    import httpx
+    import json
+    import core.database as database
+    from core import admission, upstream
+    monkeypatch.setattr(database, "DB_PATH", str(tmp_path / "test_stream_drop.db"))
+    monkeypatch.setenv("JWT_SECRET", "streamsecret")
+    monkeypatch.delenv("MOCK_MODE", raising=False)
+    monkeypatch.setenv("OPENAI_API_KEY", "sk-test")
+    database.init_db()
+
+    closed = []
+
+    class UpstreamBody(httpx.AsyncByteStream):
+        async def __aiter__(self):
+            yield b"data: [DONE]\n\n"
+
+        async def aclose(self):
+            closed.append(True)
+
+    def handler(request: httpx.Request) -> httpx.Response:
+        return httpx.Response(200, stream=UpstreamBody(), headers={"content-type": "text/event-stream"})
+
+    monkeypatch.setattr(upstream, "_transport", httpx.MockTransport(handler))
+    monkeypatch.setattr(upstream, "_client", None)
+    from core.main import app
+    from core.auth import _login_attempts
+    _login_attempts.clear()
+    token = create_test_user(TestClient(app))
+
+    body = json.dumps({"prompt": "hi", "stream": True}).encode()
+    scope = {
+        "type": "http", "asgi": {"version": "3.0", "spec_version": "2.4"}, "http_version": "1.1",
+        "method": "POST", "scheme": "http", "path": "/api/openai/", "raw_path": b"/api/openai/",
+        "query_string": b"", "root_path": "", "client": ("127.0.0.1", 5000), "server": ("testserver", 80),
+        "headers": [(b"host", b"testserver"), (b"content-type", b"application/json"),
+                    (b"authorization", f"Bearer {token}".encode()), (b"x-session-id", b"drop-1")],
+    }
+    messages = [{"type": "http.request", "body": body, "more_body": False}]
+
+    async def receive():
+        return messages.pop(0) if messages else {"type": "http.disconnect"}
+
+    async def send(message):
+        # the client is gone before anything reaches it
+        raise OSError("connection reset")
+
+    try:
+        asyncio.run(app(scope, receive, send))
+    except Exception:
+        pass
+    assert admission.controller.stats()["inflight"] == 0
+    assert closed
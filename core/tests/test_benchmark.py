@@ -0,0 +1,43 @@
+from core import benchmark
+
+
+def test_percentile_nearest_rank():
+    values = [float(v) for v in range(1, 101)]
+    assert benchmark.percentile(values, 50) == 50.0
+    assert benchmark.percentile(values, 99) == 99.0
+    assert benchmark.percentile([3.0], 95) == 3.0
+    assert benchmark.percentile([], 95) == 0.0
+
+
+def test_small_run_reports_every_level(tmp_path, monkeypatch):
+    # set up front so monkeypatch restores what the harness configures
+    monkeypatch.setenv("JWT_SECRET", "benchsecret")
+    monkeypatch.setenv("MOCK_MODE", "1")
+    monkeypatch.setenv("ADMISSION_TOKENS_PER_MINUTE", "1000000000")
+    monkeypatch.setenv("ADMISSION_TOKEN_BURST", "1000000000")
+    report = benchmark.run(
+        concurrency=(1, 2), duration=5, users=2, sessions_per_user=1, history_depth=4,
+        max_requests=6, db_path=str(tmp_path / "bench.db"),
+    )
+    for scenario in benchmark.SCENARIOS:
+        for level in ("1", "2"):
+            stats = report["results"][scenario][level]
+            assert stats["requests"] == 6
+            assert stats["errors"] == 0, stats["status"]
+            assert stats["p50_ms"] <= stats["p95_ms"] <= stats["p99_ms"]
+    # saves go through the write-behind writer and take the write lock
+    assert report["results"]["save"]["1"]["sqlite_lock"]["acquired"] >= 1
+    assert report["config"]["history_depth"] == 4
+
+
+def test_compare_flags_slowdowns_only_beyond_tolerance():
+    def report(p95, rps, errors=0):
+        return {"results": {"chat": {"8": {"p95_ms": p95, "rps": rps, "errors": errors}}}}
+
+    baseline = report(10.0, 100.0)
+    assert benchmark.compare(report(11.0, 95.0), baseline, 0.2) == []
+    regressions = benchmark.compare(report(20.0, 50.0, errors=2), baseline, 0.2)
+    assert len(regressions) == 3
+    assert regressions[0].startswith("chat@8: p95")
+    # levels missing from the baseline are not compared
+    assert benchmark.compare({"results": {"save": {"1": {"p95_ms": 99, "rps": 1, "errors": 0}}}}, baseline) == []
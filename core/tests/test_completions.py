@@ -0,0 +1,60 @@
+import asyncio
+
+import pytest
+
+from core import completions
+
+
+def test_request_key_is_canonical():
+    a = completions.request_key({"model": "m", "messages": [{"role": "user", "content": "hi"}], "temperature": 0, "max_tokens": 5})
+    b = completions.request_key({"max_tokens": 5, "temperature": 0, "messages": [{"content": "hi", "role": "user"}], "model": "m"})
+    assert a == b
+    assert a != completions.request_key({"model": "m", "messages": [], "temperature": 0, "max_tokens": 5})
+
+
+def test_singleflight_shares_one_call_and_its_errors():
+    flights = completions.SingleFlight()
+    calls = []
+
+    async def slow(value):
+        calls.append(value)
+        await asyncio.sleep(0.01)
+        if isinstance(value, Exception):
+            raise value
+        return {"answer": value}
+
+    async def scenario():
+        results = await asyncio.gather(*(flights.do("k", lambda: slow(1)) for _ in range(5)))
+        assert results == [{"answer": 1}] * 5
+        # each caller owns its copy
+        results[0]["answer"] = 2
+        assert results[1] == {"answer": 1}
+
+        outcomes = await asyncio.gather(
+            *(flights.do("e", lambda: slow(ValueError("boom"))) for _ in range(3)), return_exceptions=True
+        )
+        assert all(isinstance(o, ValueError) for o in outcomes)
+
+    asyncio.run(scenario())
+    assert len(calls) == 2
+    assert flights.coalesced == 6
+
+
+def test_singleflight_follower_retries_when_leader_is_cancelled():
+    flights = completions.SingleFlight()
+
+    async def scenario():
+        leader = asyncio.create_task(flights.do("k", lambda: asyncio.sleep(10)))
+        await asyncio.sleep(0)
+
+        async def quick():
+            return {"ok": True}
+
+        follower = asyncio.create_task(flights.do("k", quick))
+        await asyncio.sleep(0)
+        leader.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await leader
+        assert await follower == {"ok": True}
+
+    asyncio.run(scenario())
@@ -0,0 +1,100 @@
+import threading
+
+import core.database as database
+
+
+def test_get_db_reuses_tuned_connections(tmp_path, monkeypatch):
+    monkeypatch.setattr(database, "DB_PATH", str(tmp_path / "pool.db"))
+    monkeypatch.setenv("SQLITE_CACHE_SIZE", "-2000")
+    database.init_db()
+
+    conn = database.get_db()
+    raw = conn._conn
+    assert conn.execute("PRAGMA journal_mode").fetchone()[0] == "wal"
+    assert conn.execute("PRAGMA synchronous").fetchone()[0] == 1  # NORMAL
+    assert conn.execute("PRAGMA cache_size").fetchone()[0] == -2000
+    conn.close()
+
+    again = database.get_db()
+    assert again._conn is raw
+    # a second concurrent borrower gets its own connection
+    other = database.get_db()
+    assert other._conn is not raw
+    again.close()
+    other.close()
+
+
+def test_release_rolls_back_unfinished_transactions(tmp_path, monkeypatch):
+    monkeypatch.setattr(database, "DB_PATH", str(tmp_path / "pool.db"))
+    database.init_db()
+
+    conn = database.get_db()
+    conn.execute("INSERT INTO users (username) VALUES ('ghost')")
+    conn.close()
+    conn.close()  # double close is harmless
+
+    conn = database.get_db()
+    assert conn.execute("SELECT COUNT(*) FROM users").fetchone()[0] == 0
+    conn.close()
+
+
+def test_connections_can_move_between_threads(tmp_path, monkeypatch):
+    monkeypatch.setattr(database, "DB_PATH", str(tmp_path / "pool.db"))
+    database.init_db()
+    database.get_db().close()
+
+    errors = []
+
+    def use():
+        try:
+            conn = database.get_db()
+            conn.execute("SELECT 1").fetchone()
+            conn.close()
+        except Exception as exc:  # pragma: no cover - reported below
+            errors.append(exc)
+
+    t = threading.Thread(target=use)
+    t.start()
+    t.join()
+    assert errors == []
+    database.close_all()
+
+
+def test_init_db_migrates_legacy_memory_table(tmp_path, monkeypatch):
+    import sqlite3
+    from core import migrations
+    db_file = tmp_path / "legacy.db"
+    # the schema shipped in knowledge/brainforce.db: no user_id, no users table
+    conn = sqlite3.connect(db_file)
+    conn.execute(
+        "CREATE TABLE memory (id INTEGER PRIMARY KEY AUTOINCREMENT, session_id TEXT,"
+        " role TEXT, message TEXT, timestamp TEXT)"
+    )
+    conn.execute("INSERT INTO memory (session_id, role, message) VALUES ('s', 'user', 'hello there')")
+    conn.commit()
+    conn.close()
+
+    monkeypatch.setattr(database, "DB_PATH", str(db_file))
+    database.init_db()
+    database.init_db()  # re-running is a no-op
+
+    conn = database.get_db()
+    try:
+        assert migrations.current_version(conn) == migrations.LATEST_VERSION
+        cols = {r[1] for r in conn.execute("PRAGMA table_info(memory)")}
+        assert {"user_id", "token_count"} <= cols
+        assert conn.execute("SELECT token_count FROM memory").fetchone()[0] == 3
+        session = conn.execute("SELECT message_count, token_total FROM sessions WHERE session_id = 's'").fetchone()
+        assert tuple(session) == (1, 3)
+
+        def plan(sql, params):
+            return " | ".join(r[3] for r in conn.execute("EXPLAIN QUERY PLAN " + sql, params))
+
+        session_plan = plan(
+            "SELECT * FROM memory WHERE session_id = ? AND user_id = ? ORDER BY id DESC LIMIT 200", ("s", 1)
+        )
+        user_plan = plan("SELECT * FROM memory WHERE user_id = ? ORDER BY id DESC LIMIT 200", (1,))
+        assert "idx_memory_session_user" in session_plan and "TEMP B-TREE" not in session_plan
+        assert "idx_memory_user" in user_plan and "TEMP B-TREE" not in user_plan
+    finally:
+        conn.close()
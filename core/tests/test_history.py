@@ -0,0 +1,118 @@
+from core import history
+
+
+def _rows(*pairs):
+    """Build newest-first memory rows from (role, message) pairs given oldest-first."""
+    rows = [{"id": i + 1, "role": role, "message": msg} for i, (role, msg) in enumerate(pairs)]
+    return list(reversed(rows))
+
+
+def test_trim_keeps_newest_user_and_whole_turns():
+    rows = _rows(
+        ("user", "a" * 400),        # 100 tokens
+        ("assistant", "b" * 400),   # 100 tokens
+        ("user", "c" * 40),         # 10 tokens
+        ("assistant", "d" * 40),    # 10 tokens
+        ("user", "e" * 800),        # 200 tokens, newest
+    )
+    window = [history.to_cached(r) for r in rows]
+
+    # budget too small for the newest prompt: it is still included on its own
+    assert [m["content"][0] for m in history.trim_to_budget(window, 50)] == ["e"]
+    # room for one more whole turn but not the oldest one
+    assert [m["content"][0] for m in history.trim_to_budget(window, 250)] == ["c", "d", "e"]
+    assert [m["content"][0] for m in history.trim_to_budget(window, 1000)] == ["a", "b", "c", "d", "e"]
+
+
+def test_cache_loads_once_and_writes_through():
+    cache = history.HistoryCache(max_bytes=1024 * 1024)
+    calls = []
+
+    def loader():
+        calls.append(1)
+        return _rows(("user", "hi"), ("assistant", "hello"))
+
+    key = ("db", 1, "s1")
+    assert [e["message"] for e, _ in cache.get_or_load(key, loader)] == ["hello", "hi"]
+    cache.append(key, {"id": 3, "role": "user", "message": "again"})
+    window = cache.get_or_load(key, loader)
+    assert [e["message"] for e, _ in window] == ["again", "hello", "hi"]
+    assert window[0][1] == history.estimate_tokens("again")
+    assert len(calls) == 1
+    assert cache.hits == 1 and cache.misses == 1
+
+
+def test_cache_evicts_least_recently_used_sessions_by_bytes():
+    cache = history.HistoryCache(max_bytes=2500)
+    big = [{"id": 1, "role": "user", "message": "x" * 1000}]
+    cache.get_or_load(("db", 1, "old"), lambda: big)
+    cache.get_or_load(("db", 1, "new"), lambda: big)
+    # touch "old" so "new" becomes least recently used, then add a third session
+    cache.get_or_load(("db", 1, "old"), lambda: big)
+    cache.get_or_load(("db", 1, "third"), lambda: big)
+
+    calls = []
+    cache.get_or_load(("db", 1, "old"), lambda: calls.append("old") or big)
+    cache.get_or_load(("db", 1, "new"), lambda: calls.append("new") or big)
+    assert calls == ["new"]
+
+
+def test_sql_trimming_matches_python_trimming(tmp_path, monkeypatch):
+    import random
+    import core.database as database
+    from core import memory
+    from core.memory import MemorySave
+    monkeypatch.setattr(database, "DB_PATH", str(tmp_path / "trim.db"))
+    database.init_db()
+    # disable the cache so get_trimmed_messages takes the SQL path
+    monkeypatch.setattr(history, "cache", history.HistoryCache(max_bytes=0))
+
+    rng = random.Random(4)
+    user = {"id": 1, "role": "user"}
+    kept = 0
+    for n in range(12):
+        session = f"s{n}"
+        rows = rng.randint(1, 40)
+        for _ in range(rows):
+            memory.store_memory(
+                MemorySave(
+                    session_id=session,
+                    role=rng.choice(["user", "user", "assistant", "assistant", "system", "User"]),
+                    message=rng.choice(["", "k" * rng.randint(1, 600)]),
+                ),
+                current_user=user,
+            ).result()
+        window = [history.to_cached(r) for r in memory.get_all_memory(session_id=session, current_user=user)]
+        assert len(window) == rows
+        for budget in (0, 40, 300, 1500, 100000):
+            expected = history.trim_to_budget(window, budget)
+            assert memory.get_trimmed_messages(session, user, budget) == expected
+            kept += len(expected)
+    assert kept
+
+
+def test_init_db_backfills_token_count(tmp_path, monkeypatch):
+    import sqlite3
+    import core.database as database
+    db_file = tmp_path / "old.db"
+    conn = sqlite3.connect(db_file)
+    conn.execute(
+        "CREATE TABLE memory (id INTEGER PRIMARY KEY AUTOINCREMENT, session_id TEXT, user_id INTEGER,"
+        " role TEXT, message TEXT, timestamp TEXT)"
+    )
+    conn.executemany(
+        "INSERT INTO memory (session_id, user_id, role, message) VALUES ('s', 1, 'user', ?)",
+        [("x" * n,) for n in range(12)] + [(None,)],
+    )
+    conn.commit()
+    conn.close()
+
+    from core import migrations
+    monkeypatch.setattr(migrations, "BACKFILL_CHUNK_ROWS", 5)
+    monkeypatch.setattr(database, "DB_PATH", str(db_file))
+    database.init_db()
+
+    conn = sqlite3.connect(db_file)
+    rows = conn.execute("SELECT message, token_count FROM memory").fetchall()
+    conn.close()
+    assert rows and all(tc == history.estimate_tokens(msg or "") for msg, tc in rows)
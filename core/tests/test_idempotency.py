@@ -0,0 +1,44 @@
+import asyncio
+
+from fastapi.responses import JSONResponse
+
+import core.database as database
+from core import idempotency, writer
+
+
+def test_retry_attaches_to_running_attempt_and_failures_release_key(tmp_path, monkeypatch):
+    monkeypatch.setattr(database, "DB_PATH", str(tmp_path / "idem.db"))
+    database.init_db()
+    user = {"id": 7}
+    calls = []
+
+    async def work():
+        calls.append(1)
+        await asyncio.sleep(0.05)
+        return {"answer": len(calls)}
+
+    async def fail():
+        calls.append(1)
+        raise ValueError("upstream down")
+
+    async def scenario():
+        fp = idempotency.fingerprint("same")
+        first, second = await asyncio.gather(
+            idempotency.run("t", "k1", user, fp, work),
+            idempotency.run("t", "k1", user, fp, work),
+        )
+        assert first == {"answer": 1}
+        assert isinstance(second, JSONResponse) and second.headers["Idempotent-Replayed"] == "true"
+        # keys are per user
+        assert await idempotency.run("t", "k1", {"id": 8}, fp, work) == {"answer": 2}
+
+        try:
+            await idempotency.run("t", "k2", user, fp, fail)
+        except ValueError:
+            pass
+        writer.memory_writer.flush()
+        # the failed attempt did not keep the key
+        assert await idempotency.run("t", "k2", user, fp, work) == {"answer": 4}
+
+    asyncio.run(scenario())
+    assert len(calls) == 4
@@ -32,3 +32,89 @@ def test_save_and_get_memory(tmp_path, monkeypatch):
     assert r.status_code == 200
     data = r.json()
     assert isinstance(data, list) and any(item.get("message") == "hello" for item in data)
+
+
+def _seeded_client(tmp_path, monkeypatch, rows: int):
+    import core.database as database
+    monkeypatch.setattr(database, "DB_PATH", str(tmp_path / "paging.db"))
+    monkeypatch.setenv("JWT_SECRET", "pagesecret")
+    database.init_db()
+    from core.main import app
+    from core.auth import _login_attempts
+    from core.tests.test_api import create_test_user
+    _login_attempts.clear()
+    client = TestClient(app)
+    token = create_test_user(client, "pager", "pw")
+    headers = {"Authorization": f"Bearer {token}"}
+    conn = database.get_db()
+    uid = conn.execute("SELECT id FROM users WHERE username = 'pager'").fetchone()[0]
+    conn.executemany(
+        "INSERT INTO memory (session_id, user_id, role, message, timestamp, token_count) VALUES (?, ?, 'user', ?, '', 1)",
+        [("a" if i % 2 else "b", uid, f"m{i}") for i in range(rows)],
+    )
+    # someone else's row must never show up
+    conn.execute("INSERT INTO memory (session_id, user_id, role, message, timestamp) VALUES ('x', ?, 'user', 'theirs', '')", (uid + 1,))
+    conn.execute("INSERT INTO sessions (session_id, user_id, created_at, last_active) VALUES ('x', ?, '', '')", (uid + 1,))
+    conn.commit()
+    conn.close()
+    return client, headers
+
+
+def test_all_memory_keyset_pages(tmp_path, monkeypatch):
+    client, headers = _seeded_client(tmp_path, monkeypatch, 25)
+
+    seen, before = [], None
+    while True:
+        params = {"limit": 10, **({"before_id": before} if before else {})}
+        page = client.get("/memory/all/", params=params, headers=headers).json()
+        if not page:
+            break
+        ids = [row["id"] for row in page]
+        assert ids == sorted(ids, reverse=True)
+        seen.extend(page)
+        before = ids[-1]
+    assert [row["message"] for row in seen] == [f"m{i}" for i in reversed(range(25))]
+
+    oldest = seen[-1]["id"]
+    newer = client.get("/memory/all/", params={"after_id": oldest, "limit": 3}, headers=headers).json()
+    assert [row["id"] for row in newer] == [oldest + 3, oldest + 2, oldest + 1]
+
+    session_page = client.get("/memory/all/", params={"session_id": "a", "before_id": seen[0]["id"], "limit": 5}, headers=headers).json()
+    assert len(session_page) == 5 and {row["session_id"] for row in session_page} == {"a"}
+
+
+def test_export_streams_ndjson_in_chunks(tmp_path, monkeypatch):
+    import json
+    monkeypatch.setenv("MEMORY_EXPORT_CHUNK", "4")
+    client, headers = _seeded_client(tmp_path, monkeypatch, 11)
+
+    r = client.get("/memory/export/", headers=headers)
+    assert r.status_code == 200
+    assert r.headers["content-type"].startswith("application/x-ndjson")
+    rows = [json.loads(line) for line in r.text.splitlines()]
+    assert [row["message"] for row in rows] == [f"m{i}" for i in range(11)]
+
+    resumed = client.get("/memory/export/", params={"after_id": rows[7]["id"], "session_id": "a"}, headers=headers)
+    assert [json.loads(line)["message"] for line in resumed.text.splitlines()] == ["m9"]
+
+
+def test_save_batch_returns_ids_in_order(tmp_path, monkeypatch):
+    client, headers = _seeded_client(tmp_path, monkeypatch, 0)
+    items = [{"session_id": "imp-1" if i < 3 else "imp-2", "role": "user", "message": f"t{i}"} for i in range(5)]
+
+    r = client.post("/memory/save_batch/", json={"items": items}, headers=headers)
+    assert r.status_code == 200
+    ids = r.json()["ids"]
+    assert len(ids) == 5 and ids == sorted(ids)
+    rows = client.get("/memory/all/", params={"limit": 10}, headers=headers).json()
+    assert {row["id"]: row["message"] for row in rows} == {ids[i]: f"t{i}" for i in range(5)}
+    sessions = {s["session_id"]: s["message_count"] for s in client.get("/memory/sessions/", headers=headers).json()}
+    assert sessions["imp-1"] == 3 and sessions["imp-2"] == 2
+
+    # a session owned by someone else rejects the whole batch
+    r = client.post("/memory/save_batch/", json={"items": items + [{"session_id": "x", "message": "no"}]}, headers=headers)
+    assert r.status_code == 400
+    assert len(client.get("/memory/all/", params={"limit": 50}, headers=headers).json()) == 5
+
+    monkeypatch.setenv("MEMORY_BATCH_MAX_ITEMS", "2")
+    assert client.post("/memory/save_batch/", json={"items": items}, headers=headers).status_code == 413
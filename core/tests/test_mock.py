@@ -0,0 +1,91 @@
+import json
+
+import pytest
+from fastapi.testclient import TestClient
+
+from core import mock
+from core.tests.test_api import create_test_user
+
+AUTH = {"Authorization": "Bearer fake"}
+
+
+@pytest.fixture
+def fake(monkeypatch):
+    for name in ("MOCK_UPSTREAM_LATENCY", "MOCK_UPSTREAM_429_RATE", "MOCK_UPSTREAM_ERROR_RATE"):
+        monkeypatch.delenv(name, raising=False)
+    client = TestClient(mock.create_app())
+    yield client
+    mock._overrides.clear()
+
+
+def test_latency_specs():
+    assert mock.latency_sampler("fixed:20")() == 0.02
+    assert 0.01 <= mock.latency_sampler("uniform:10:30")() <= 0.03
+    assert mock.latency_sampler("normal:5:100")() >= 0.0
+    for bad in ("gamma:1", "uniform:1", "fixed:x"):
+        with pytest.raises(ValueError):
+            mock.latency_sampler(bad)
+
+
+def test_fake_completion_has_usage(fake):
+    body = {"model": "gpt-4o", "messages": [{"role": "user", "content": "hello there"}]}
+    r = fake.post("/v1/chat/completions", json=body, headers=AUTH)
+    assert r.status_code == 200
+    data = r.json()
+    assert data["object"] == "chat.completion"
+    assert data["choices"][0]["message"]["content"] == "MOCK_REPLY: reply to hello there"
+    usage = data["usage"]
+    assert usage["total_tokens"] == usage["prompt_tokens"] + usage["completion_tokens"] > 0
+
+    assert fake.post("/v1/chat/completions", json=body).status_code == 401
+    assert fake.post("/v1/chat/completions", json={"messages": []}, headers=AUTH).status_code == 400
+
+
+def test_fake_stream_and_usage_chunk(fake):
+    body = {"messages": [{"role": "user", "content": "stream it"}], "stream": True,
+            "stream_options": {"include_usage": True}}
+    with fake.stream("POST", "/v1/chat/completions", json=body, headers=AUTH) as r:
+        events = [line[6:] for line in r.iter_lines() if line.startswith("data: ")]
+    assert events[-1] == "[DONE]"
+    chunks = [json.loads(e) for e in events[:-1]]
+    text = "".join(c["choices"][0]["delta"].get("content", "") for c in chunks if c["choices"])
+    assert text == "MOCK_REPLY: reply to stream it"
+    assert chunks[-1]["usage"]["completion_tokens"] > 0
+
+
+def test_control_injects_rate_limits(fake):
+    assert fake.post("/_control", json={"MOCK_UPSTREAM_429_RATE": 1, "MOCK_UPSTREAM_RETRY_AFTER": 3}).status_code == 200
+    r = fake.post("/v1/chat/completions", json={"messages": [{"role": "user", "content": "x"}]}, headers=AUTH)
+    assert r.status_code == 429 and r.headers["retry-after"] == "3"
+    assert fake.post("/_control", json={"OTHER": 1}).status_code == 400
+    assert fake.post("/_control", json={"MOCK_UPSTREAM_LATENCY": "nope:1"}).status_code == 400
+    fake.delete("/_control")
+    r = fake.post("/v1/chat/completions", json={"messages": [{"role": "user", "content": "x"}]}, headers=AUTH)
+    assert r.status_code == 200
+
+
+def test_proxy_runs_real_path_against_fake_upstream(tmp_path, monkeypatch, fake):
+    import httpx
+    import core.database as database
+    from core import upstream
+    monkeypatch.setattr(database, "DB_PATH", str(tmp_path / "fake_upstream.db"))
+    monkeypatch.setenv("JWT_SECRET", "fakesecret")
+    monkeypatch.delenv("MOCK_MODE", raising=False)
+    monkeypatch.setenv("OPENAI_API_KEY", "sk-fake")
+    monkeypatch.setenv("OPENAI_BASE_URL", "http://fake-upstream/v1/")
+    monkeypatch.setattr(upstream, "_transport", httpx.ASGITransport(app=mock.create_app()))
+    monkeypatch.setattr(upstream, "_client", None)
+    database.init_db()
+    assert upstream.chat_url() == "http://fake-upstream/v1/chat/completions"
+
+    from core.main import app
+    from core.auth import _login_attempts
+    _login_attempts.clear()
+    client = TestClient(app)
+    token = create_test_user(client)
+    headers = {"Authorization": f"Bearer {token}", "X-Session-Id": "via-fake"}
+
+    r = client.post("/api/openai/", json={"prompt": "through the wire"}, headers=headers)
+    assert r.status_code == 200
+    assert r.json()["choices"][0]["message"]["content"] == "MOCK_REPLY: reply to through the wire"
+    assert r.json()["usage"]["total_tokens"] > 0
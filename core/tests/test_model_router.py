@@ -0,0 +1,95 @@
+import asyncio
+
+import pytest
+from fastapi import HTTPException
+
+from core import model_router
+from core.model_router import OfflineBackend, Router
+
+PAYLOAD = {"model": "gpt-4o-mini", "messages": [{"role": "user", "content": "hi"}], "temperature": 0, "max_tokens": 5}
+
+
+def test_policies_order_capable_backends(monkeypatch):
+    slow, fast = OfflineBackend("slow"), OfflineBackend("fast")
+    router = Router([slow, fast])
+    slow.stats.record(0.5, True)
+    fast.stats.record(0.1, True)
+
+    monkeypatch.setenv("MODEL_ROUTING_POLICY", "fastest")
+    assert [b.name for b, _ in router.candidates("m")] == ["fast", "slow"]
+    # errors make a fast backend look slower
+    for _ in range(10):
+        fast.stats.record(0.1, False)
+    assert [b.name for b, _ in router.candidates("m")] == ["slow", "fast"]
+
+    monkeypatch.setenv("MODEL_ROUTING_POLICY", "cheapest")
+    monkeypatch.setenv("COST_PER_1K_SLOW", "2")
+    monkeypatch.setenv("COST_PER_1K_FAST", "0.5")
+    assert [b.name for b, _ in router.candidates("m")] == ["fast", "slow"]
+
+    # an explicit backend prefix pins the backend and strips the prefix
+    assert [(b.name, m) for b, m in router.candidates("slow/llama3")] == [("slow", "llama3")]
+
+
+def test_openai_backend_passes_through_unclaimed_models(monkeypatch):
+    monkeypatch.setenv("OPENAI_API_KEY", "sk-test")
+    monkeypatch.setenv("MODEL_BACKENDS", "openai,offline")
+    monkeypatch.setenv("MODEL_ROUTING_POLICY", "capability")
+    router = Router()
+    assert [b.name for b, _ in router.candidates("gpt-4o-mini")] == ["openai", "offline"]
+    # fine-tunes and unknown families still reach OpenAI, as before routing existed
+    assert [b.name for b, _ in router.candidates("ft:gpt-4o-mini:acme::abc123")] == ["openai", "offline"]
+    monkeypatch.setenv("MODEL_BACKENDS", "openai")
+    assert [b.name for b, _ in router.candidates("text-embedding-3-small")] == ["openai"]
+
+    # a model another backend serves natively is not sent to OpenAI
+    monkeypatch.setenv("MODEL_BACKENDS", "openai,ollama")
+    monkeypatch.setenv("OLLAMA_HOST", "http://ollama.invalid:11434")
+    monkeypatch.setenv("OLLAMA_MODELS", "mistral")
+    assert [b.name for b, _ in router.candidates("mistral")] == ["ollama"]
+
+
+def test_hedged_request_takes_the_faster_answer(monkeypatch):
+    monkeypatch.setenv("ROUTER_HEDGE", "1")
+    monkeypatch.setenv("ROUTER_HEDGE_MIN_SAMPLES", "5")
+    monkeypatch.setenv("MODEL_ROUTING_POLICY", "capability")
+    primary, backup = OfflineBackend("primary", latency=5.0), OfflineBackend("backup")
+    for _ in range(5):
+        primary.stats.record(0.02, True)
+    router = Router([primary, backup])
+
+    async def scenario():
+        started = asyncio.get_running_loop().time()
+        result = await router.complete(PAYLOAD)
+        assert asyncio.get_running_loop().time() - started < 1.0
+        return result
+
+    result = asyncio.run(scenario())
+    assert result["choices"][0]["message"]["content"] == "[Offline mode] hi"
+    assert router.hedges == 1
+    # the cancelled loser is not counted as a failure
+    assert primary.stats.requests == 5 and backup.stats.requests == 1
+
+
+def test_proxy_routes_to_offline_backend_without_api_key(tmp_path, monkeypatch):
+    from fastapi.testclient import TestClient
+    import core.database as database
+    from core.tests.test_api import create_test_user
+    monkeypatch.setattr(database, "DB_PATH", str(tmp_path / "router.db"))
+    monkeypatch.setenv("JWT_SECRET", "routersecret")
+    monkeypatch.delenv("MOCK_MODE", raising=False)
+    monkeypatch.delenv("OPENAI_API_KEY", raising=False)
+    monkeypatch.setenv("MODEL_BACKENDS", "offline")
+    monkeypatch.setattr(model_router, "router", Router())
+    database.init_db()
+    from core.main import app
+    from core.auth import _login_attempts
+    _login_attempts.clear()
+    client = TestClient(app)
+    auth_headers = {"Authorization": f"Bearer {create_test_user(client)}"}
+
+    r = client.post("/api/openai/", json={"prompt": "are you there"}, headers={"X-Session-Id": "off-1", **auth_headers})
+    assert r.status_code == 200
+    assert r.json()["choices"][0]["message"]["content"] == "[Offline mode] are you there"
+    mem = client.get("/memory/session/off-1/", headers=auth_headers).json()
+    assert any(m["role"] == "assistant" for m in mem)
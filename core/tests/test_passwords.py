@@ -0,0 +1,34 @@
+import asyncio
+import time
+
+from core import passwords
+
+
+def _slow_check(password, hashed):
+    time.sleep(0.2)
+    return passwords.check_sync(password, hashed)
+
+
+def test_inline_mode_keeps_bcrypt_off_the_event_loop(monkeypatch):
+    monkeypatch.setenv("BCRYPT_WORKERS", "0")
+    pool = passwords._BcryptPool()
+    hashed = passwords.hash_sync("pw", 4)
+    ticks = []
+
+    async def ticker():
+        for _ in range(5):
+            ticks.append(time.monotonic())
+            await asyncio.sleep(0.01)
+
+    async def scenario():
+        check = asyncio.wrap_future(pool.submit(_slow_check, "pw", hashed))
+        await ticker()
+        # the loop kept ticking while the check was still running
+        assert not check.done()
+        return await check
+
+    assert asyncio.run(scenario()) is True
+    assert len(ticks) == 5 and pool._pending == 0
+
+    # outside an event loop the work still runs inline
+    assert pool.submit(passwords.check_sync, "nope", hashed).result(0) is False
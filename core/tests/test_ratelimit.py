@@ -0,0 +1,80 @@
+import core.database as database
+from core import ratelimit
+
+
+def test_sliding_window_counts_are_shared_and_weighted(tmp_path, monkeypatch):
+    monkeypatch.setattr(database, "DB_PATH", str(tmp_path / "rl.db"))
+    database.init_db()
+    clock = [1000.0]
+    monkeypatch.setattr(ratelimit.time, "time", lambda: clock[0])
+
+    a = ratelimit.SlidingWindowLimiter("api", limit=3, window=10)
+    # a second limiter object (e.g. in another worker) sees the same counters
+    b = ratelimit.SlidingWindowLimiter("api", limit=3, window=10)
+    for _ in range(3):
+        assert a.allow("1.2.3.4")
+        a.hit("1.2.3.4")
+    assert not b.allow("1.2.3.4")
+    assert b.allow("5.6.7.8")
+
+    # halfway through the next window half of the previous count still applies
+    clock[0] = 1015.0
+    assert b.count("1.2.3.4") == 2
+    # two windows later the key is forgotten
+    clock[0] = 1030.0
+    assert b.count("1.2.3.4") == 0
+
+    a.hit("1.2.3.4")
+    a.reset("1.2.3.4")
+    assert a.count("1.2.3.4") == 0
+
+
+def test_memory_is_bounded_by_slots(tmp_path, monkeypatch):
+    monkeypatch.setattr(database, "DB_PATH", str(tmp_path / "rl.db"))
+    database.init_db()
+    limiter = ratelimit.SlidingWindowLimiter("login", limit=5, window=300, slots=16)
+    for i in range(500):
+        limiter.hit(f"10.0.{i // 256}.{i % 256}")
+
+    conn = database.get_db()
+    rows = conn.execute("SELECT COUNT(*) FROM rate_limits WHERE scope = 'login'").fetchone()[0]
+    conn.close()
+    assert rows <= 16
+    limiter.clear()
+    assert limiter.count("10.0.0.1") == 0
+
+
+def test_colliding_keys_keep_separate_counters(tmp_path, monkeypatch):
+    monkeypatch.setattr(database, "DB_PATH", str(tmp_path / "rl.db"))
+    database.init_db()
+    # a single set of two slots: every key collides
+    limiter = ratelimit.SlidingWindowLimiter("login", limit=3, window=300, slots=2, ways=2)
+    for _ in range(3):
+        limiter.hit("victim")
+    limiter.hit("attacker")
+    assert not limiter.allow("victim")
+    assert limiter.count("attacker") == 1
+
+    # resetting one key leaves the other's counter alone
+    limiter.reset("attacker")
+    assert limiter.count("attacker") == 0
+    assert limiter.count("victim") == 3
+    limiter.reset("victim")
+    assert limiter.allow("victim")
+
+
+def test_full_set_evicts_least_recently_hit_key(tmp_path, monkeypatch):
+    monkeypatch.setattr(database, "DB_PATH", str(tmp_path / "rl.db"))
+    database.init_db()
+    clock = [1000.0]
+    monkeypatch.setattr(ratelimit.time, "time", lambda: clock[0])
+    limiter = ratelimit.SlidingWindowLimiter("login", limit=5, window=300, slots=2, ways=2)
+    limiter.hit("old")
+    clock[0] += 1
+    limiter.hit("recent")
+    clock[0] += 1
+    # junk keys flooding the set never lock anyone out, they only forget hits
+    limiter.hit("junk")
+    assert limiter.count("old") == 0
+    assert limiter.count("recent") == 1
+    assert limiter.count("junk") == 1
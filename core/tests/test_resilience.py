@@ -0,0 +1,100 @@
+import asyncio
+
+import pytest
+from fastapi import HTTPException
+
+from core import model_router, resilience
+from core.model_router import Backend, OfflineBackend, Router
+
+PAYLOAD = {"model": "m", "messages": [{"role": "user", "content": "hi"}], "temperature": 0, "max_tokens": 5}
+
+
+class Flaky(Backend):
+    def __init__(self, name, failures, status=503, retry_after=None):
+        super().__init__()
+        self.name = name
+        self.failures = failures
+        self.status = status
+        self.retry_after = retry_after
+        self.calls = 0
+
+    async def _complete(self, payload):
+        self.calls += 1
+        if self.calls <= self.failures:
+            headers = {"Retry-After": self.retry_after} if self.retry_after else None
+            raise HTTPException(status_code=self.status, detail="unavailable", headers=headers)
+        return {"choices": [{"message": {"role": "assistant", "content": self.name}}]}
+
+
+def test_breaker_opens_fails_fast_and_recovers_after_probe(monkeypatch):
+    monkeypatch.setenv("BREAKER_FAILURES", "2")
+    monkeypatch.setenv("BREAKER_COOLDOWN", "0.05")
+    breaker = resilience.CircuitBreaker()
+    for _ in range(2):
+        assert breaker.allow()
+        breaker.record(False)
+    assert breaker.state == "open" and not breaker.allow()
+
+    asyncio.run(asyncio.sleep(0.06))
+    # one probe at a time while half open
+    assert breaker.allow() and not breaker.allow()
+    breaker.record(True)
+    assert breaker.state == "closed" and breaker.allow()
+
+
+def test_router_retries_within_budget_and_fails_over(monkeypatch):
+    monkeypatch.setenv("RETRY_BASE_DELAY_MS", "1")
+    monkeypatch.setenv("BREAKER_FAILURES", "2")
+    monkeypatch.setenv("MODEL_ROUTING_POLICY", "capability")
+    monkeypatch.setattr(resilience, "budget", resilience.RetryBudget())
+
+    # Retry-After from the upstream is honored, then the retry succeeds
+    flaky = Flaky("flaky", failures=1, status=429, retry_after="0")
+    router = Router([flaky])
+    assert asyncio.run(router.complete(PAYLOAD))["choices"][0]["message"]["content"] == "flaky"
+    assert flaky.calls == 2 and router.retries == 1
+
+    # two failures open the breaker, so the third attempt goes to the next backend
+    down, spare = Flaky("down", failures=99), Flaky("spare", failures=0)
+    router = Router([down, spare])
+    assert asyncio.run(router.complete(PAYLOAD))["choices"][0]["message"]["content"] == "spare"
+    assert down.calls == 2 and down.breaker.state == "open"
+    # while open, the failing backend is not called at all
+    asyncio.run(router.complete(PAYLOAD))
+    assert down.calls == 2
+
+    # without budget left nothing is retried
+    monkeypatch.setenv("RETRY_BUDGET_CAP", "0")
+    monkeypatch.setattr(resilience, "budget", resilience.RetryBudget())
+    again = Flaky("again", failures=1)
+    with pytest.raises(HTTPException) as exc:
+        asyncio.run(Router([again]).complete(PAYLOAD))
+    assert exc.value.status_code == 503 and again.calls == 1
+    assert resilience.budget.denied == 1
+
+
+def test_request_deadline_header_bounds_the_upstream_call(tmp_path, monkeypatch):
+    from fastapi.testclient import TestClient
+    import core.database as database
+    from core.tests.test_api import create_test_user
+    monkeypatch.setattr(database, "DB_PATH", str(tmp_path / "deadline.db"))
+    monkeypatch.setenv("JWT_SECRET", "deadlinesecret")
+    monkeypatch.delenv("MOCK_MODE", raising=False)
+    slow = OfflineBackend("slow", latency=5.0)
+    monkeypatch.setattr(model_router, "router", Router([slow]))
+    database.init_db()
+    from core.main import app
+    from core.auth import _login_attempts
+    _login_attempts.clear()
+    client = TestClient(app)
+    auth_headers = {"Authorization": f"Bearer {create_test_user(client)}"}
+
+    headers = {"X-Session-Id": "dl-1", "X-Request-Timeout-Ms": "100", **auth_headers}
+    r = client.post("/api/openai/", json={"prompt": "hurry"}, headers=headers)
+    assert r.status_code == 504
+    assert "upstream" in r.json()["detail"]
+    # a client deadline does not count against the backend's breaker
+    assert slow.breaker.state == "closed"
+
+    r = client.post("/api/openai/", json={"prompt": "hurry"}, headers={**headers, "X-Request-Timeout-Ms": "soon"})
+    assert r.status_code == 400
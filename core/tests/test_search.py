@@ -0,0 +1,83 @@
+import pytest
+from fastapi import HTTPException
+from fastapi.testclient import TestClient
+
+import core.database as database
+from core import migrations
+from core import search
+from core.tests.test_api import create_test_user
+
+
+def test_match_expression_quotes_user_input():
+    assert search.match_expression('deploy "prod* OR x:y', 7) == \
+        'message : ("deploy" "prod"* "OR" "x" "y") AND user_id : "7"'
+    with pytest.raises(HTTPException):
+        search.match_expression('  "*  ', 7)
+
+
+def test_migration_backfills_existing_rows(tmp_path, monkeypatch):
+    monkeypatch.setattr(database, "DB_PATH", str(tmp_path / "fts.db"))
+    monkeypatch.setattr(migrations, "BACKFILL_CHUNK_ROWS", 3)
+    # stop at the version before the index, as an upgraded database would be
+    monkeypatch.setattr(migrations, "MIGRATIONS", migrations.MIGRATIONS[:-1])
+    database.init_db()
+    conn = database.get_db()
+    conn.executemany(
+        "INSERT INTO memory (session_id, user_id, role, message, timestamp) VALUES ('s', 1, 'user', ?, '')",
+        [(f"old note {i}",) for i in range(7)],
+    )
+    conn.commit()
+    conn.close()
+
+    monkeypatch.undo()
+    monkeypatch.setattr(database, "DB_PATH", str(tmp_path / "fts.db"))
+    monkeypatch.setattr(migrations, "BACKFILL_CHUNK_ROWS", 3)
+    database.init_db()
+    page = search.search(1, "note", limit=50)
+    assert len(page["results"]) == 7
+
+    # a rebuild leaves the same index behind
+    assert search.rebuild() == 7
+    assert len(search.search(1, "note", limit=50)["results"]) == 7
+
+
+def test_search_endpoint(tmp_path, monkeypatch):
+    monkeypatch.setattr(database, "DB_PATH", str(tmp_path / "search.db"))
+    monkeypatch.setenv("JWT_SECRET", "searchsecret")
+    database.init_db()
+    from core.main import app
+    from core.auth import _login_attempts
+    _login_attempts.clear()
+    client = TestClient(app)
+    h1 = {"Authorization": f"Bearer {create_test_user(client, 'finder', 'pw')}"}
+    h2 = {"Authorization": f"Bearer {create_test_user(client, 'other', 'pw')}"}
+
+    items = [{"session_id": "s-a", "role": "user", "message": f"the kubernetes deploy failed {i}"} for i in range(5)]
+    items.append({"session_id": "s-b", "role": "assistant", "message": "Kubernetes deploy kubernetes rollout"})
+    assert client.post("/memory/save_batch/", json={"items": items}, headers=h1).status_code == 200
+    client.post("/memory/save/", json={"session_id": "theirs", "message": "kubernetes secrets"}, headers=h2)
+
+    r = client.get("/memory/search/", params={"q": "kubernetes"}, headers=h1)
+    assert r.status_code == 200
+    results = r.json()["results"]
+    assert len(results) == 6
+    # bm25: the row mentioning the term twice in a short message ranks first
+    assert results[0]["session_id"] == "s-b"
+    assert "<mark>Kubernetes</mark>" in results[0]["snippet"]
+
+    seen, cursor = [], None
+    while True:
+        params = {"q": "deploy", "limit": 2, **({"cursor": cursor} if cursor else {})}
+        body = client.get("/memory/search/", params=params, headers=h1).json()
+        seen.extend(row["id"] for row in body["results"])
+        cursor = body["next_cursor"]
+        if not cursor:
+            break
+    assert len(seen) == len(set(seen)) == 6
+
+    only_a = client.get("/memory/search/", params={"q": "kube*", "session_id": "s-a"}, headers=h1).json()["results"]
+    assert len(only_a) == 5
+    assert client.get("/memory/search/", params={"q": "deploy", "since": "2999"}, headers=h1).json()["results"] == []
+    assert [row["session_id"] for row in client.get("/memory/search/", params={"q": "kubernetes"}, headers=h2).json()["results"]] == ["theirs"]
+    assert client.get("/memory/search/", params={"q": "???"}, headers=h1).status_code == 400
+    assert client.get("/memory/search/", params={"q": "x", "cursor": "bad"}, headers=h1).status_code == 400
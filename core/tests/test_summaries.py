@@ -0,0 +1,130 @@
+from fastapi.testclient import TestClient
+
+import core.database as database
+from core import history, summaries
+from core.tests.test_api import create_test_user
+
+
+def test_mock_summarizer_is_deterministic_and_bounded():
+    entries = [{"role": "user", "message": "word " * 40}, {"role": "assistant", "message": "short answer"}]
+    first = summaries.mock_summarize("", entries, 20)
+    assert first == summaries.mock_summarize("", entries, 20)
+    assert history.estimate_tokens(first) <= 20
+    assert first.endswith("assistant: short answer")
+
+
+def test_long_sessions_keep_a_flat_prompt_with_a_running_summary(tmp_path, monkeypatch):
+    monkeypatch.setattr(database, "DB_PATH", str(tmp_path / "summaries.db"))
+    monkeypatch.setenv("JWT_SECRET", "summarysecret")
+    monkeypatch.setenv("MOCK_MODE", "1")
+    monkeypatch.setenv("MEMORY_TOKEN_BUDGET", "60")
+    monkeypatch.setenv("SUMMARY_MAX_TOKENS", "20")
+    monkeypatch.setenv("SUMMARY_MIN_EVICTED", "2")
+    database.init_db()
+    from core.main import app
+    from core.auth import _login_attempts
+    _login_attempts.clear()
+    client = TestClient(app)
+    auth_headers = {"Authorization": f"Bearer {create_test_user(client)}"}
+
+    sizes = []
+    for n in range(16):
+        r = client.post("/api/openai/", json={"prompt": f"question {n} about the roadmap"},
+                        headers={"X-Session-Id": "long-1", **auth_headers})
+        assert r.status_code == 200
+        messages = r.json()["messages"]
+        sizes.append(sum(history.estimate_tokens(m["content"]) for m in messages))
+        summaries.folder.wait()
+
+    assert messages[0]["role"] == "system"
+    assert messages[0]["content"].startswith(summaries.PREFIX)
+    assert messages[-1]["content"] == "question 15 about the roadmap"
+    # the summary shares the budget, so the prompt does not grow with the session
+    assert max(sizes) <= 60
+    assert summaries.folder.folds >= 2
+
+    stored = summaries.load("long-1", 1)
+    assert stored is not None and stored.tokens <= history.estimate_tokens(summaries.PREFIX) + 20
+
+
+def test_batch_turns_use_and_extend_the_running_summary(tmp_path, monkeypatch):
+    import json
+    monkeypatch.setattr(database, "DB_PATH", str(tmp_path / "batch_summaries.db"))
+    monkeypatch.setenv("JWT_SECRET", "summarysecret")
+    monkeypatch.setenv("MOCK_MODE", "1")
+    monkeypatch.setenv("MEMORY_TOKEN_BUDGET", "40")
+    monkeypatch.setenv("SUMMARY_MAX_TOKENS", "20")
+    monkeypatch.setenv("SUMMARY_MIN_EVICTED", "2")
+    database.init_db()
+    from core.main import app
+    from core.auth import _login_attempts
+    _login_attempts.clear()
+    client = TestClient(app)
+    auth_headers = {"Authorization": f"Bearer {create_test_user(client)}"}
+    for n in range(12):
+        role = "user" if n % 2 == 0 else "assistant"
+        client.post("/memory/save/", json={"session_id": "bs-1", "role": role, "message": f"turn {n} " + "x" * 40},
+                    headers=auth_headers)
+
+    def batch_messages():
+        r = client.post("/api/openai/batch", json={"items": [{"session_id": "bs-1", "prompt": "next"}]},
+                        headers=auth_headers)
+        assert r.status_code == 200
+        return json.loads(r.text.splitlines()[0])["messages"]
+
+    # the first batch turn trims the old turns and folds them in the background
+    assert not batch_messages()[0]["content"].startswith(summaries.PREFIX)
+    summaries.folder.wait()
+    assert summaries.load("bs-1", 1) is not None
+
+    messages = batch_messages()
+    assert messages[0]["role"] == "system"
+    assert messages[0]["content"].startswith(summaries.PREFIX)
+    assert messages[-1]["content"] == "next"
+
+
+def test_bulk_imports_larger_than_the_window_are_folded_without_gaps(tmp_path, monkeypatch):
+    monkeypatch.setattr(database, "DB_PATH", str(tmp_path / "bulk_summaries.db"))
+    monkeypatch.setenv("JWT_SECRET", "summarysecret")
+    monkeypatch.setenv("MOCK_MODE", "1")
+    monkeypatch.setenv("MEMORY_TOKEN_BUDGET", "200")
+    monkeypatch.setenv("SUMMARY_MAX_TOKENS", "20")
+    monkeypatch.setenv("SUMMARY_MIN_EVICTED", "2")
+    database.init_db()
+    from core.main import app
+    from core.auth import _login_attempts
+    _login_attempts.clear()
+    client = TestClient(app)
+    auth_headers = {"Authorization": f"Bearer {create_test_user(client)}"}
+
+    folded = []
+    summarize = summaries.summarize
+
+    async def recording(previous, entries, tokens):
+        folded.extend(entry["id"] for entry in entries)
+        return await summarize(previous, entries, tokens)
+
+    monkeypatch.setattr(summaries, "summarize", recording)
+
+    items = [{"session_id": "bulk-1", "role": "user" if n % 2 == 0 else "assistant", "message": f"turn {n} of the import"}
+             for n in range(history.WINDOW_ROWS + 50)]
+    r = client.post("/memory/save_batch/", json={"items": items}, headers=auth_headers)
+    assert r.status_code == 200
+    imported = r.json()["ids"]
+
+    for n in range(3):
+        r = client.post("/api/openai/", json={"prompt": f"follow-up {n}"},
+                        headers={"X-Session-Id": "bulk-1", **auth_headers})
+        assert r.status_code == 200
+        summaries.folder.wait()
+
+    # the rows that never made it into the window are folded first, in order, once
+    assert folded[:50] == imported[:50]
+    assert folded == sorted(set(folded))
+    conn = database.get_db()
+    try:
+        session_ids = [row["id"] for row in conn.execute("SELECT id FROM memory WHERE session_id = 'bulk-1' ORDER BY id")]
+    finally:
+        conn.close()
+    assert folded == session_ids[:len(folded)]
+    assert summaries.load("bulk-1", 1).covered_id == folded[-1]
@@ -0,0 +1,77 @@
+from fastapi.testclient import TestClient
+
+from core import timing
+from core.tests.test_api import create_test_user
+
+
+def test_phase_is_noop_outside_a_request():
+    with timing.phase("anything") as p:
+        pass
+    assert p is timing._NO_PHASE
+
+
+def test_histogram_renders_cumulative_buckets():
+    h = timing.Histogram("x_seconds", "help", ("phase",), buckets=(0.01, 0.1))
+    h.observe(("a",), 0.005)
+    h.observe(("a",), 0.05)
+    h.observe(("a",), 5)
+    lines = h.render()
+    assert 'x_seconds_bucket{phase="a",le="0.01"} 1' in lines
+    assert 'x_seconds_bucket{phase="a",le="0.1"} 2' in lines
+    assert 'x_seconds_bucket{phase="a",le="+Inf"} 3' in lines
+    assert 'x_seconds_count{phase="a"} 3' in lines
+
+
+def test_server_timing_header_and_metrics(tmp_path, monkeypatch):
+    import core.database as database
+    monkeypatch.setattr(database, "DB_PATH", str(tmp_path / "timing.db"))
+    monkeypatch.setenv("JWT_SECRET", "timingsecret")
+    monkeypatch.setenv("MOCK_MODE", "1")
+    database.init_db()
+    from core.auth import _login_attempts
+    _login_attempts.clear()
+    from core.main import app
+    client = TestClient(app)
+    token = create_test_user(client, "timer", "pw")
+    headers = {"Authorization": f"Bearer {token}", "X-Session-Id": "timed"}
+
+    r = client.post("/api/openai/", json={"prompt": "hi"}, headers=headers)
+    assert r.status_code == 200
+    names = [part.split(";")[0] for part in r.headers["server-timing"].split(", ")]
+    for name in ("auth", "admission", "prompt_save", "history", "trim", "reply_queue", "app"):
+        assert name in names
+
+    from core import writer
+    writer.memory_writer.flush()
+    body = client.get("/metrics").text
+    assert 'brainforce_phase_duration_seconds_bucket{phase="prompt_save",le="+Inf"}' in body
+    # the reply commit is timed when it lands, after the response went out
+    assert 'brainforce_phase_duration_seconds_bucket{phase="reply_save",le="+Inf"}' in body
+    # labelled by route template, not the raw path
+    assert 'route="/api/openai/"' in body
+
+    monkeypatch.setenv("METRICS_TOKEN", "scrape")
+    assert client.get("/metrics").status_code == 401
+    assert client.get("/metrics", headers={"Authorization": "Bearer scrape"}).status_code == 200
+
+
+def test_route_template_uses_the_matched_routes_template(tmp_path, monkeypatch):
+    import core.database as database
+    monkeypatch.setattr(database, "DB_PATH", str(tmp_path / "timing_routes.db"))
+    monkeypatch.setenv("JWT_SECRET", "timingsecret")
+    database.init_db()
+    from core.auth import _login_attempts
+    _login_attempts.clear()
+    from core.main import app
+    client = TestClient(app)
+    headers = {"Authorization": f"Bearer {create_test_user(client, 'router', 'pw')}"}
+    timing.request_seconds.reset()
+
+    # a parameter value equal to a literal segment must not relabel that segment
+    client.get("/memory/session/memory/", headers=headers)
+    client.get("/memory/session/session/", headers=headers)
+    client.get("/nope")
+    routes = {values[1] for values in timing.request_seconds._series}
+    assert routes == {"/memory/session/{session_id}/", "unmatched"}
+
+    assert timing.route_template({"path": "/nope"}) == "unmatched"
@@ -0,0 +1,135 @@
+import base64
+
+from core import history, tokenizer
+
+
+def _write_vocab(directory, family="cl100k_base"):
+    tokens = [bytes([b]) for b in range(256)] + [b"he", b"ll", b"hell", b"hello", b" hello"]
+    lines = [f"{base64.b64encode(t).decode()} {rank}" for rank, t in enumerate(tokens)]
+    (directory / f"{family}.tiktoken").write_text("\n".join(lines) + "\n")
+
+
+def test_bpe_counts_with_local_vocab_and_memoizes(tmp_path, monkeypatch):
+    _write_vocab(tmp_path)
+    monkeypatch.setenv("TOKENIZER_VOCAB_DIR", str(tmp_path))
+    monkeypatch.setattr(tokenizer, "registry", tokenizer._Registry())
+
+    assert tokenizer.count_tokens("hello") == 1
+    assert tokenizer.count_tokens("hello hello") == 2
+    # unmerged bytes are a token each: "å" is two UTF-8 bytes
+    assert tokenizer.count_tokens("å") == 2
+    assert tokenizer.count_many(["hello", "hello hello"], "gpt-3.5-turbo") == [1, 2]
+    assert tokenizer.registry.hits == 2
+
+    # no o200k vocab installed, so gpt-4o falls back to the heuristic
+    assert tokenizer.family_for("gpt-4o-mini") == "o200k_base"
+    assert tokenizer.count_tokens("hello hello", "gpt-4o-mini") == history.estimate_tokens("hello hello")
+    monkeypatch.setenv("TOKENIZER", "heuristic")
+    assert tokenizer.count_tokens("hello") == history.estimate_tokens("hello")
+
+
+def test_saved_rows_store_bpe_token_counts(tmp_path, monkeypatch):
+    from fastapi.testclient import TestClient
+    import core.database as database
+    from core.tests.test_api import create_test_user
+    vocab = tmp_path / "vocab"
+    vocab.mkdir()
+    _write_vocab(vocab)
+    monkeypatch.setenv("TOKENIZER_VOCAB_DIR", str(vocab))
+    monkeypatch.setattr(tokenizer, "registry", tokenizer._Registry())
+    monkeypatch.setattr(database, "DB_PATH", str(tmp_path / "tok.db"))
+    monkeypatch.setenv("JWT_SECRET", "toksecret")
+    database.init_db()
+    from core.main import app
+    from core.auth import _login_attempts
+    _login_attempts.clear()
+    client = TestClient(app)
+    auth_headers = {"Authorization": f"Bearer {create_test_user(client)}"}
+
+    r = client.post("/memory/save/", json={"session_id": "tok-1", "role": "user", "message": "hello hello hello"},
+                    headers=auth_headers)
+    assert r.status_code == 200
+    mem = client.get("/memory/session/tok-1/", headers=auth_headers).json()
+    assert mem[0]["token_count"] == 3
+
+
+def test_split_patterns_differ_per_family_and_keep_every_character():
+    cl100k, o200k = tokenizer._PATTERNS["cl100k_base"], tokenizer._PATTERNS["o200k_base"]
+    assert cl100k.findall("don't") == ["don", "'t"]
+    assert o200k.findall("don't") == ["don't"]
+    assert o200k.findall("a/b/\n") == ["a", "/b", "/\n"]
+    text = "snake_case + 123456 å ok\r\n  end"
+    for pattern in (cl100k, o200k):
+        assert "".join(pattern.findall(text)) == text
+
+
+def test_clip_tail_keeps_newest_whole_pieces(tmp_path, monkeypatch):
+    from core import summaries
+    _write_vocab(tmp_path)
+    monkeypatch.setenv("TOKENIZER_VOCAB_DIR", str(tmp_path))
+    monkeypatch.setattr(tokenizer, "registry", tokenizer._Registry())
+
+    assert tokenizer.clip_tail("hello hello hello", 3) == "hello hello hello"
+    # counted with the tokenizer: 12 characters are 2 tokens here
+    assert tokenizer.clip_tail("hello hello hello", 2) == " hello hello"
+    # " åå" is one piece of five unmerged bytes
+    assert tokenizer.clip_tail("hello åå", 4) == ""
+    assert tokenizer.clip_tail("hello åå", 5) == " åå"
+    summary = summaries.mock_summarize("", [{"role": "user", "message": "hello " * 50}], 10)
+    assert tokenizer.count_tokens(summary) <= 10
+
+    monkeypatch.setenv("TOKENIZER", "heuristic")
+    assert tokenizer.clip_tail("x" * 20, 2) == "x" * 8
+
+
+def test_download_rejects_a_bad_checksum(tmp_path, monkeypatch):
+    import hashlib
+    import httpx
+    import pytest
+    body = base64.b64encode(b"a") + b" 0\n"
+    monkeypatch.setattr(httpx, "get", lambda url, **kw: httpx.Response(200, content=body, request=httpx.Request("GET", url)))
+
+    monkeypatch.setitem(tokenizer.VOCAB_SOURCES, "cl100k_base", ("https://vocab.invalid/c.tiktoken", "0" * 64))
+    with pytest.raises(ValueError):
+        tokenizer.download("cl100k_base", str(tmp_path))
+    assert not list(tmp_path.iterdir())
+
+    digest = hashlib.sha256(body).hexdigest()
+    monkeypatch.setitem(tokenizer.VOCAB_SOURCES, "cl100k_base", ("https://vocab.invalid/c.tiktoken", digest))
+    path = tokenizer.download("cl100k_base", str(tmp_path))
+    assert tokenizer.BPETokenizer.from_file(path).ranks == {b"a": 0}
+
+
+def test_proxy_rows_are_counted_with_the_request_model(tmp_path, monkeypatch):
+    from fastapi.testclient import TestClient
+    import core.database as database
+    from core.tests.test_api import create_test_user
+    vocab = tmp_path / "vocab"
+    vocab.mkdir()
+    _write_vocab(vocab)
+    # o200k without any merges: every byte is a token
+    lines = [f"{base64.b64encode(bytes([b])).decode()} {b}" for b in range(256)]
+    (vocab / "o200k_base.tiktoken").write_text("\n".join(lines) + "\n")
+    monkeypatch.setenv("TOKENIZER_VOCAB_DIR", str(vocab))
+    monkeypatch.setattr(tokenizer, "registry", tokenizer._Registry())
+    monkeypatch.setattr(database, "DB_PATH", str(tmp_path / "tok_model.db"))
+    monkeypatch.setenv("JWT_SECRET", "toksecret")
+    monkeypatch.setenv("MOCK_MODE", "1")
+    database.init_db()
+    from core.main import app
+    from core.auth import _login_attempts
+    _login_attempts.clear()
+    client = TestClient(app)
+    auth_headers = {"Authorization": f"Bearer {create_test_user(client)}"}
+
+    for model, session in (("gpt-3.5-turbo", "tok-35"), ("gpt-4o-mini", "tok-4o")):
+        r = client.post("/api/openai/", json={"prompt": "hello hello hello", "model": model},
+                        headers={"X-Session-Id": session, **auth_headers})
+        assert r.status_code == 200
+    counts = {
+        m["session_id"]: m["token_count"]
+        for session in ("tok-35", "tok-4o")
+        for m in client.get(f"/memory/session/{session}/", headers=auth_headers).json()
+        if m["role"] == "user"
+    }
+    assert counts == {"tok-35": 3, "tok-4o": 17}
@@ -0,0 +1,119 @@
+import sqlite3
+import threading
+
+import pytest
+
+from core.writer import AppendWriter, SQLiteWriter
+
+
+def _make_db(path):
+    conn = sqlite3.connect(path)
+    conn.execute("CREATE TABLE t (id INTEGER PRIMARY KEY AUTOINCREMENT, v TEXT)")
+    conn.commit()
+    conn.close()
+
+
+def test_sqlite_writer_groups_inserts_into_few_commits(tmp_path):
+    db = str(tmp_path / "w.db")
+    _make_db(db)
+    w = SQLiteWriter(max_delay=0.05, max_batch=100)
+    gate = threading.Event()
+
+    def insert(v):
+        def op(c):
+            gate.wait(1)
+            c.execute("INSERT INTO t (v) VALUES (?)", (v,))
+            return c.lastrowid
+        return op
+
+    futures = [w.submit(db, insert(str(i))) for i in range(20)]
+    gate.set()
+    ids = [f.result(5) for f in futures]
+    w.close()
+
+    assert ids == sorted(ids) and len(set(ids)) == 20
+    assert w.batches < 20
+    conn = sqlite3.connect(db)
+    assert conn.execute("SELECT COUNT(*) FROM t").fetchone()[0] == 20
+    conn.close()
+
+
+def test_failing_op_only_rolls_back_itself(tmp_path):
+    db = str(tmp_path / "w.db")
+    _make_db(db)
+    w = SQLiteWriter(max_delay=0.05)
+    seen = []
+
+    def good(c):
+        c.execute("INSERT INTO t (v) VALUES ('ok')")
+        return "ok"
+
+    def bad(c):
+        c.execute("INSERT INTO t (v) VALUES ('bad')")
+        raise ValueError("nope")
+
+    f1 = w.submit(db, good, after_commit=seen.append)
+    f2 = w.submit(db, bad)
+    f3 = w.submit(db, good)
+    assert f1.result(5) == "ok" and f3.result(5) == "ok"
+    with pytest.raises(ValueError):
+        f2.result(5)
+    w.flush(5)
+    w.close()
+
+    assert seen == ["ok"]
+    conn = sqlite3.connect(db)
+    assert [r[0] for r in conn.execute("SELECT v FROM t ORDER BY id")] == ["ok", "ok"]
+    conn.close()
+
+
+def test_append_writer_and_synchronous_fallback(tmp_path, monkeypatch):
+    log = tmp_path / "events.log"
+    w = AppendWriter()
+    for i in range(3):
+        w.submit(str(log), f"line {i}\n")
+    w.flush(5)
+    w.close()
+    assert log.read_text().splitlines() == ["line 0", "line 1", "line 2"]
+
+    monkeypatch.setenv("WRITE_BEHIND", "0")
+    w.submit(str(log), "sync\n").result(0)
+    assert log.read_text().splitlines()[-1] == "sync"
+
+
+def test_synchronous_mode_keeps_commits_off_the_event_loop(tmp_path, monkeypatch):
+    import asyncio
+    db = str(tmp_path / "sync.db")
+    _make_db(db)
+    monkeypatch.setenv("WRITE_BEHIND", "0")
+    w = SQLiteWriter()
+    gate = threading.Event()
+
+    def op(c):
+        gate.wait(5)
+        c.execute("INSERT INTO t (v) VALUES ('x')")
+        return c.lastrowid
+
+    async def scenario():
+        # returns while the commit is still blocked, so the loop keeps running
+        future = w.submit(db, op)
+        assert not future.done()
+        gate.set()
+        return await asyncio.wrap_future(future)
+
+    assert asyncio.run(scenario()) == 1
+
+    gate.clear()
+    pending = []
+    threading.Timer(0.05, gate.set).start()
+
+    async def fire_and_forget():
+        pending.append(w.submit(db, op))
+
+    asyncio.run(fire_and_forget())
+    # flush also waits for writes handed to the sync pool
+    w.flush(5)
+    assert pending[0].done()
+    conn = sqlite3.connect(db)
+    assert conn.execute("SELECT COUNT(*) FROM t").fetchone()[0] == 2
+    conn.close()
@@ -0,0 +1,206 @@
+"""Per-phase request timing: Server-Timing headers and Prometheus histograms.
+
+Handlers wrap the expensive parts of a request in ``with timing.phase("history"):``.
+:class:`TimingMiddleware` gives every request a fresh dict of phase
+durations, adds them to the response as a ``Server-Timing`` header (in
+milliseconds, plus ``app`` for the time until the headers went out) and,
+once the response is finished, folds them into fixed-bucket histograms that
+``/metrics`` renders in the Prometheus text format:
+
+- ``brainforce_phase_duration_seconds{phase}``
+- ``brainforce_request_duration_seconds{method,route,status}``
+
+Phases that end after the headers were sent (e.g. queueing the reply of a
+streamed response) only reach the histograms, as do durations recorded with
+:func:`observe` for work the request does not wait for, such as
+``reply_save``: queueing to commit of the assistant reply.
+
+REQUEST_TIMING=0 (read when the app is built) leaves the middleware out;
+``phase()`` is then a single context-variable lookup returning a shared no-op.
+"""
+import bisect
+import contextvars
+import os
+import threading
+import time
+from typing import Dict, List, Optional, Tuple
+
+from starlette.routing import NoMatchFound
+
+# seconds; the +Inf bucket is implicit
+BUCKETS: Tuple[float, ...] = (
+    0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0,
+)
+
+_phases: contextvars.ContextVar = contextvars.ContextVar("request_phases", default=None)
+
+
+def enabled() -> bool:
+    return os.getenv("REQUEST_TIMING", "1") != "0"
+
+
+class _NoPhase:
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc) -> None:
+        return None
+
+
+_NO_PHASE = _NoPhase()
+
+
+class _Phase:
+    __slots__ = ("_store", "_name", "_started")
+
+    def __init__(self, store: Dict[str, float], name: str):
+        self._store = store
+        self._name = name
+
+    def __enter__(self):
+        self._started = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc) -> None:
+        elapsed = time.perf_counter() - self._started
+        store = self._store
+        # a phase entered twice in one request adds up
+        store[self._name] = store.get(self._name, 0.0) + elapsed
+
+
+def phase(name: str):
+    """Context manager timing ``name`` for the current request (no-op outside one)."""
+    store = _phases.get()
+    if store is None:
+        return _NO_PHASE
+    return _Phase(store, name)
+
+
+class Histogram:
+    """Fixed-bucket histogram family keyed by a tuple of label values."""
+
+    def __init__(self, name: str, help_text: str, labels: Tuple[str, ...], buckets: Tuple[float, ...] = BUCKETS):
+        self.name = name
+        self.help = help_text
+        self.labels = labels
+        self.buckets = buckets
+        self._lock = threading.Lock()
+        # label values -> [per-bucket counts..., +Inf count, sum]
+        self._series: Dict[tuple, List[float]] = {}
+
+    def observe(self, values: tuple, seconds: float) -> None:
+        index = bisect.bisect_left(self.buckets, seconds)
+        with self._lock:
+            series = self._series.get(values)
+            if series is None:
+                series = self._series[values] = [0] * (len(self.buckets) + 1) + [0.0]
+            series[index] += 1
+            series[-1] += seconds
+
+    def reset(self) -> None:
+        with self._lock:
+            self._series.clear()
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            series = sorted((k, list(v)) for k, v in self._series.items())
+        for values, counts in series:
+            labels = ",".join(f'{k}="{_escape(v)}"' for k, v in zip(self.labels, values))
+            sep = "," if labels else ""
+            cumulative = 0
+            for bound, count in zip(self.buckets, counts):
+                cumulative += count
+                lines.append(f'{self.name}_bucket{{{labels}{sep}le="{bound:g}"}} {cumulative}')
+            cumulative += counts[len(self.buckets)]
+            lines.append(f'{self.name}_bucket{{{labels}{sep}le="+Inf"}} {cumulative}')
+            lines.append(f"{self.name}_sum{{{labels}}} {counts[-1]:.6f}")
+            lines.append(f"{self.name}_count{{{labels}}} {cumulative}")
+        return lines
+
+
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+phase_seconds = Histogram(
+    "brainforce_phase_duration_seconds", "Time spent in each phase of a request.", ("phase",)
+)
+request_seconds = Histogram(
+    "brainforce_request_duration_seconds", "Time from request start to the end of the response.",
+    ("method", "route", "status"),
+)
+
+
+def observe(name: str, seconds: float) -> None:
+    """Record a phase that ends outside any request (histograms only)."""
+    if enabled():
+        phase_seconds.observe((name,), seconds)
+
+
+def render() -> str:
+    """Every histogram in the Prometheus text exposition format."""
+    return "\n".join(phase_seconds.render() + request_seconds.render()) + "\n"
+
+
+def server_timing(store: Dict[str, float], app_seconds: Optional[float] = None) -> str:
+    parts = [f"{name};dur={seconds * 1000.0:.3f}" for name, seconds in store.items()]
+    if app_seconds is not None:
+        parts.append(f"app;dur={app_seconds * 1000.0:.3f}")
+    return ", ".join(parts)
+
+
+def route_template(scope) -> str:
+    """``/memory/session/{session_id}/`` for ``/memory/session/abc/``.
+
+    Labels use the matched route's template, never the raw path, so their
+    cardinality stays bounded.  A route inside an included router may not
+    carry the router's prefix in its path; the prefix is then whatever
+    precedes the route's own rendered path in the request path.
+    """
+    route = scope.get("route")
+    if route is None:
+        return "unmatched"
+    template = getattr(route, "path_format", None) or getattr(route, "path", "")
+    try:
+        own = str(route.url_path_for(route.name, **(scope.get("path_params") or {})))
+    except (AttributeError, NoMatchFound):
+        return template
+    path = scope.get("path", "")
+    prefix = path[:len(path) - len(own)] if path.endswith(own) else ""
+    return prefix + template
+
+
+class TimingMiddleware:
+    """Pure ASGI middleware, so streamed responses pass through untouched."""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        store: Dict[str, float] = {}
+        token = _phases.set(store)
+        started = time.perf_counter()
+        status = [500]
+
+        async def send_timed(message):
+            if message["type"] == "http.response.start":
+                status[0] = message["status"]
+                header = server_timing(store, time.perf_counter() - started)
+                message = dict(message)
+                message["headers"] = list(message.get("headers") or []) + [(b"server-timing", header.encode("latin-1"))]
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_timed)
+        finally:
+            elapsed = time.perf_counter() - started
+            _phases.reset(token)
+            request_seconds.observe((scope.get("method", ""), route_template(scope), str(status[0])), elapsed)
+            for name, seconds in store.items():
+                phase_seconds.observe((name,), seconds)
@@ -0,0 +1,264 @@
+"""Token counting with a local byte-level BPE per model family.
+
+``history.estimate_tokens`` (about four characters per token) is far off for
+code, Swedish and CJK text.  This module counts tokens with the models'
+published byte-pair merge ranks, without network access or extra packages:
+
+- a model name maps to a family (``o200k_base`` for gpt-4o/o1/o3/o4,
+  ``cl100k_base`` for gpt-4 and gpt-3.5; others use TOKENIZER_DEFAULT_FAMILY)
+- each family's merge ranks are read from ``<family>.tiktoken`` in
+  TOKENIZER_VOCAB_DIR (default ``core/vocab``), the plain-text format
+  tiktoken publishes: one ``<base64 token> <rank>`` per line
+- text is split into pieces with a per-family pattern before merging.
+  tiktoken's patterns need ``\\p{...}`` classes the re module lacks, so these
+  approximate them; counts can differ from the API's by a token here and
+  there (o200k's split of camelCase words, for one, is not reproduced)
+- counts are memoized per message hash (TOKENIZER_CACHE_SIZE entries,
+  default 50000) and per pre-tokenized piece
+
+The vocab files are a few MB each and not committed.  Fetch them (checked
+against their published SHA-256) with:
+
+    python -m core.tokenizer --download [--family NAME] [--dir PATH]
+
+Without a vocab file, or with TOKENIZER=heuristic, counting falls back to
+``history.estimate_tokens`` at no cost.
+
+History is trimmed with the ``memory.token_count`` stored on each row, not
+recounted per request.  Rows written by the proxy are counted with the
+request's model; rows saved through /memory/ carry no model and use
+TOKENIZER_DEFAULT_FAMILY.  Rows backfilled by migration 2 keep the
+four-characters-per-token estimate and are never recounted, so sessions
+older than the column are trimmed with the heuristic until those turns
+age out of the window.
+"""
+import argparse
+import base64
+import hashlib
+import os
+import re
+import threading
+from collections import OrderedDict
+from functools import lru_cache
+from typing import Dict, Iterable, List, Optional
+
+from core import history
+
+DEFAULT_VOCAB_DIR = os.path.join(os.path.dirname(__file__), "vocab")
+
+# \p{L} is [^\W\d_] here, \p{N} is \d and "neither" is [^\w] or "_"
+_PATTERNS = {
+    "cl100k_base": re.compile(
+        r"""'(?i:[sdmt]|ll|ve|re)|(?:[^\r\n\w]|_)?[^\W\d_]+|\d{1,3}| ?(?:[^\s\w]|_)+[\r\n]*|\s*[\r\n]+|\s+(?!\S)|\s+""",
+        re.UNICODE,
+    ),
+    # contractions stay on their word and "/" joins trailing punctuation
+    "o200k_base": re.compile(
+        r"""(?:[^\r\n\w]|_)?[^\W\d_]+(?i:'s|'t|'re|'ve|'m|'ll|'d)?|\d{1,3}| ?(?:[^\s\w]|_)+[\r\n/]*|\s*[\r\n]+|\s+(?!\S)|\s+""",
+        re.UNICODE,
+    ),
+}
+
+# where tiktoken publishes each family's merge ranks, with the file's SHA-256
+VOCAB_SOURCES = {
+    "cl100k_base": (
+        "https://openaipublic.blob.core.windows.net/encodings/cl100k_base.tiktoken",
+        "223921b76ee99bde995b7ff738513eef100fb51d18c93597a113bcffe865b2a7",
+    ),
+    "o200k_base": (
+        "https://openaipublic.blob.core.windows.net/encodings/o200k_base.tiktoken",
+        "446a9538cb6c348e3516120d7c08b09f57c36495e2acfffe59a5bf8b0cfb1a2d",
+    ),
+}
+
+_FAMILY_PREFIXES = (
+    ("gpt-4o", "o200k_base"),
+    ("o1", "o200k_base"),
+    ("o3", "o200k_base"),
+    ("o4", "o200k_base"),
+    ("gpt-4", "cl100k_base"),
+    ("gpt-3.5", "cl100k_base"),
+)
+
+
+def _env_int(name: str, default: int) -> int:
+    try:
+        return int(os.getenv(name, default))
+    except (TypeError, ValueError):
+        return default
+
+
+def family_for(model: Optional[str]) -> str:
+    for prefix, family in _FAMILY_PREFIXES:
+        if model and model.startswith(prefix):
+            return family
+    return os.getenv("TOKENIZER_DEFAULT_FAMILY", "cl100k_base")
+
+
+class BPETokenizer:
+    """Byte-level BPE that only needs the merge ranks."""
+
+    def __init__(self, ranks: Dict[bytes, int], pattern=None, piece_cache: int = 65536):
+        self.ranks = ranks
+        self.pattern = pattern or _PATTERNS["cl100k_base"]
+        self._count_piece = lru_cache(maxsize=piece_cache)(self._merge_count)
+
+    @classmethod
+    def from_file(cls, path: str, pattern=None) -> "BPETokenizer":
+        ranks: Dict[bytes, int] = {}
+        with open(path, "rb") as fh:
+            for line in fh:
+                if not line.strip():
+                    continue
+                token, rank = line.split()
+                ranks[base64.b64decode(token)] = int(rank)
+        return cls(ranks, pattern)
+
+    def _merge_count(self, piece: bytes) -> int:
+        if piece in self.ranks:
+            return 1
+        parts = [piece[i:i + 1] for i in range(len(piece))]
+        while len(parts) > 1:
+            best, best_rank = -1, None
+            for i in range(len(parts) - 1):
+                rank = self.ranks.get(parts[i] + parts[i + 1])
+                if rank is not None and (best_rank is None or rank < best_rank):
+                    best, best_rank = i, rank
+            if best_rank is None:
+                break
+            parts[best:best + 2] = [parts[best] + parts[best + 1]]
+        return len(parts)
+
+    def count(self, text: str) -> int:
+        return sum(self._count_piece(piece.encode("utf-8")) for piece in self.pattern.findall(text))
+
+    def clip_tail(self, text: str, tokens: int) -> str:
+        # the patterns match every character, so whole pieces rejoin exactly
+        pieces = self.pattern.findall(text)
+        start, total = len(pieces), 0
+        while start > 0:
+            total += self._count_piece(pieces[start - 1].encode("utf-8"))
+            if total > tokens:
+                break
+            start -= 1
+        return "".join(pieces[start:])
+
+
+class _Registry:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._tokenizers: Dict[tuple, Optional[BPETokenizer]] = {}
+        self._counts: "OrderedDict[bytes, int]" = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def tokenizer(self, family: str) -> Optional[BPETokenizer]:
+        if os.getenv("TOKENIZER", "bpe") == "heuristic":
+            return None
+        path = os.path.join(os.getenv("TOKENIZER_VOCAB_DIR", DEFAULT_VOCAB_DIR), f"{family}.tiktoken")
+        key = (family, path)
+        with self._lock:
+            if key in self._tokenizers:
+                return self._tokenizers[key]
+        try:
+            loaded: Optional[BPETokenizer] = BPETokenizer.from_file(path, _PATTERNS.get(family))
+        except FileNotFoundError:
+            loaded = None
+        except (OSError, ValueError) as exc:
+            print(f"warning: could not load tokenizer vocab {path}: {exc}")
+            loaded = None
+        with self._lock:
+            return self._tokenizers.setdefault(key, loaded)
+
+    def count(self, text: str, model: Optional[str] = None) -> int:
+        family = family_for(model)
+        bpe = self.tokenizer(family)
+        if bpe is None:
+            return history.estimate_tokens(text)
+        key = hashlib.blake2b(f"{family}\0{text}".encode("utf-8"), digest_size=16).digest()
+        with self._lock:
+            cached = self._counts.get(key)
+            if cached is not None:
+                self._counts.move_to_end(key)
+                self.hits += 1
+                return cached
+            self.misses += 1
+        # the heuristic never counts an empty message as zero, keep that floor
+        tokens = max(1, bpe.count(text))
+        limit = _env_int("TOKENIZER_CACHE_SIZE", 50000)
+        with self._lock:
+            if limit > 0:
+                self._counts[key] = tokens
+                while len(self._counts) > limit:
+                    self._counts.popitem(last=False)
+        return tokens
+
+    def clip_tail(self, text: str, tokens: int, model: Optional[str] = None) -> str:
+        bpe = self.tokenizer(family_for(model))
+        if bpe is None:
+            # the inverse of estimate_tokens' four characters per token
+            limit = max(0, tokens) * 4
+            return text if len(text) <= limit else text[len(text) - limit:]
+        return bpe.clip_tail(text, tokens)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._tokenizers.clear()
+            self._counts.clear()
+
+
+registry = _Registry()
+
+
+def count_tokens(text: str, model: Optional[str] = None) -> int:
+    """Tokens in ``text`` for ``model``'s family (heuristic if no vocab is installed)."""
+    return registry.count(text or "", model)
+
+
+def count_many(texts: Iterable[str], model: Optional[str] = None) -> List[int]:
+    """Batch form of :func:`count_tokens`, e.g. for a whole history window."""
+    return [registry.count(text or "", model) for text in texts]
+
+
+def clip_tail(text: str, tokens: int, model: Optional[str] = None) -> str:
+    """The newest part of ``text`` that fits in ``tokens``, cut between whole pieces."""
+    return registry.clip_tail(text or "", tokens, model)
+
+
+def download(family: str, directory: Optional[str] = None) -> str:
+    """Fetch ``family``'s merge ranks into ``directory``; returns the file path.
+
+    Raises ValueError for an unknown family or a checksum mismatch.
+    """
+    import httpx
+
+    if family not in VOCAB_SOURCES:
+        raise ValueError(f"unknown tokenizer family {family!r}")
+    url, sha256 = VOCAB_SOURCES[family]
+    directory = directory or os.getenv("TOKENIZER_VOCAB_DIR", DEFAULT_VOCAB_DIR)
+    os.makedirs(directory, exist_ok=True)
+    resp = httpx.get(url, timeout=60.0, follow_redirects=True)
+    resp.raise_for_status()
+    digest = hashlib.sha256(resp.content).hexdigest()
+    if digest != sha256:
+        raise ValueError(f"{url} has SHA-256 {digest}, expected {sha256}")
+    path = os.path.join(directory, f"{family}.tiktoken")
+    # a half-written file must never be picked up as a vocab
+    partial = path + ".part"
+    with open(partial, "wb") as fh:
+        fh.write(resp.content)
+    os.replace(partial, path)
+    return path
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(prog="python -m core.tokenizer", description="Tokenizer vocab maintenance")
+    parser.add_argument("--download", action="store_true", help="fetch and verify the merge-rank files")
+    parser.add_argument("--family", action="append", choices=sorted(VOCAB_SOURCES),
+                        help="family to fetch (repeatable; default all)")
+    parser.add_argument("--dir", default=None, help=f"vocab directory (default {DEFAULT_VOCAB_DIR})")
+    args = parser.parse_args()
+    if not args.download:
+        parser.error("nothing to do; pass --download")
+    for name in args.family or sorted(VOCAB_SOURCES):
+        print(f"{name}: {download(name, args.dir)}")
@@ -0,0 +1,112 @@
+"""Shared async HTTP client for upstream model APIs.
+
+A single pooled ``httpx.AsyncClient`` is kept for the lifetime of the app so
+that chat turns reuse keep-alive connections instead of paying a fresh
+TCP+TLS handshake each time.  Pool limits and per-phase timeouts are read
+from the environment when the client is created:
+
+- UPSTREAM_MAX_CONNECTIONS (default 100)
+- UPSTREAM_MAX_KEEPALIVE (default 20)
+- UPSTREAM_KEEPALIVE_EXPIRY seconds (default 30)
+- UPSTREAM_CONNECT_TIMEOUT / UPSTREAM_READ_TIMEOUT /
+  UPSTREAM_WRITE_TIMEOUT / UPSTREAM_POOL_TIMEOUT seconds
+
+OPENAI_BASE_URL (e.g. ``http://127.0.0.1:8001/v1`` for the fake upstream in
+core/mock.py) replaces ``https://api.openai.com/v1``; it is read per call.
+"""
+import asyncio
+import os
+import weakref
+from typing import Optional
+
+OPENAI_CHAT_URL = "https://api.openai.com/v1/chat/completions"
+
+# optional transport override (tests plug in httpx.MockTransport here)
+_transport = None
+
+_client = None
+_client_loop: Optional[asyncio.AbstractEventLoop] = None
+# clients of other live loops, dropped together with their loop
+_side_clients: "weakref.WeakKeyDictionary" = weakref.WeakKeyDictionary()
+
+
+def _env_int(name: str, default: int) -> int:
+    try:
+        return int(os.getenv(name, default))
+    except (TypeError, ValueError):
+        return default
+
+
+def _env_float(name: str, default: float) -> float:
+    try:
+        return float(os.getenv(name, default))
+    except (TypeError, ValueError):
+        return default
+
+
+def chat_url() -> str:
+    """Chat completions endpoint, honouring OPENAI_BASE_URL."""
+    base = os.getenv("OPENAI_BASE_URL")
+    if base:
+        return base.rstrip("/") + "/chat/completions"
+    return OPENAI_CHAT_URL
+
+
+def _build_client():
+    # import httpx lazily so module import works even when httpx isn't installed
+    import httpx
+
+    limits = httpx.Limits(
+        max_connections=_env_int("UPSTREAM_MAX_CONNECTIONS", 100),
+        max_keepalive_connections=_env_int("UPSTREAM_MAX_KEEPALIVE", 20),
+        keepalive_expiry=_env_float("UPSTREAM_KEEPALIVE_EXPIRY", 30.0),
+    )
+    timeout = httpx.Timeout(
+        connect=_env_float("UPSTREAM_CONNECT_TIMEOUT", 5.0),
+        read=_env_float("UPSTREAM_READ_TIMEOUT", 60.0),
+        write=_env_float("UPSTREAM_WRITE_TIMEOUT", 10.0),
+        pool=_env_float("UPSTREAM_POOL_TIMEOUT", 5.0),
+    )
+    return httpx.AsyncClient(limits=limits, timeout=timeout, transport=_transport)
+
+
+def get_client():
+    """Return the shared AsyncClient, creating it on first use.
+
+    The client is bound to the event loop it was created on; if called from a
+    different loop (e.g. the TestClient spins up one per request) a new
+    client is built instead of reusing connections owned by a dead loop.
+    A second loop that runs alongside a live one (the background summarizer)
+    gets a client of its own rather than taking the shared one over.
+    """
+    global _client, _client_loop
+    loop = asyncio.get_running_loop()
+    if _client is not None and not _client.is_closed and _client_loop is loop:
+        return _client
+    if _client is not None and not _client.is_closed and _client_loop is not None and _client_loop.is_running():
+        client = _side_clients.get(loop)
+        if client is None or client.is_closed:
+            client = _side_clients[loop] = _build_client()
+        return client
+    _client = _build_client()
+    _client_loop = loop
+    return _client
+
+
+async def aclose() -> None:
+    """Close the shared client (called from the app shutdown hook).
+
+    A side loop's client is closed instead when called from that loop.
+    """
+    global _client, _client_loop
+    side = _side_clients.pop(asyncio.get_running_loop(), None)
+    if side is not None:
+        await side.aclose()
+        return
+    client, loop = _client, _client_loop
+    _client, _client_loop = None, None
+    if client is None or client.is_closed:
+        return
+    # a client owned by another (already finished) loop cannot be awaited here
+    if loop is asyncio.get_running_loop():
+        await client.aclose()
@@ -0,0 +1,262 @@
+"""Write-behind queues that group many small writes into one commit.
+
+Each writer owns a single background thread that drains a queue, collects
+up to WRITE_BEHIND_MAX_BATCH items (waiting at most WRITE_BEHIND_MAX_DELAY_MS
+for more to arrive) and commits them together, so concurrent requests share
+one commit/fsync instead of paying for their own.
+
+``submit`` returns a ``concurrent.futures.Future`` that resolves once the
+item is durable; callers that need the result (or read-your-writes) wait on
+it, others just fire and forget.  Setting WRITE_BEHIND=0 commits every
+write on its own instead: synchronously in the caller's thread, or, when the
+caller is running an event loop, in a worker thread so the loop never waits
+on a commit (``flush`` waits for those as well).
+"""
+import asyncio
+import atexit
+import os
+import queue
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor, wait
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+from core import database
+
+_STOP = object()
+
+
+def _env_number(name: str, default: float) -> float:
+    try:
+        return float(os.getenv(name, default))
+    except (TypeError, ValueError):
+        return default
+
+
+def enabled() -> bool:
+    return os.getenv("WRITE_BEHIND", "1") != "0"
+
+
+def _on_event_loop() -> bool:
+    try:
+        asyncio.get_running_loop()
+    except RuntimeError:
+        return False
+    return True
+
+
+# runs WRITE_BEHIND=0 writes submitted from an event loop, see submit()
+_sync_pool: Optional[ThreadPoolExecutor] = None
+_sync_pool_lock = threading.Lock()
+
+
+def _sync_executor() -> ThreadPoolExecutor:
+    global _sync_pool
+    with _sync_pool_lock:
+        if _sync_pool is None:
+            _sync_pool = ThreadPoolExecutor(max_workers=4, thread_name_prefix="writer-sync")
+        return _sync_pool
+
+
+class _Item:
+    __slots__ = ("key", "op", "after_commit", "future")
+
+    def __init__(self, key, op, after_commit):
+        self.key = key
+        self.op = op
+        self.after_commit = after_commit
+        self.future: Future = Future()
+
+
+class _BatchWriter:
+    """Single-threaded batching writer; subclasses implement ``_commit``."""
+
+    name = "writer"
+
+    def __init__(self, max_delay: Optional[float] = None, max_batch: Optional[int] = None):
+        self.max_delay = max_delay
+        self.max_batch = max_batch
+        self._queue: "queue.Queue" = queue.Queue()
+        self._thread: Optional[threading.Thread] = None
+        self._lock = threading.Lock()
+        self._pending = 0
+        # WRITE_BEHIND=0 writes still running in the sync pool
+        self._detached: set = set()
+        self.batches = 0
+        self.items = 0
+
+    def _limits(self) -> Tuple[float, int]:
+        delay = self.max_delay
+        if delay is None:
+            delay = _env_number("WRITE_BEHIND_MAX_DELAY_MS", 1) / 1000.0
+        batch = self.max_batch
+        if batch is None:
+            batch = int(_env_number("WRITE_BEHIND_MAX_BATCH", 256))
+        return delay, max(1, batch)
+
+    def submit(self, key, op, after_commit: Optional[Callable[[Any], None]] = None) -> Future:
+        """Queue ``op`` for the resource ``key``; the future carries its result.
+
+        ``after_commit(result)`` runs in the writer thread after the commit and
+        before the future resolves, e.g. to update caches write-through.
+        """
+        item = _Item(key, op, after_commit)
+        if not enabled():
+            if _on_event_loop():
+                # an inline commit would stall every request on this loop
+                self._run_detached(item)
+            else:
+                self._run_batch([item])
+            return item.future
+        with self._lock:
+            self._pending += 1
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._run, name=self.name, daemon=True)
+                self._thread.start()
+        self._queue.put(item)
+        return item.future
+
+    def _run_detached(self, item: _Item) -> None:
+        with self._lock:
+            self._detached.add(item.future)
+        item.future.add_done_callback(self._detached_done)
+        _sync_executor().submit(self._run_batch, [item])
+
+    def _detached_done(self, future: Future) -> None:
+        with self._lock:
+            self._detached.discard(future)
+
+    def flush(self, timeout: Optional[float] = None) -> None:
+        """Block until everything submitted so far is committed."""
+        with self._lock:
+            detached = list(self._detached)
+            pending = self._pending
+        if detached:
+            wait(detached, timeout)
+        if pending == 0:
+            return
+        self.submit(None, None).result(timeout)
+
+    def close(self, timeout: Optional[float] = 5.0) -> None:
+        """Drain the queue and stop the writer thread."""
+        with self._lock:
+            thread, self._thread = self._thread, None
+        if thread is not None and thread.is_alive():
+            self._queue.put(_STOP)
+            thread.join(timeout)
+
+    def _run(self) -> None:
+        while True:
+            first = self._queue.get()
+            if first is _STOP:
+                return
+            max_delay, max_batch = self._limits()
+            batch = [first]
+            stop = False
+            deadline = time.monotonic() + max_delay
+            while len(batch) < max_batch:
+                remaining = deadline - time.monotonic()
+                try:
+                    item = self._queue.get(timeout=remaining) if remaining > 0 else self._queue.get_nowait()
+                except queue.Empty:
+                    break
+                if item is _STOP:
+                    stop = True
+                    break
+                batch.append(item)
+            self._run_batch(batch)
+            with self._lock:
+                self._pending -= len(batch)
+            if stop:
+                return
+
+    def _run_batch(self, batch: List[_Item]) -> None:
+        groups: Dict[Any, List[_Item]] = {}
+        for item in batch:
+            if item.op is None:
+                # flush marker, resolves once everything queued before it is done
+                continue
+            if not item.future.set_running_or_notify_cancel():
+                # the caller cancelled before the write started
+                continue
+            groups.setdefault(item.key, []).append(item)
+        for key, items in groups.items():
+            try:
+                results = self._commit(key, items)
+            except BaseException as exc:
+                for item in items:
+                    if not item.future.done():
+                        item.future.set_exception(exc)
+                continue
+            for item, result in zip(items, results):
+                if isinstance(result, BaseException):
+                    item.future.set_exception(result)
+                    continue
+                if item.after_commit is not None:
+                    try:
+                        item.after_commit(result)
+                    except Exception as exc:
+                        print(f"warning: {self.name} after-commit hook failed: {exc}")
+                item.future.set_result(result)
+        self.batches += 1
+        self.items += len(batch)
+        for item in batch:
+            if item.op is None and item.future.set_running_or_notify_cancel():
+                item.future.set_result(None)
+
+    def _commit(self, key, items: List[_Item]) -> List[Any]:
+        raise NotImplementedError
+
+
+class SQLiteWriter(_BatchWriter):
+    """Runs ``op(cursor)`` callables against the database at ``key`` in one transaction.
+
+    Every op gets its own savepoint, so one failing op (e.g. an ownership
+    check raising HTTPException) only rolls back itself.
+    """
+
+    name = "sqlite-writer"
+
+    def _commit(self, key: str, items: List[_Item]) -> List[Any]:
+        conn = database.get_db(key)
+        try:
+            c = conn.cursor()
+            database.begin_immediate(c)
+            results: List[Any] = []
+            for item in items:
+                c.execute("SAVEPOINT op")
+                try:
+                    results.append(item.op(c))
+                    c.execute("RELEASE op")
+                except Exception as exc:
+                    c.execute("ROLLBACK TO op")
+                    c.execute("RELEASE op")
+                    results.append(exc)
+            c.execute("COMMIT")
+            return results
+        finally:
+            # returning the connection to the pool rolls back anything unfinished
+            conn.close()
+
+
+class AppendWriter(_BatchWriter):
+    """Appends text lines to the file at ``key`` with one write per batch."""
+
+    name = "append-writer"
+
+    def _commit(self, key: str, items: List[_Item]) -> List[Any]:
+        with open(key, "a") as f:
+            f.write("".join(item.op for item in items))
+        return [None] * len(items)
+
+
+memory_writer = SQLiteWriter()
+log_writer = AppendWriter()
+
+
+def close_all() -> None:
+    memory_writer.close()
+    log_writer.close()
+
+
+atexit.register(close_all)